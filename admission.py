@@ -0,0 +1,178 @@
+import os
+import time
+import logging
+import threading
+import functools
+from collections import deque
+from contextlib import contextmanager
+from metrics import metrics
+
+
+class BusyError(Exception):
+    """Raised when a request is shed because the service or the user is over its limits"""
+
+    def __init__(self, message, reason, backend=None):
+        super().__init__(message)
+        self.reason = reason
+        self.backend = backend
+
+
+BUSY_MESSAGE = "I'm helping a lot of people right now. Please take a slow breath and try again in a few seconds."
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        """Initialize a bucket refilled at rate tokens per second up to capacity"""
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = float(capacity)
+        self.updated = clock()
+
+    def try_consume(self, amount=1):
+        """Take tokens if available, returning False without blocking otherwise"""
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+
+class FairLimiter:
+    def __init__(self, name, concurrency, max_queue, queue_timeout):
+        """Initialize a concurrency cap whose waiters are served strictly first-come, first-served"""
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiters = deque()
+
+    def acquire(self, timeout=None):
+        """Wait in line for a slot, raising BusyError when the queue is full or the wait times out"""
+        timeout = self.queue_timeout if timeout is None else timeout
+        start = time.monotonic()
+        with self._cond:
+            if self._active < self.concurrency and not self._waiters:
+                self._active += 1
+                self._publish()
+                return
+            if len(self._waiters) >= self.max_queue:
+                metrics.inc("admission_rejected_total", reason="queue_full", backend=self.name)
+                raise BusyError(f"'{self.name}' queue is full", "queue_full", self.name)
+
+            ticket = object()
+            self._waiters.append(ticket)
+            self._publish()
+            try:
+                while not (self._waiters[0] is ticket and self._active < self.concurrency):
+                    remaining = timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        metrics.inc("admission_rejected_total", reason="queue_timeout", backend=self.name)
+                        raise BusyError(f"Timed out waiting for '{self.name}'", "queue_timeout", self.name)
+                    self._cond.wait(remaining)
+                self._active += 1
+            finally:
+                self._waiters.remove(ticket)
+                self._publish()
+                # The next waiter may now be at the head of the line
+                self._cond.notify_all()
+        metrics.observe("admission_wait_seconds", time.monotonic() - start, backend=self.name)
+
+    def has_capacity(self, reserve=0):
+        """True when a slot is free with at least reserve more left over and nobody is queued"""
+        with self._cond:
+            return not self._waiters and self._active + reserve < self.concurrency
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._publish()
+            self._cond.notify_all()
+
+    def _publish(self):
+        metrics.set_gauge("admission_in_flight", self._active, backend=self.name)
+        metrics.set_gauge("admission_queue_depth", len(self._waiters), backend=self.name)
+
+
+class AdmissionController:
+    def __init__(self, turn_rate=0.5, turn_burst=5, limits=None, max_queue=32, queue_timeout=10.0, max_users=10000):
+        """Initialize per-user turn buckets and per-backend concurrency caps"""
+        self.turn_rate = turn_rate
+        self.turn_burst = turn_burst
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._buckets = {}
+        limits = limits or {'llm': 8, 'vision': 4, 'tts': 8, 'db': 10, 'embedding': 4}
+        self.limiters = {
+            name: FairLimiter(name, concurrency, max_queue, queue_timeout)
+            for name, concurrency in limits.items()
+        }
+
+    @classmethod
+    def from_env(cls):
+        """Build a controller from ADMISSION_* environment variables"""
+        limits = {}
+        for name, default in (('llm', 8), ('vision', 4), ('tts', 8), ('db', 10), ('embedding', 4)):
+            limits[name] = int(os.getenv(f"ADMISSION_{name.upper()}_CONCURRENCY", str(default)))
+        return cls(
+            turn_rate=float(os.getenv("ADMISSION_USER_TURN_RATE", "0.5")),
+            turn_burst=int(os.getenv("ADMISSION_USER_TURN_BURST", "5")),
+            limits=limits,
+            max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "32")),
+            queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+        )
+
+    def admit_turn(self, user_session_id):
+        """Charge one turn to the user's token bucket, raising BusyError when it is empty"""
+        with self._lock:
+            bucket = self._buckets.pop(user_session_id, None)
+            if bucket is None:
+                bucket = TokenBucket(self.turn_rate, self.turn_burst)
+            # Re-insert so the dict stays in least-recently-used order for eviction
+            self._buckets[user_session_id] = bucket
+            if len(self._buckets) > self.max_users:
+                self._buckets.pop(next(iter(self._buckets)))
+            allowed = bucket.try_consume()
+
+        if not allowed:
+            metrics.inc("admission_rejected_total", reason="user_rate", backend="turn")
+            logging.info(f"Rate limited turn for session {user_session_id}")
+            raise BusyError("Too many messages in a short time", "user_rate")
+        metrics.inc("admission_admitted_total", backend="turn")
+
+    def has_capacity(self, backend, reserve=0):
+        """Whether background work may use backend without making foreground requests wait"""
+        limiter = self.limiters.get(backend)
+        return limiter is None or limiter.has_capacity(reserve)
+
+    @contextmanager
+    def slot(self, backend, timeout=None):
+        """Hold one concurrency slot for a backend; unknown backends are not limited"""
+        limiter = self.limiters.get(backend)
+        if limiter is None:
+            yield
+            return
+        limiter.acquire(timeout)
+        try:
+            yield
+        finally:
+            limiter.release()
+
+
+# Process-wide controller shared by every session
+admission_controller = AdmissionController.from_env()
+
+
+def limited(backend):
+    """Decorator that runs a function while holding a slot for backend"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with admission_controller.slot(backend):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
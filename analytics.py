@@ -0,0 +1,320 @@
+"""Incrementally maintained usage, latency and satisfaction rollups.
+
+Every saved conversation and rating adds to hourly and daily buckets per
+input type in the analytics_rollups table: conversation and audio counts, a
+fixed latency histogram with its sum, and the rating distribution. Increments
+are accumulated in memory and written every ANALYTICS_FLUSH_INTERVAL seconds
+as one batch of additive upserts, so a busy hour's row is not locked by every
+save. Dashboards read a bounded range of buckets by primary key, which costs
+the same however many conversations are stored.
+
+    python analytics.py rebuild --since 2025-07-01   # recompute buckets from raw rows
+    python analytics.py report --period day --days 14
+"""
+import sys
+import time
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import MetaData, Table, Column, String, DateTime, Integer, Float, select, delete
+from sqlalchemy.dialects import postgresql, sqlite
+
+ROLLUP_TABLE = "analytics_rollups"
+PERIODS = ('hour', 'day')
+# Histogram columns and their upper bounds in seconds; the last bucket is unbounded
+LATENCY_BUCKETS = (
+    ('latency_le_500ms', 0.5), ('latency_le_1s', 1.0), ('latency_le_2s', 2.0), ('latency_le_5s', 5.0),
+    ('latency_le_10s', 10.0), ('latency_le_30s', 30.0), ('latency_over_30s', None)
+)
+RATINGS = range(1, 6)
+COUNTERS = (
+    'conversations', 'audio_responses', 'latency_count', 'latency_sum',
+    *(name for name, _ in LATENCY_BUCKETS), 'ratings', 'rating_sum', *(f'rating_{r}' for r in RATINGS)
+)
+
+metadata = MetaData()
+rollups = Table(
+    ROLLUP_TABLE, metadata,
+    Column('period', String(8), primary_key=True),
+    Column('bucket_start', DateTime, primary_key=True),
+    Column('input_type', String(50), primary_key=True),
+    *(Column(name, Float if name == 'latency_sum' else Integer, nullable=False, default=0) for name in COUNTERS)
+)
+
+
+def bucket_start(when, period):
+    """Start of the hour or day containing when"""
+    if period == 'hour':
+        return when.replace(minute=0, second=0, microsecond=0)
+    return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def latency_bucket(seconds):
+    for name, bound in LATENCY_BUCKETS:
+        if bound is None or seconds <= bound:
+            return name
+
+
+def conversation_counts(has_audio_response, response_time):
+    """Counter increments contributed by one conversation"""
+    counts = {'conversations': 1}
+    if has_audio_response:
+        counts['audio_responses'] = 1
+    if response_time is not None:
+        counts['latency_count'] = 1
+        counts['latency_sum'] = float(response_time)
+        counts[latency_bucket(response_time)] = 1
+    return counts
+
+
+def rating_counts(rating):
+    """Counter increments contributed by one rating"""
+    return {'ratings': 1, 'rating_sum': rating, f'rating_{rating}': 1}
+
+
+def histogram_quantile(histogram, count, quantile):
+    """Upper bound of the latency bucket holding the quantile (the last finite bound when it overflows)"""
+    if not count:
+        return None
+    target = quantile * count
+    seen = 0
+    for name, bound in LATENCY_BUCKETS:
+        seen += histogram.get(name, 0)
+        if seen >= target:
+            return bound if bound is not None else LATENCY_BUCKETS[-2][1]
+    return LATENCY_BUCKETS[-2][1]
+
+
+def describe(bucket):
+    """Dashboard view of summed counters: averages, audio share, latency percentiles and rating spread"""
+    latency_count = bucket['latency_count']
+    histogram = {name: bucket[name] for name, _ in LATENCY_BUCKETS}
+    return {
+        'conversations': bucket['conversations'],
+        'audio_responses': bucket['audio_responses'],
+        'audio_ratio': bucket['audio_responses'] / bucket['conversations'] if bucket['conversations'] else 0.0,
+        'latency': {
+            'count': latency_count,
+            'avg': bucket['latency_sum'] / latency_count if latency_count else None,
+            'p50': histogram_quantile(histogram, latency_count, 0.5),
+            'p95': histogram_quantile(histogram, latency_count, 0.95),
+            'histogram': histogram
+        },
+        'ratings': {
+            'count': bucket['ratings'],
+            'avg': bucket['rating_sum'] / bucket['ratings'] if bucket['ratings'] else None,
+            'distribution': {r: bucket[f'rating_{r}'] for r in RATINGS}
+        }
+    }
+
+
+def _add(target, counts):
+    for name, value in counts.items():
+        target[name] = target.get(name, 0) + value
+
+
+class AnalyticsRollups:
+    def __init__(self, engine, flush_interval=10.0):
+        """Hourly and daily rollups for engine's database, written in coalesced batches"""
+        self.engine = engine
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._thread = None
+        self._stop = threading.Event()
+
+    def create(self):
+        metadata.create_all(bind=self.engine)
+
+    def _record(self, when, input_type, counts):
+        when = when or datetime.utcnow()
+        with self._lock:
+            for period in PERIODS:
+                _add(self._pending.setdefault((period, bucket_start(when, period), input_type), {}), counts)
+            if self._thread is None and self.flush_interval > 0:
+                self._thread = threading.Thread(target=self._run, name="analytics-flush", daemon=True)
+                self._thread.start()
+
+    def record_conversation(self, created_at, input_type, has_audio_response=False, response_time=None):
+        self._record(created_at, input_type, conversation_counts(has_audio_response, response_time))
+
+    def record_feedback(self, created_at, input_type, rating):
+        """Count a 1-5 rating in the buckets of the time it was given"""
+        if rating in RATINGS:
+            self._record(created_at, input_type or 'unknown', rating_counts(rating))
+
+    def upsert_statement(self):
+        """INSERT ... ON CONFLICT DO UPDATE that adds the inserted counters to an existing bucket"""
+        dialects = {'postgresql': postgresql, 'sqlite': sqlite}
+        if self.engine.dialect.name not in dialects:
+            raise ValueError(f"Rollups are not supported for database dialect '{self.engine.dialect.name}'")
+        stmt = dialects[self.engine.dialect.name].insert(rollups)
+        return stmt.on_conflict_do_update(
+            index_elements=[rollups.c.period, rollups.c.bucket_start, rollups.c.input_type],
+            set_={name: rollups.c[name] + stmt.excluded[name] for name in COUNTERS}
+        )
+
+    def flush(self):
+        """Write all buffered increments in one transaction; returns the number of buckets touched"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        rows = [
+            {'period': period, 'bucket_start': start, 'input_type': input_type,
+             **{name: counts.get(name, 0) for name in COUNTERS}}
+            for (period, start, input_type), counts in pending.items()
+        ]
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(self.upsert_statement(), rows)
+            return len(rows)
+        except Exception as e:
+            logging.error(f"Error flushing analytics rollups: {e}")
+            # Keep the increments for the next flush
+            with self._lock:
+                for key, counts in pending.items():
+                    _add(self._pending.setdefault(key, {}), counts)
+            return 0
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def query(self, period='hour', since=None, until=None, input_type=None):
+        """Buckets in [since, until) oldest first, per input type or summed over all of them"""
+        if period not in PERIODS:
+            raise ValueError(f"Unknown rollup period '{period}'")
+        until = until or datetime.utcnow()
+        since = since or until - (timedelta(hours=24) if period == 'hour' else timedelta(days=30))
+        statement = (
+            select(rollups)
+            .where(rollups.c.period == period)
+            .where(rollups.c.bucket_start >= bucket_start(since, period))
+            .where(rollups.c.bucket_start < until)
+            .order_by(rollups.c.bucket_start)
+        )
+        if input_type:
+            statement = statement.where(rollups.c.input_type == input_type)
+        with self.engine.connect() as conn:
+            rows = conn.execute(statement).mappings().all()
+
+        buckets = {}
+        totals = {name: 0 for name in COUNTERS}
+        for row in rows:
+            _add(buckets.setdefault(row['bucket_start'], {name: 0 for name in COUNTERS}), {name: row[name] for name in COUNTERS})
+            _add(totals, {name: row[name] for name in COUNTERS})
+        return {
+            'period': period,
+            'since': bucket_start(since, period),
+            'until': until,
+            'input_type': input_type,
+            'buckets': [{'bucket_start': start, **describe(counts)} for start, counts in buckets.items()],
+            'totals': describe(totals)
+        }
+
+    def rebuild(self, since, until=None, batch_size=2000):
+        """Recompute the days covering [since, until) from conversations and user_feedback
+
+        Rows saved by a running app within its last flush interval can be counted twice,
+        so repair ranges that have no live traffic.
+        """
+        from database import Conversation, UserFeedback
+
+        # Whole days, so no hourly or daily bucket is rebuilt from part of its rows
+        since = bucket_start(since, 'day')
+        until = until or datetime.utcnow()
+        if until != bucket_start(until, 'day'):
+            until = bucket_start(until, 'day') + timedelta(days=1)
+        computed = {}
+
+        def add(when, input_type, counts):
+            for period in PERIODS:
+                _add(computed.setdefault((period, bucket_start(when, period), input_type), {}), counts)
+
+        # Keyset scan by (created_at, id) so memory stays bounded on large tables
+        with self.engine.connect() as conn:
+            for rows in self._scan(conn, select(
+                Conversation.id, Conversation.created_at, Conversation.input_type,
+                Conversation.has_audio_response, Conversation.response_time
+            ), Conversation, since, until, batch_size):
+                for row in rows:
+                    add(row.created_at, row.input_type, conversation_counts(row.has_audio_response, row.response_time))
+            for rows in self._scan(conn, select(
+                UserFeedback.id, UserFeedback.created_at, UserFeedback.rating, Conversation.input_type
+            ).outerjoin(Conversation, Conversation.id == UserFeedback.conversation_id), UserFeedback, since, until, batch_size):
+                for row in rows:
+                    if row.rating in RATINGS:
+                        add(row.created_at, row.input_type or 'unknown', rating_counts(row.rating))
+
+        rows = [
+            {'period': period, 'bucket_start': start, 'input_type': input_type,
+             **{name: counts.get(name, 0) for name in COUNTERS}}
+            for (period, start, input_type), counts in computed.items()
+        ]
+        with self.engine.begin() as conn:
+            conn.execute(delete(rollups).where(rollups.c.bucket_start >= since).where(rollups.c.bucket_start < until))
+            if rows:
+                conn.execute(rollups.insert(), rows)
+        logging.info(f"Rebuilt {len(rows)} rollup buckets from {since} to {until}")
+        return len(rows)
+
+    @staticmethod
+    def _scan(conn, statement, model, since, until, batch_size):
+        last = None
+        while True:
+            query = statement.where(model.created_at >= since, model.created_at < until)
+            if last is not None:
+                query = query.where(
+                    (model.created_at > last[0]) | ((model.created_at == last[0]) & (model.id > last[1]))
+                )
+            rows = conn.execute(query.order_by(model.created_at, model.id).limit(batch_size)).all()
+            if not rows:
+                return
+            last = (rows[-1].created_at, rows[-1].id)
+            yield rows
+
+
+def print_report(report):
+    print(f"{report['period']} buckets from {report['since']} to {report['until']:%Y-%m-%d %H:%M}")
+    for bucket in report['buckets'] + [dict(report['totals'], bucket_start='total')]:
+        latency = bucket['latency']
+        ratings = bucket['ratings']
+        start = bucket['bucket_start'] if isinstance(bucket['bucket_start'], str) else f"{bucket['bucket_start']:%Y-%m-%d %H:%M}"
+        avg_latency = f"{latency['avg']:.2f}s" if latency['avg'] is not None else "-"
+        avg_rating = f"{ratings['avg']:.2f}" if ratings['avg'] is not None else "-"
+        print(f"{start:>16}  {bucket['conversations']:6d} turns  {100 * bucket['audio_ratio']:5.1f}% audio  "
+              f"avg {avg_latency:>7}  p95 <= {latency['p95'] or '-'}s  rating {avg_rating} ({ratings['count']})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Conversation analytics rollups")
+    parser.add_argument('command', choices=['rebuild', 'report'])
+    parser.add_argument('--since', type=datetime.fromisoformat, help="Start (UTC ISO date); default 30 days ago")
+    parser.add_argument('--until', type=datetime.fromisoformat, help="End (UTC ISO date); default now")
+    parser.add_argument('--period', choices=PERIODS, default='day')
+    parser.add_argument('--days', type=int, default=30, help="Report window when --since is not given")
+    parser.add_argument('--input-type', default=None)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    from database import db_manager
+    analytics = db_manager.analytics
+    analytics.create()
+    until = args.until or datetime.utcnow()
+    since = args.since or until - timedelta(days=args.days)
+    if args.command == 'rebuild':
+        started = time.perf_counter()
+        count = analytics.rebuild(since, until)
+        print(f"Rebuilt {count} buckets in {time.perf_counter() - started:.1f}s")
+    else:
+        print_report(analytics.query(args.period, since, until, args.input_type))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,464 @@
+"""Headless HTTP API for the therapy assistant.
+
+Serves TherapyService as JSON (and NDJSON streaming) endpoints so turns can
+be handled by several worker processes behind one address, independent of
+Streamlit reruns:
+
+    python api.py --workers 4
+    API_TOKEN=... uvicorn api:app --host 0.0.0.0 --port 8000 --workers 4
+
+Every worker builds its own service at startup; state shared between workers
+lives in the database. When API_TOKEN is set every endpoint except /healthz
+requires `Authorization: Bearer <token>`; without it the API should only be
+reachable from localhost, which is where main() binds by default. Requires
+`pip install starlette uvicorn python-multipart`.
+"""
+import os
+import json
+import re
+import uuid
+import asyncio
+import hmac
+import hashlib
+import logging
+import argparse
+from datetime import datetime
+from collections.abc import Mapping
+from contextlib import asynccontextmanager
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse, PlainTextResponse
+from starlette.routing import Route
+from admission import BusyError
+from metrics import metrics
+from audio_encoding import audio_mime
+from service import TherapyService, UploadedMedia, TranscriptionError, ImageAnalysisError
+from image_handler import MAX_IMAGES_PER_TURN
+
+MAX_UPLOAD_BYTES = int(os.getenv("API_MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+MAX_TEXT_CHARS = int(os.getenv("API_MAX_TEXT_CHARS", "5000"))
+RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+API_TOKEN = os.getenv("API_TOKEN") or None
+# Load balancer probes carry no credentials
+PUBLIC_ROUTES = {"healthz"}
+
+
+class ApiError(Exception):
+    def __init__(self, status_code, message):
+        """A request that should be answered with status_code and an error message"""
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def jsonable(value):
+    """Convert entries (datetimes, UUIDs, read-only catalog mappings) to JSON types"""
+    if isinstance(value, Mapping):
+        return {key: jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [jsonable(item) for item in value]
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
+def entry_json(entry, session_id):
+    """Public form of a conversation entry: audio as a URL to fetch as binary, internal keys dropped"""
+    public = {key: value for key, value in entry.items() if key not in ('audio_data', 'audio_id')}
+    public['audio_url'] = f"/sessions/{session_id}/audio/{entry['audio_id']}" if entry.get('audio_id') else None
+    return jsonable(public)
+
+
+def service(request):
+    return request.app.state.service
+
+
+def session_id_param(request):
+    session_id = request.path_params['session_id']
+    if not session_id or len(session_id) > 255:
+        raise ApiError(400, "Invalid session id")
+    return session_id
+
+
+def flag(value, default=True):
+    if value is None:
+        return default
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+
+async def json_body(request):
+    try:
+        body = await request.json()
+    except Exception:
+        raise ApiError(400, "Request body must be JSON")
+    if not isinstance(body, dict):
+        raise ApiError(400, "Request body must be a JSON object")
+    return body
+
+
+def required_text(body, name, max_chars=MAX_TEXT_CHARS):
+    value = body.get(name)
+    if not isinstance(value, str) or not value.strip():
+        raise ApiError(400, f"'{name}' is required")
+    if len(value) > max_chars:
+        raise ApiError(413, f"'{name}' is longer than {max_chars} characters")
+    return value
+
+
+async def upload(form, name, field=None):
+    field = field if field is not None else form.get(name)
+    if field is None or not hasattr(field, 'read'):
+        raise ApiError(400, f"'{name}' file is required")
+    data = await field.read()
+    if not data:
+        raise ApiError(400, f"'{name}' file is empty")
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise ApiError(413, f"'{name}' is larger than {MAX_UPLOAD_BYTES} bytes")
+    return UploadedMedia(data, name=field.filename or name, type=field.content_type or "application/octet-stream")
+
+
+def error_response(error):
+    """Map service and request errors to HTTP responses"""
+    if isinstance(error, ApiError):
+        return JSONResponse({'error': str(error)}, status_code=error.status_code)
+    if isinstance(error, BusyError):
+        return JSONResponse({'error': str(error), 'reason': error.reason}, status_code=429, headers={'Retry-After': '5'})
+    if isinstance(error, (TranscriptionError, ImageAnalysisError)):
+        return JSONResponse({'error': str(error)}, status_code=422)
+    logging.error(f"API request failed: {error}")
+    return JSONResponse({'error': "Internal error"}, status_code=500)
+
+
+def authorized(request):
+    """True when no API_TOKEN is configured or the request carries it as a bearer token"""
+    if API_TOKEN is None:
+        return True
+    scheme, _, token = request.headers.get('authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(token.encode(), API_TOKEN.encode())
+
+
+def endpoint(handler):
+    """Wrap a handler so errors become JSON responses and requests are counted"""
+    async def wrapper(request):
+        route = handler.__name__
+        try:
+            if route not in PUBLIC_ROUTES and not authorized(request):
+                raise ApiError(401, "Missing or invalid API token")
+            response = await handler(request)
+        except Exception as e:
+            response = error_response(e)
+        metrics.inc("api_requests_total", route=route, status=str(response.status_code))
+        return response
+    wrapper.__name__ = handler.__name__
+    return wrapper
+
+
+async def run_turn(request, call, session_id, *args, enable_audio=True):
+    """Run a turn as one JSON response, or as NDJSON events when ?stream=1"""
+    # Audio is not inlined: the spoken reply is fetched as binary from entry['audio_url']
+    if not flag(request.query_params.get('stream'), default=False):
+        entry, warnings = await run_in_threadpool(call, session_id, *args, enable_audio_output=enable_audio)
+        return JSONResponse({'entry': entry_json(entry, session_id), 'warnings': warnings})
+
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def emit(event):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    def on_progress(stage, data):
+        emit({'event': stage, **jsonable(data)})
+
+    def work():
+        try:
+            entry, warnings = call(session_id, *args, enable_audio_output=enable_audio, on_progress=on_progress)
+            emit({'event': 'turn', 'entry': entry_json(entry, session_id), 'warnings': warnings})
+        except Exception as e:
+            response = error_response(e)
+            emit({'event': 'error', 'status': response.status_code, **json.loads(response.body)})
+        finally:
+            emit(None)
+
+    async def stream():
+        pending = run_in_threadpool(work)
+        task = asyncio.ensure_future(pending)
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                yield json.dumps(event) + "\n"
+        finally:
+            await task
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@endpoint
+async def healthz(request):
+    return PlainTextResponse("ok\n")
+
+
+@endpoint
+async def status(request):
+    return JSONResponse(service(request).status())
+
+
+@endpoint
+async def metrics_endpoint(request):
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@endpoint
+async def create_session(request):
+    body = await json_body(request) if await request.body() else {}
+    session_id = body.get('session_id')
+    if session_id is not None and (not isinstance(session_id, str) or not session_id or len(session_id) > 255):
+        raise ApiError(400, "Invalid session id")
+    session = await run_in_threadpool(service(request).start_session, session_id)
+    return JSONResponse({'session_id': session['session_id'], 'history': [entry_json(entry, session['session_id']) for entry in session['history']]})
+
+
+@endpoint
+async def history(request):
+    session_id = session_id_param(request)
+    try:
+        limit = min(max(int(request.query_params.get('limit', 50)), 1), 500)
+    except ValueError:
+        raise ApiError(400, "'limit' must be an integer")
+    entries = await run_in_threadpool(service(request).history, session_id, limit)
+    return JSONResponse({'history': [entry_json(entry, session_id) for entry in entries]})
+
+
+@endpoint
+async def clear_history(request):
+    session_id = session_id_param(request)
+    await run_in_threadpool(service(request).clear, session_id)
+    return Response(status_code=204)
+
+
+@endpoint
+async def stats(request):
+    session_id = session_id_param(request)
+    return JSONResponse({'stats': jsonable(await run_in_threadpool(service(request).stats, session_id))})
+
+
+@endpoint
+async def search(request):
+    session_id = session_id_param(request)
+    query = request.query_params.get('q', '')
+    try:
+        page = max(int(request.query_params.get('page', 1)), 1)
+        page_size = min(max(int(request.query_params.get('page_size', 10)), 1), 50)
+    except ValueError:
+        raise ApiError(400, "'page' and 'page_size' must be integers")
+    found = await run_in_threadpool(service(request).search, session_id, query, page, page_size)
+    return JSONResponse(jsonable(found))
+
+
+@endpoint
+async def usage(request):
+    session_id = session_id_param(request)
+    try:
+        days = min(max(int(request.query_params.get('days', 7)), 1), 90)
+    except ValueError:
+        raise ApiError(400, "'days' must be an integer")
+    return JSONResponse(jsonable(await run_in_threadpool(service(request).usage, session_id, days)))
+
+
+@endpoint
+async def analytics(request):
+    params = request.query_params
+    period = params.get('period', 'hour')
+    if period not in ('hour', 'day'):
+        raise ApiError(400, "'period' must be 'hour' or 'day'")
+    try:
+        since = datetime.fromisoformat(params['since']) if params.get('since') else None
+        until = datetime.fromisoformat(params['until']) if params.get('until') else None
+    except ValueError:
+        raise ApiError(400, "'since' and 'until' must be ISO timestamps")
+    report = await run_in_threadpool(service(request).analytics, period, since, until, params.get('input_type'))
+    if report is None:
+        raise ApiError(503, "Analytics need a database")
+    return JSONResponse(jsonable(report))
+
+
+@endpoint
+async def feedback(request):
+    session_id = session_id_param(request)
+    try:
+        conversation_id = uuid.UUID(request.path_params['conversation_id'])
+    except ValueError:
+        raise ApiError(400, "Invalid conversation id")
+    body = await json_body(request)
+    rating = body.get('rating')
+    feedback_text = body.get('feedback_text')
+    if rating is not None and (not isinstance(rating, int) or isinstance(rating, bool) or not 1 <= rating <= 5):
+        raise ApiError(400, "'rating' must be an integer from 1 to 5")
+    if feedback_text is not None and not isinstance(feedback_text, str):
+        raise ApiError(400, "'feedback_text' must be a string")
+    if rating is None and not feedback_text:
+        raise ApiError(400, "'rating' or 'feedback_text' is required")
+    saved = await run_in_threadpool(service(request).feedback, session_id, conversation_id, rating, feedback_text)
+    if not saved:
+        raise ApiError(503, "Feedback could not be saved")
+    return JSONResponse({'saved': True}, status_code=201)
+
+
+@endpoint
+async def text_turn(request):
+    session_id = session_id_param(request)
+    body = await json_body(request)
+    text = required_text(body, 'text')
+    return await run_turn(request, service(request).text_turn, session_id, text, enable_audio=flag(body.get('enable_audio')))
+
+
+@endpoint
+async def audio_turn(request):
+    session_id = session_id_param(request)
+    async with request.form(max_part_size=MAX_UPLOAD_BYTES) as form:
+        audio = await upload(form, 'audio')
+        enable_audio = flag(form.get('enable_audio'))
+    return await run_turn(request, service(request).audio_turn, session_id, audio, enable_audio=enable_audio)
+
+
+@endpoint
+async def image_turn(request):
+    session_id = session_id_param(request)
+    async with request.form(max_part_size=MAX_UPLOAD_BYTES) as form:
+        # Several 'image' parts are analyzed together in one vision request
+        fields = form.getlist('image')
+        if len(fields) > MAX_IMAGES_PER_TURN:
+            raise ApiError(413, f"At most {MAX_IMAGES_PER_TURN} images per turn")
+        images = [await upload(form, 'image', field) for field in fields] or [await upload(form, 'image')]
+        image_context = required_text(form, 'context')
+        enable_audio = flag(form.get('enable_audio'))
+    if not all(image.type.startswith('image/') for image in images):
+        raise ApiError(415, "'image' must be an image")
+    return await run_turn(request, service(request).image_turn, session_id, images, image_context, enable_audio=enable_audio)
+
+
+def audio_response(request, data):
+    """Binary audio with ETag and single-range support, so players can seek and resume"""
+    if not data:
+        raise ApiError(503, "Audio generation temporarily unavailable")
+    etag = '"' + hashlib.sha1(data).hexdigest()[:20] + '"'
+    headers = {'Accept-Ranges': 'bytes', 'ETag': etag, 'Cache-Control': 'private, max-age=3600'}
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    media_type = audio_mime(data)
+    size = len(data)
+    match = RANGE.match(request.headers.get('range', '').strip())
+    if not match or match.group(1) == match.group(2) == '':
+        return Response(data, media_type=media_type, headers=headers)
+    if match.group(1):
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start = max(size - int(match.group(2)), 0)
+        end = size - 1
+    if start >= size or start > end:
+        return Response(status_code=416, headers={**headers, 'Content-Range': f"bytes */{size}"})
+    headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+    return Response(data[start:end + 1], status_code=206, media_type=media_type, headers=headers)
+
+
+async def audio_params(request):
+    # GET (query string) lets <audio> elements fetch directly; POST takes a JSON body
+    if request.method == "GET":
+        return dict(request.query_params)
+    return await json_body(request)
+
+
+@endpoint
+async def reply_audio(request):
+    session_id = session_id_param(request)
+    speech_id = request.path_params['audio_id']
+    data = await run_in_threadpool(service(request).speech_audio, session_id, speech_id)
+    if data is None:
+        raise ApiError(404, "Unknown audio")
+    return audio_response(request, data)
+
+
+@endpoint
+async def song_audio(request):
+    body = await audio_params(request)
+    song = required_text(body, 'song', max_chars=500)
+    emotion_type = body.get('emotion_type')
+    return audio_response(request, await run_in_threadpool(service(request).song_audio, song, emotion_type))
+
+
+@endpoint
+async def remedy_audio(request):
+    body = await audio_params(request)
+    remedy = required_text(body, 'remedy', max_chars=2000)
+    return audio_response(request, await run_in_threadpool(service(request).remedy_audio, remedy))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Each worker process builds its own handlers and database pool
+    if getattr(app.state, 'service', None) is None:
+        app.state.service = await run_in_threadpool(TherapyService.from_env)
+    yield
+
+
+def create_app(therapy_service=None):
+    """Build the ASGI app; therapy_service defaults to one built from the environment at startup"""
+    app = Starlette(
+        routes=[
+            Route("/healthz", healthz),
+            Route("/status", status),
+            Route("/metrics", metrics_endpoint),
+            Route("/analytics", analytics),
+            Route("/sessions", create_session, methods=["POST"]),
+            Route("/sessions/{session_id}/history", history),
+            Route("/sessions/{session_id}/history", clear_history, methods=["DELETE"]),
+            Route("/sessions/{session_id}/stats", stats),
+            Route("/sessions/{session_id}/search", search),
+            Route("/sessions/{session_id}/usage", usage),
+            Route("/sessions/{session_id}/conversations/{conversation_id}/feedback", feedback, methods=["POST"]),
+            Route("/sessions/{session_id}/turns", text_turn, methods=["POST"]),
+            Route("/sessions/{session_id}/turns/audio", audio_turn, methods=["POST"]),
+            Route("/sessions/{session_id}/turns/image", image_turn, methods=["POST"]),
+            Route("/sessions/{session_id}/audio/{audio_id}", reply_audio),
+            Route("/audio/song", song_audio, methods=["GET", "POST"]),
+            Route("/audio/remedy", remedy_audio, methods=["GET", "POST"]),
+        ],
+        lifespan=lifespan
+    )
+    app.state.service = therapy_service
+    return app
+
+
+app = create_app()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the therapy assistant HTTP API")
+    # Loopback unless configured otherwise: exposing the API also needs API_TOKEN
+    parser.add_argument("--host", default=os.getenv("API_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("API_PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("API_WORKERS", "1")))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.host not in ("127.0.0.1", "localhost", "::1") and API_TOKEN is None:
+        parser.error(f"refusing to serve on {args.host} without API_TOKEN; set it or bind to 127.0.0.1")
+
+    if args.workers > 1:
+        # The memory store is per process: other workers would keep serving history cleared on one
+        store = os.getenv("SESSION_STORE", "").lower()
+        if store == "memory":
+            parser.error("SESSION_STORE=memory cannot be shared by several workers; use sqlite or redis")
+        if not store:
+            os.environ["SESSION_STORE"] = "sqlite"
+            logging.warning("Using SESSION_STORE=sqlite so that all workers share session state")
+
+    import uvicorn
+    uvicorn.run("api:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Client for the headless API (api.py) with the same methods as TherapyService.
+
+The Streamlit app uses it when THERAPY_API_URL is set, so the UI process only
+renders pages while turns run in the API workers. Requires `pip install httpx`.
+"""
+import os
+import logging
+from datetime import datetime
+import httpx
+from admission import BusyError
+from service import TranscriptionError, ImageAnalysisError
+
+
+def _decode_entry(entry):
+    """Turn an API entry into the dict shape the app renders; audio is fetched on demand"""
+    entry = dict(entry)
+    entry['audio_data'] = None
+    return entry
+
+
+def _decode_result(result):
+    """A search result with created_at parsed back from the API's ISO string"""
+    result = dict(result)
+    if isinstance(result.get('created_at'), str):
+        result['created_at'] = datetime.fromisoformat(result['created_at'])
+    return result
+
+
+class ApiClient:
+    def __init__(self, base_url, timeout=None):
+        """Synchronous HTTP client for one API deployment"""
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout if timeout is not None else float(os.getenv("THERAPY_API_TIMEOUT", "90"))
+        token = os.getenv("API_TOKEN")
+        headers = {'Authorization': f"Bearer {token}"} if token else None
+        self.http = httpx.Client(base_url=self.base_url, timeout=self.timeout, headers=headers)
+
+    def _request(self, method, path, **kwargs):
+        response = self.http.request(method, path, **kwargs)
+        if response.status_code == 429:
+            body = response.json()
+            raise BusyError(body.get('error'), body.get('reason'))
+        if response.status_code == 422:
+            message = response.json().get('error')
+            raise ImageAnalysisError(message) if path.endswith('/image') else TranscriptionError(message)
+        response.raise_for_status()
+        return response
+
+    def status(self):
+        try:
+            return self._request("GET", "/status").json()
+        except Exception as e:
+            logging.error(f"Error reaching therapy API: {e}")
+            return {'database': False, 'search': False, 'memory': False, 'prefetch': False, 'sessions': None}
+
+    def start_session(self, session_id=None):
+        body = self._request("POST", "/sessions", json={'session_id': session_id} if session_id else {}).json()
+        return {'session_id': body['session_id'], 'history': [_decode_entry(entry) for entry in body['history']]}
+
+    def history(self, session_id, limit=50):
+        try:
+            body = self._request("GET", f"/sessions/{session_id}/history", params={'limit': limit}).json()
+            return [_decode_entry(entry) for entry in body['history']]
+        except Exception as e:
+            logging.error(f"Error getting history from therapy API: {e}")
+            return []
+
+    def stats(self, session_id):
+        try:
+            return self._request("GET", f"/sessions/{session_id}/stats").json()['stats']
+        except Exception as e:
+            logging.error(f"Error getting stats from therapy API: {e}")
+            return None
+
+    def clear(self, session_id):
+        self._request("DELETE", f"/sessions/{session_id}/history")
+
+    def search(self, session_id, query, page=1, page_size=10):
+        try:
+            body = self._request("GET", f"/sessions/{session_id}/search", params={'q': query, 'page': page, 'page_size': page_size}).json()
+            body['results'] = [_decode_result(result) for result in body['results']]
+            return body
+        except Exception as e:
+            logging.error(f"Error searching through therapy API: {e}")
+            return {'results': [], 'page': page, 'has_more': False}
+
+    def usage(self, session_id, days=7):
+        try:
+            return self._request("GET", f"/sessions/{session_id}/usage", params={'days': days}).json()
+        except Exception as e:
+            logging.error(f"Error getting usage from therapy API: {e}")
+            return {'days': [], 'budget': 'ok'}
+
+    def analytics(self, period='hour', since=None, until=None, input_type=None):
+        params = {'period': period}
+        for name, value in (('since', since), ('until', until), ('input_type', input_type)):
+            if value is not None:
+                params[name] = value.isoformat() if hasattr(value, 'isoformat') else value
+        try:
+            return self._request("GET", "/analytics", params=params).json()
+        except Exception as e:
+            logging.error(f"Error getting analytics from therapy API: {e}")
+            return None
+
+    def feedback(self, session_id, conversation_id, rating=None, feedback_text=None):
+        try:
+            self._request("POST", f"/sessions/{session_id}/conversations/{conversation_id}/feedback", json={'rating': rating, 'feedback_text': feedback_text})
+            return True
+        except Exception as e:
+            logging.error(f"Error saving feedback through therapy API: {e}")
+            return False
+
+    def _turn(self, path, **kwargs):
+        body = self._request("POST", path, **kwargs).json()
+        return _decode_entry(body['entry']), body['warnings']
+
+    def text_turn(self, session_id, text, enable_audio_output=True, history=None, on_progress=None):
+        # The API keeps its own history; history and on_progress are accepted for interface parity
+        return self._turn(f"/sessions/{session_id}/turns", json={'text': text, 'enable_audio': enable_audio_output})
+
+    def audio_turn(self, session_id, audio, enable_audio_output=True, history=None, on_progress=None):
+        files = {'audio': (getattr(audio, 'name', None) or 'recording.wav', audio.getvalue(), getattr(audio, 'type', None) or 'audio/wav')}
+        return self._turn(f"/sessions/{session_id}/turns/audio", files=files, data={'enable_audio': str(enable_audio_output).lower()})
+
+    def image_turn(self, session_id, image, image_context, enable_audio_output=True, history=None, on_progress=None):
+        images = image if isinstance(image, (list, tuple)) else [image]
+        files = [('image', (getattr(item, 'name', None) or 'image', item.getvalue(), item.type)) for item in images]
+        data = {'context': image_context, 'enable_audio': str(enable_audio_output).lower()}
+        return self._turn(f"/sessions/{session_id}/turns/image", files=files, data=data)
+
+    def reply_audio(self, entry, timeout=0.0):
+        """Download the entry's spoken reply as binary; skipped for older entries (timeout 0)"""
+        if entry.get('audio_data') is None and timeout and entry.get('audio_url'):
+            try:
+                entry['audio_data'] = self._request("GET", entry['audio_url'], timeout=max(timeout, self.timeout)).content
+            except Exception as e:
+                logging.error(f"Error getting reply audio from therapy API: {e}")
+        return entry.get('audio_data')
+
+    def _audio(self, path, body):
+        try:
+            return self._request("POST", path, json=body).content
+        except Exception as e:
+            logging.error(f"Error getting audio from therapy API: {e}")
+            return None
+
+    def song_audio(self, song, emotion_type=None):
+        return self._audio("/audio/song", {'song': song, 'emotion_type': emotion_type})
+
+    def remedy_audio(self, remedy):
+        return self._audio("/audio/remedy", {'remedy': remedy})
@@ -1,12 +1,14 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import os
 import time
 import uuid
-from therapy_bot import TherapyBot
-from audio_handler import AudioHandler
-from image_handler import ImageHandler
-from database import db_manager, init_database
-from audio_generator import AudioGenerator
+from service import TherapyService, TranscriptionError, ImageAnalysisError
+from metrics import start_metrics_server
+from admission import BusyError, BUSY_MESSAGE
+from audio_encoding import audio_mime
+from image_handler import MAX_IMAGES_PER_TURN
+from profiler import profiled
 import base64
 from io import BytesIO
 import logging
@@ -19,41 +21,70 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Initialize database
+# Turns run in the headless API when THERAPY_API_URL is set, otherwise in this process
 @st.cache_resource
-def initialize_database():
-    """Initialize database connection and tables"""
+def get_backend():
+    """The API client or an in-process TherapyService, shared by every session"""
+    api_url = os.getenv("THERAPY_API_URL")
+    if api_url:
+        from api_client import ApiClient
+        return ApiClient(api_url)
+    return TherapyService.from_env()
+
+# Start the Prometheus-style metrics endpoint once per process when configured
+@st.cache_resource
+def start_metrics_endpoint():
+    """Serve /metrics on METRICS_PORT if it is set"""
+    port = os.getenv("METRICS_PORT")
+    if not port:
+        return None
     try:
-        init_database()
-        return True
+        return start_metrics_server(int(port))
     except Exception as e:
-        st.error(f"Database initialization failed: {e}")
-        return False
+        logging.error(f"Failed to start metrics endpoint: {e}")
+        return None
+
+start_metrics_endpoint()
+
+backend = get_backend()
+
+# The session id is the only key to a session's history, so it lives in a first-party cookie, never the URL
+SESSION_COOKIE = "therapy_session"
+
+def cookie_session_id():
+    """Session id from this browser's cookie, or None when absent or malformed"""
+    try:
+        return str(uuid.UUID(st.context.cookies.get(SESSION_COOKIE, '')))
+    except ValueError:
+        return None
+
+def remember_session_cookie(session_id):
+    """Store the session id in a SameSite=Strict cookie so a reload or another replica resumes it"""
+    max_age = int(float(os.getenv("SESSION_TTL", "86400")))
+    components.html(
+        f"<script>window.parent.document.cookie = '{SESSION_COOKIE}={session_id}; path=/; max-age={max_age}; SameSite=Strict'"
+        f" + (window.parent.location.protocol === 'https:' ? '; Secure' : '');</script>",
+        height=0
+    )
 
 # Initialize session state
-if 'therapy_bot' not in st.session_state:
-    st.session_state.therapy_bot = TherapyBot()
-if 'audio_handler' not in st.session_state:
-    st.session_state.audio_handler = AudioHandler()
-if 'image_handler' not in st.session_state:
-    st.session_state.image_handler = ImageHandler()
 if 'user_session_id' not in st.session_state:
-    st.session_state.user_session_id = str(uuid.uuid4())
+    st.session_state.user_session_id = cookie_session_id() or str(uuid.uuid4())
+    if 'session' in st.query_params:
+        # Links from older versions carried the id; it is neither trusted nor kept in the address bar
+        del st.query_params['session']
+    remember_session_cookie(st.session_state.user_session_id)
 if 'conversation_history' not in st.session_state:
     st.session_state.conversation_history = []
 if 'current_audio_response' not in st.session_state:
     st.session_state.current_audio_response = None
-if 'db_initialized' not in st.session_state:
-    st.session_state.db_initialized = initialize_database()
-if 'current_user' not in st.session_state:
-    if st.session_state.db_initialized:
-        try:
-            st.session_state.current_user = db_manager.get_or_create_user(st.session_state.user_session_id)
-            # Load conversation history from database
-            st.session_state.conversation_history = db_manager.get_user_conversations(st.session_state.user_session_id)
-        except Exception as e:
-            logging.error(f"Error loading user data: {e}")
-            st.session_state.current_user = None
+if 'backend_status' not in st.session_state:
+    st.session_state.backend_status = backend.status()
+    try:
+        # Register the session and load its history from the session store (or the database)
+        st.session_state.conversation_history = backend.start_session(st.session_state.user_session_id)['history']
+    except Exception as e:
+        logging.error(f"Error loading user data: {e}")
 
 def main():
     st.title("🧠 AI Therapy Assistant")
@@ -64,19 +95,19 @@ def main():
         st.header("Session Options")
         
         # User stats
-        if st.session_state.db_initialized and st.session_state.current_user:
-            user_stats = db_manager.get_user_stats(st.session_state.user_session_id)
+        if st.session_state.backend_status['database']:
+            user_stats = backend.stats(st.session_state.user_session_id)
             if user_stats:
                 st.info(f"💬 Total conversations: {user_stats['total_conversations']}")
         
         # Clear conversation button
         if st.button("Clear Conversation", type="secondary"):
-            if st.session_state.db_initialized:
-                try:
-                    db_manager.clear_user_conversations(st.session_state.user_session_id)
+            try:
+                backend.clear(st.session_state.user_session_id)
+                if st.session_state.backend_status['database']:
                     st.success("Conversation history cleared from database")
-                except Exception as e:
-                    st.error(f"Error clearing database: {e}")
+            except Exception as e:
+                st.error(f"Error clearing database: {e}")
             st.session_state.conversation_history = []
             st.session_state.current_audio_response = None
             st.rerun()
@@ -114,11 +145,38 @@ def main():
         
         # Database status
         st.subheader("Database Status")
-        if st.session_state.db_initialized:
+        if st.session_state.backend_status['database']:
             st.success("✅ Database connected")
         else:
             st.error("❌ Database not available")
         
+        # Search past conversations
+        if st.session_state.backend_status['search']:
+            st.subheader("Search Conversations")
+            search_query = st.text_input("Search your past conversations", key="search_query", placeholder="e.g. sleep, work stress")
+            if search_query != st.session_state.get('last_search_query'):
+                st.session_state.last_search_query = search_query
+                st.session_state.search_page = 1
+            if search_query.strip():
+                page = st.session_state.get('search_page', 1)
+                found = backend.search(st.session_state.user_session_id, search_query, page=page)
+                if found['results']:
+                    for result in found['results']:
+                        with st.expander(f"{result['created_at']:%Y-%m-%d %H:%M} · {result['input_type'].title()}"):
+                            st.markdown(f"**You:** {result['user_snippet']}")
+                            st.markdown(f"**Assistant:** {result['assistant_snippet']}")
+                else:
+                    st.write("No matching conversations.")
+                prev_col, next_col = st.columns(2)
+                with prev_col:
+                    if page > 1 and st.button("← Previous", key="search_prev"):
+                        st.session_state.search_page = page - 1
+                        st.rerun()
+                with next_col:
+                    if found['has_more'] and st.button("Next →", key="search_next"):
+                        st.session_state.search_page = page + 1
+                        st.rerun()
+
         # Conversation history
         st.subheader("Recent Conversations")
         if st.session_state.conversation_history:
@@ -178,11 +236,9 @@ def main():
                                         # Add audio button for each song
                                         if st.button(f"🔊 Play {song.split(' by')[0]}", key=f"play_{entry.get('id', 'unknown')}_{song[:20]}"):
                                             try:
-                                                from audio_generator import AudioGenerator
-                                                audio_gen = AudioGenerator()
-                                                audio_data = audio_gen.create_song_audio(song, entry.get('emotional_context', 'general'))
+                                                audio_data = backend.song_audio(song, entry.get('emotional_context', 'general'))
                                                 if audio_data:
-                                                    st.audio(audio_data, format='audio/mp3')
+                                                    st.audio(audio_data, format=audio_mime(audio_data))
                                             except Exception as e:
                                                 st.warning("Audio generation temporarily unavailable")
                         
@@ -194,11 +250,9 @@ def main():
                                         # Add audio guidance for remedy
                                         if st.button(f"🎧 Guide me", key=f"remedy_{entry.get('id', 'unknown')}_{remedy[:20]}"):
                                             try:
-                                                from audio_generator import AudioGenerator
-                                                audio_gen = AudioGenerator()
-                                                audio_data = audio_gen.create_remedy_audio(remedy)
+                                                audio_data = backend.remedy_audio(remedy)
                                                 if audio_data:
-                                                    st.audio(audio_data, format='audio/mp3')
+                                                    st.audio(audio_data, format=audio_mime(audio_data))
                                             except Exception as e:
                                                 st.warning("Audio guidance temporarily unavailable")
                         
@@ -213,8 +267,12 @@ def main():
                         st.info(f"✨ {entry['motivational_quote']}")
                     
                     # Audio playback if available
+                    if not entry.get('audio_data') and entry.get('has_audio_response') and enable_audio_output:
+                        # Restored entries have no audio bytes; only the newest one is worth rendering again
+                        is_latest = i == len(st.session_state.conversation_history) - 1
+                        backend.reply_audio(entry, timeout=15.0 if is_latest else 0.0)
                     if entry.get('audio_data') and enable_audio_output:
-                        st.audio(entry['audio_data'], format='audio/mp3')
+                        st.audio(entry['audio_data'], format=audio_mime(entry['audio_data']))
                     
                     # Show if this had audio response
                     if entry.get('has_audio_response'):
@@ -235,7 +293,7 @@ def main():
         # Submit text button
         if st.button("Send Message", type="primary", disabled=not user_input.strip()):
             if user_input.strip():
-                process_user_input(user_input, "text", enable_audio_output)
+                process_user_input(backend.text_turn, user_input, enable_audio_output=enable_audio_output)
     
     with col2:
         st.subheader("🎤 Audio Input")
@@ -249,134 +307,66 @@ def main():
             
             if st.button("Process Audio", type="secondary"):
                 with st.spinner("Processing audio..."):
-                    try:
-                        # Convert audio to text
-                        audio_text = st.session_state.audio_handler.speech_to_text(audio_bytes)
-                        if audio_text:
-                            st.success(f"Transcribed: {audio_text}")
-                            process_user_input(audio_text, "audio", enable_audio_output)
-                        else:
-                            st.error("Could not transcribe audio. Please try again.")
-                    except Exception as e:
-                        st.error(f"Audio processing error: {str(e)}")
+                    # Transcription and the reply run as one turn
+                    process_user_input(backend.audio_turn, audio_bytes, enable_audio_output=enable_audio_output)
         
         st.divider()
         
         st.subheader("🖼️ Image Input")
         
         # Image upload section
-        uploaded_image = st.file_uploader(
-            "Upload an image to discuss:",
+        uploaded_images = st.file_uploader(
+            "Upload images to discuss:",
             type=['png', 'jpg', 'jpeg'],
-            help="Share an image that relates to your feelings or situation"
+            accept_multiple_files=True,
+            help=f"Share up to {MAX_IMAGES_PER_TURN} images that relate to your feelings or situation"
         )
+        uploaded_images = uploaded_images[:MAX_IMAGES_PER_TURN]
         
-        if uploaded_image:
-            st.image(uploaded_image, caption="Uploaded Image", use_column_width=True)
+        if uploaded_images:
+            st.image(uploaded_images, caption=[image.name for image in uploaded_images], use_column_width=True)
             
             # Image description input
             image_context = st.text_input(
-                "Describe what you'd like to discuss about this image:",
+                "Describe what you'd like to discuss about these images:" if len(uploaded_images) > 1 else "Describe what you'd like to discuss about this image:",
                 placeholder="What does this image mean to you?"
             )
             
             if st.button("Analyze Image", type="secondary", disabled=not image_context.strip()):
                 if image_context.strip():
                     with st.spinner("Analyzing image..."):
-                        try:
-                            # Process image with context
-                            image_analysis = st.session_state.image_handler.analyze_image_with_context(
-                                uploaded_image, image_context
-                            )
-                            if image_analysis:
-                                combined_input = f"[Image Context: {image_context}]\n[Image Analysis: {image_analysis}]"
-                                process_user_input(combined_input, "image", enable_audio_output)
-                            else:
-                                st.error("Could not analyze image. Please try again.")
-                        except Exception as e:
-                            st.error(f"Image processing error: {str(e)}")
+                        # Process image with context
+                        process_user_input(backend.image_turn, uploaded_images, image_context, enable_audio_output=enable_audio_output)
 
-def process_user_input(user_input, input_type, enable_audio_output):
-    """Process user input and generate response"""
+@profiled("process_user_input")
+def process_user_input(turn, *args, enable_audio_output=True):
+    """Run one turn through the backend and add it to the history"""
     try:
-        start_time = time.time()
-        
         with st.spinner("Generating response..."):
-            # Get AI response
-            response = st.session_state.therapy_bot.get_response(
-                user_input, 
-                st.session_state.conversation_history
+            conversation_entry, warnings = turn(
+                st.session_state.user_session_id,
+                *args,
+                enable_audio_output=enable_audio_output
             )
-            
-            response_time = time.time() - start_time
-            
-            # Generate audio if enabled
-            audio_data = None
-            has_audio_response = False
-            if enable_audio_output:
-                try:
-                    audio_data = st.session_state.audio_handler.text_to_speech(response)
-                    has_audio_response = audio_data is not None
-                except Exception as e:
-                    st.warning(f"Audio generation failed: {str(e)}")
-            
-            # Analyze emotional context and generate supportive content
-            emotional_context = None
-            coping_strategies = None
-            soothing_content = None
-            motivational_quote = None
-            try:
-                emotional_context = st.session_state.therapy_bot.analyze_emotional_context(user_input)
-                if emotional_context:
-                    # Extract key emotional state for personalized content
-                    emotional_state = emotional_context.split('\n')[0] if emotional_context else user_input
-                    coping_strategies = st.session_state.therapy_bot.generate_coping_strategies(emotional_state)
-                    soothing_content = st.session_state.therapy_bot.get_soothing_content(emotional_state)
-                    motivational_quote = st.session_state.therapy_bot.get_motivational_quote(emotional_state)
-            except Exception as e:
-                logging.warning(f"Emotional analysis failed: {e}")
-            
-            # Save to database if available
-            conversation_id = None
-            if st.session_state.db_initialized and st.session_state.current_user:
-                try:
-                    conversation_record = db_manager.save_conversation(
-                        user_id=st.session_state.current_user.id,
-                        session_id=st.session_state.user_session_id,
-                        user_input=user_input,
-                        ai_response=response,
-                        input_type=input_type,
-                        has_audio_response=has_audio_response,
-                        emotional_context=emotional_context,
-                        response_time=response_time
-                    )
-                    conversation_id = conversation_record.id
-                except Exception as e:
-                    logging.error(f"Failed to save conversation to database: {e}")
-                    st.warning("Conversation not saved to database")
-            
-            # Add to session conversation history
-            conversation_entry = {
-                'id': str(conversation_id) if conversation_id else None,
-                'user': user_input,
-                'assistant': response,
-                'input_type': input_type,
-                'audio_data': audio_data,
-                'has_audio_response': has_audio_response,
-                'emotional_context': emotional_context,
-                'coping_strategies': coping_strategies,
-                'soothing_content': soothing_content,
-                'motivational_quote': motivational_quote,
-                'created_at': time.strftime('%Y-%m-%d %H:%M:%S')
-            }
-            st.session_state.conversation_history.append(conversation_entry)
-            
-            # Refresh the page to show new conversation
-            st.rerun()
-            
+    except BusyError:
+        st.warning(BUSY_MESSAGE)
+        return
+    except (TranscriptionError, ImageAnalysisError) as e:
+        st.error(str(e))
+        return
     except Exception as e:
         st.error(f"Error processing input: {str(e)}")
         logging.error(f"Error in process_user_input: {e}")
+        return
+
+    for warning in warnings:
+        st.warning(warning)
+
+    # Add to session conversation history
+    st.session_state.conversation_history.append(conversation_entry)
+
+    # Refresh the page to show new conversation
+    st.rerun()
 
 if __name__ == "__main__":
     # Check for required API key
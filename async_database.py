@@ -0,0 +1,252 @@
+import os
+import uuid
+import logging
+from datetime import datetime
+from sqlalchemy import select, update, delete
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from database import Base, User, Conversation, UserFeedback, DATABASE_URL, upsert_user_statement, add_token_usage_statement, db_manager
+from search import ConversationSearch
+from tracing import traced
+
+# Async drivers used in place of the synchronous ones in DATABASE_URL
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def to_async_url(database_url):
+    """Rewrite a sync database URL (psycopg2/pysqlite) to its asyncio driver"""
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for database backend '{backend}'")
+    url = url.set(drivername=ASYNC_DRIVERS[backend])
+    if backend == 'postgresql' and 'sslmode' in url.query:
+        # asyncpg takes ssl=<mode> instead of libpq's sslmode=<mode>
+        query = dict(url.query)
+        query['ssl'] = query.pop('sslmode')
+        url = url.set(query=query)
+    return url
+
+
+def _conversation_to_dict(conv):
+    return {
+        'id': str(conv.id),
+        'user': conv.user_input,
+        'assistant': conv.ai_response,
+        'input_type': conv.input_type,
+        'has_audio_response': conv.has_audio_response,
+        'created_at': conv.created_at,
+        'emotional_context': conv.emotional_context,
+        'response_time': conv.response_time,
+        'stage_timings': conv.stage_timings,
+        'token_usage': conv.token_usage
+    }
+
+
+class AsyncDatabaseManager:
+    def __init__(self, database_url=None, pool_size=None, max_overflow=None):
+        """Initialize an asyncio engine and session factory over the same schema as DatabaseManager"""
+        url = to_async_url(database_url or DATABASE_URL)
+        engine_options = {'pool_pre_ping': True}
+        if url.get_backend_name() != 'sqlite':
+            engine_options['pool_size'] = pool_size or int(os.getenv("ASYNC_DB_POOL_SIZE", "10"))
+            engine_options['max_overflow'] = max_overflow if max_overflow is not None else int(os.getenv("ASYNC_DB_MAX_OVERFLOW", "20"))
+        self.engine = create_async_engine(url, **engine_options)
+        self.SessionLocal = async_sessionmaker(self.engine, expire_on_commit=False, autoflush=False)
+        # The search table is created by DatabaseManager; this manager only writes to it when present
+        self.search = ConversationSearch(self.engine.sync_engine, os.getenv("SEARCH_LANGUAGE", "english"))
+        # Rollup increments and last_active bumps are buffered in memory and flushed by the synchronous manager's threads
+        self.analytics = db_manager.analytics
+        self.last_active = db_manager.last_active
+        self.stats_cache = db_manager.stats_cache
+
+    async def create_tables(self):
+        """Create all database tables"""
+        try:
+            async with self.engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.run_sync(self.search.table_exists)
+            logging.info("Database tables created successfully")
+        except Exception as e:
+            logging.error(f"Error creating database tables: {e}")
+            raise
+
+    def get_session(self):
+        """Get async database session"""
+        return self.SessionLocal()
+
+    async def dispose(self):
+        """Close all pooled connections"""
+        await self.engine.dispose()
+
+    @traced("db.get_or_create_user")
+    async def get_or_create_user(self, session_id):
+        """Get existing user or create new one"""
+        async with self.get_session() as db:
+            try:
+                result = await db.scalars(
+                    upsert_user_statement(self.engine.dialect.name, session_id),
+                    execution_options={'populate_existing': True}
+                )
+                user = result.one()
+                await db.commit()
+                return user
+            except Exception as e:
+                await db.rollback()
+                logging.error(f"Error getting/creating user: {e}")
+                raise
+
+    @traced("db.save_conversation")
+    async def save_conversation(self, user_id, session_id, user_input, ai_response, input_type, has_audio_response=False, emotional_context=None, response_time=None, stage_timings=None, token_usage=None):
+        """Save conversation to database"""
+        async with self.get_session() as db:
+            try:
+                conversation = Conversation(
+                    id=uuid.uuid4(),
+                    created_at=datetime.utcnow(),
+                    user_id=user_id,
+                    session_id=session_id,
+                    user_input=user_input,
+                    ai_response=ai_response,
+                    input_type=input_type,
+                    has_audio_response=has_audio_response,
+                    emotional_context=emotional_context,
+                    response_time=response_time,
+                    stage_timings=stage_timings,
+                    token_usage=token_usage
+                )
+                db.add(conversation)
+                if token_usage and token_usage.get('models'):
+                    await db.execute(add_token_usage_statement(self.engine.dialect.name, user_id, conversation.created_at.date(), token_usage['models']))
+                if self.search.enabled:
+                    await db.execute(self.search.index_statement(conversation.id, session_id, conversation.created_at, user_input, ai_response))
+
+                # Update user's total conversation count without loading the row; last_active is batched separately
+                await db.execute(
+                    update(User)
+                    .where(User.id == user_id)
+                    .values(total_conversations=User.total_conversations + 1)
+                )
+
+                await db.commit()
+                await db.refresh(conversation)
+                self.last_active.touch(user_id)
+                self.stats_cache.invalidate(session_id)
+                self.analytics.record_conversation(conversation.created_at, input_type, has_audio_response, response_time)
+                logging.info(f"Saved conversation for user {user_id}")
+                return conversation
+            except Exception as e:
+                await db.rollback()
+                logging.error(f"Error saving conversation: {e}")
+                raise
+
+    @traced("db.get_user_conversations")
+    async def get_user_conversations(self, session_id, limit=50):
+        """Get user's conversation history"""
+        try:
+            async with self.get_session() as db:
+                result = await db.execute(
+                    select(Conversation)
+                    .where(Conversation.session_id == session_id)
+                    .order_by(Conversation.created_at.desc())
+                    .limit(limit)
+                )
+                conversations = result.scalars().all()
+            # Return in chronological order
+            return [_conversation_to_dict(conv) for conv in reversed(conversations)]
+        except Exception as e:
+            logging.error(f"Error getting user conversations: {e}")
+            return []
+
+    @traced("db.save_user_feedback")
+    async def save_user_feedback(self, conversation_id, user_id, rating=None, feedback_text=None):
+        """Save user feedback for a conversation"""
+        async with self.get_session() as db:
+            try:
+                feedback = UserFeedback(
+                    conversation_id=conversation_id,
+                    user_id=user_id,
+                    rating=rating,
+                    feedback_text=feedback_text
+                )
+                db.add(feedback)
+                input_type = None
+                if rating is not None:
+                    input_type = (await db.execute(select(Conversation.input_type).where(Conversation.id == conversation_id))).scalar()
+                await db.commit()
+                if rating is not None:
+                    self.analytics.record_feedback(datetime.utcnow(), input_type, rating)
+                logging.info(f"Saved feedback for conversation {conversation_id}")
+                return feedback
+            except Exception as e:
+                await db.rollback()
+                logging.error(f"Error saving feedback: {e}")
+                raise
+
+    @traced("db.get_user_stats")
+    async def get_user_stats(self, session_id):
+        """Get user statistics"""
+        try:
+            stats = self.stats_cache.get(session_id)
+            if stats is None:
+                async with self.get_session() as db:
+                    result = await db.execute(select(User).where(User.session_id == session_id))
+                    user = result.scalars().first()
+                    if not user:
+                        return None
+                    stats = {
+                        'user_id': user.id,
+                        'total_conversations': user.total_conversations or 0,
+                        'user_since': user.created_at,
+                        'last_active': user.last_active
+                    }
+                self.stats_cache.set(session_id, stats)
+
+            pending_last_active = self.last_active.pending_for(stats.pop('user_id'))
+            if pending_last_active and (stats['last_active'] is None or pending_last_active > stats['last_active']):
+                stats['last_active'] = pending_last_active
+            return stats
+        except Exception as e:
+            logging.error(f"Error getting user stats: {e}")
+            return None
+
+    @traced("db.clear_user_conversations")
+    async def clear_user_conversations(self, session_id, batch_size=1000):
+        """Clear all conversations for a user"""
+        deleted = 0
+        try:
+            # Delete in short transactions so a long history never holds one huge lock
+            while True:
+                async with self.get_session() as db:
+                    chunk = (
+                        select(Conversation.id)
+                        .where(Conversation.session_id == session_id)
+                        .limit(batch_size)
+                        .scalar_subquery()
+                    )
+                    result = await db.execute(
+                        delete(Conversation)
+                        .where(Conversation.id.in_(chunk))
+                        .execution_options(synchronize_session=False)
+                    )
+                    await db.commit()
+                deleted += result.rowcount
+                if result.rowcount < batch_size:
+                    break
+
+            # Reset user's conversation count and drop their search documents
+            async with self.get_session() as db:
+                await db.execute(update(User).where(User.session_id == session_id).values(total_conversations=0))
+                if self.search.enabled:
+                    await db.execute(self.search.delete_session_statement(session_id))
+                await db.commit()
+            self.stats_cache.invalidate(session_id)
+            logging.info(f"Cleared {deleted} conversations for session {session_id}")
+        except Exception as e:
+            logging.error(f"Error clearing conversations: {e}")
+            # Rows deleted before the failure are fixed up by reconcile_conversation_counts
+            self.stats_cache.invalidate(session_id)
+            raise
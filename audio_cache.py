@@ -0,0 +1,92 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from metrics import metrics
+from singleflight import SingleFlight, normalize_key
+
+
+class AudioCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=3600.0, clock=time.monotonic):
+        """LRU cache of rendered audio bytes, bounded by total size and entry age"""
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Concurrent renders of one key (a click racing its prefetch) share a single gTTS call
+        self._flight = SingleFlight("audio_render")
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self.clock() - entry[1] > self.ttl:
+                if entry is not None:
+                    self._remove(key)
+                metrics.inc("audio_cache_total", result="miss")
+                return None
+            self._entries.move_to_end(key)
+            metrics.inc("audio_cache_total", result="hit")
+            return entry[0]
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and self.clock() - entry[1] <= self.ttl
+
+    def put(self, key, data):
+        if not data or len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (data, self.clock())
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                metrics.inc("audio_cache_evictions_total")
+            metrics.set_gauge("audio_cache_bytes", self._bytes)
+
+    def _remove(self, key):
+        data, _ = self._entries.pop(key)
+        self._bytes -= len(data)
+
+    def get_or_render(self, key, render, *args, **kwargs):
+        """Return cached audio for key, rendering (once across concurrent callers) on a miss"""
+        data = self.get(key)
+        if data is not None:
+            return data
+        return self._flight.do(key, self._render, key, render, args, kwargs)
+
+    def _render(self, key, render, args, kwargs):
+        data = render(*args, **kwargs)
+        self.put(key, data)
+        return data
+
+
+def song_key(song_name, emotion_type):
+    return normalize_key("song", song_name, emotion_type)
+
+
+def remedy_key(remedy_text):
+    return normalize_key("remedy", remedy_text)
+
+
+def speech_key(text, language='en', slow=False):
+    # Spoken replies are exact text, so only whitespace at the ends is ignored
+    return "\x1f".join(("speech", language, str(bool(slow)), text.strip()))
+
+
+def audio_id(key):
+    """Short stable id for a cache key, safe to put in URLs"""
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+
+# Process-wide cache shared by every session
+audio_cache = AudioCache(
+    max_bytes=int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    ttl=float(os.getenv("AUDIO_CACHE_TTL", "3600"))
+)
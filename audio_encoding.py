@@ -0,0 +1,106 @@
+"""Speech-optimized re-encoding of rendered audio.
+
+gTTS returns 24 kHz MP3. For a speaking voice, mono low-bitrate Opus (in an
+Ogg container) or a lower-bitrate MP3 is just as intelligible and two to three
+times smaller. Transcoding runs ffmpeg in a bounded worker pool, so a burst of
+replies cannot start an unbounded number of encoder processes. When ffmpeg is
+missing or a clip fails to encode, the original MP3 is returned unchanged and
+playback keeps working.
+"""
+import os
+import time
+import shutil
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
+
+# ffmpeg output options per format: (codec arguments, container)
+FORMATS = {
+    'opus': (['-c:a', 'libopus', '-application', 'voip', '-vbr', 'on'], 'ogg'),
+    'mp3': (['-c:a', 'libmp3lame'], 'mp3'),
+}
+
+
+def audio_mime(data):
+    """MIME type of encoded audio bytes, from their leading magic bytes"""
+    if not data:
+        return 'application/octet-stream'
+    if data[:4] == b'OggS':
+        return 'audio/ogg'
+    if data[:3] == b'ID3' or (data[0] == 0xFF and data[1] & 0xE0 == 0xE0):
+        return 'audio/mpeg'
+    if data[:4] == b'RIFF':
+        return 'audio/wav'
+    return 'application/octet-stream'
+
+
+class AudioEncoder:
+    def __init__(self, format='opus', bitrate='12k', sample_rate=16000, workers=2, ffmpeg=None, timeout=30.0):
+        """Transcode rendered MP3 to format at bitrate (mono, sample_rate Hz); format 'source' keeps it"""
+        self.format = format
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.workers = workers
+        self.ffmpeg = ffmpeg or shutil.which('ffmpeg')
+        self.timeout = timeout
+        self._pool = None
+        self._lock = threading.Lock()
+        if format != 'source' and format not in FORMATS:
+            raise ValueError(f"Unknown audio output format '{format}'")
+        if format != 'source' and not self.ffmpeg:
+            logging.warning("ffmpeg not found; audio is served as rendered MP3")
+
+    @classmethod
+    def from_env(cls):
+        """Encoder configured by AUDIO_OUTPUT_* environment variables"""
+        return cls(
+            format=os.getenv("AUDIO_OUTPUT_FORMAT", "opus").lower(),
+            bitrate=os.getenv("AUDIO_OUTPUT_BITRATE", "12k"),
+            sample_rate=int(os.getenv("AUDIO_OUTPUT_SAMPLE_RATE", "16000")),
+            workers=int(os.getenv("AUDIO_ENCODE_WORKERS", str(min(4, os.cpu_count() or 1)))),
+            ffmpeg=os.getenv("FFMPEG_PATH") or None
+        )
+
+    @property
+    def enabled(self):
+        return self.format != 'source' and bool(self.ffmpeg)
+
+    def command(self):
+        codec, container = FORMATS[self.format]
+        return [
+            self.ffmpeg, '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0', '-vn',
+            '-ac', '1', '-ar', str(self.sample_rate), *codec, '-b:a', self.bitrate,
+            '-f', container, 'pipe:1'
+        ]
+
+    def encode(self, data):
+        """Speech-optimized bytes for data, or data itself when encoding is off or fails"""
+        if not data or not self.enabled:
+            return data
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="audio-encode")
+        start = time.perf_counter()
+        try:
+            encoded = self._pool.submit(self._transcode, data).result()
+        except Exception as e:
+            logging.warning(f"Audio encoding to {self.format} failed, serving MP3: {e}")
+            metrics.inc("audio_encode_total", outcome="failed")
+            return data
+        metrics.observe("audio_encode_seconds", time.perf_counter() - start)
+        metrics.inc("audio_encode_total", outcome="ok")
+        metrics.inc("audio_encode_bytes_total", len(data), stage="source")
+        metrics.inc("audio_encode_bytes_total", len(encoded), stage="encoded")
+        return encoded
+
+    def _transcode(self, data):
+        result = subprocess.run(self.command(), input=data, capture_output=True, timeout=self.timeout)
+        if result.returncode != 0 or not result.stdout:
+            raise RuntimeError(result.stderr.decode('utf-8', 'replace').strip() or f"ffmpeg exited with {result.returncode}")
+        return result.stdout
+
+
+# Process-wide encoder shared by every renderer
+audio_encoder = AudioEncoder.from_env()
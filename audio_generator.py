@@ -2,6 +2,10 @@ import os
 import logging
 from gtts import gTTS
 import io
+from admission import admission_controller
+from tracing import traced
+from audio_cache import audio_cache, song_key, remedy_key
+from audio_encoding import audio_encoder
 
 class AudioGenerator:
     def __init__(self):
@@ -10,46 +14,66 @@ class AudioGenerator:
         if not os.path.exists(self.temp_dir):
             os.makedirs(self.temp_dir)
     
+    @traced("song_audio")
     def create_song_audio(self, song_name, emotion_type):
         """Create audio file for recommended song"""
         try:
-            # Create a simple audio message about the song
-            text = f"Here's a recommended song for {emotion_type}: {song_name}. This music can help soothe your emotions and provide comfort."
-            
-            # Generate audio
-            tts = gTTS(text=text, lang='en', slow=False)
-            
-            # Save to bytes
-            audio_bytes = io.BytesIO()
-            tts.write_to_fp(audio_bytes)
-            audio_bytes.seek(0)
-            
-            return audio_bytes.getvalue()
+            # Cached and shared across sessions so prefetches and repeat clicks render a song once
+            return audio_cache.get_or_render(
+                song_key(song_name, emotion_type),
+                self._render_song_audio,
+                song_name,
+                emotion_type
+            )
             
         except Exception as e:
             logging.error(f"Error creating song audio: {e}")
             return None
     
+    def _render_song_audio(self, song_name, emotion_type):
+        """Render the spoken song recommendation with gTTS"""
+        # Create a simple audio message about the song
+        text = f"Here's a recommended song for {emotion_type}: {song_name}. This music can help soothe your emotions and provide comfort."
+        
+        # Generate audio
+        tts = gTTS(text=text, lang='en', slow=False)
+        
+        # Save to bytes
+        audio_bytes = io.BytesIO()
+        with admission_controller.slot("tts"):
+            tts.write_to_fp(audio_bytes)
+        audio_bytes.seek(0)
+        
+        # Re-encoded for speech (smaller Opus/MP3) before it is cached
+        return audio_encoder.encode(audio_bytes.getvalue())
+    
+    @traced("remedy_audio")
     def create_remedy_audio(self, remedy_text):
         """Create audio guidance for a remedy"""
         try:
-            # Create guided audio for the remedy
-            guidance_text = f"Here's a helpful remedy: {remedy_text}. Take your time and be gentle with yourself."
-            
-            # Generate audio
-            tts = gTTS(text=guidance_text, lang='en', slow=True)
-            
-            # Save to bytes
-            audio_bytes = io.BytesIO()
-            tts.write_to_fp(audio_bytes)
-            audio_bytes.seek(0)
-            
-            return audio_bytes.getvalue()
+            return audio_cache.get_or_render(remedy_key(remedy_text), self._render_remedy_audio, remedy_text)
             
         except Exception as e:
             logging.error(f"Error creating remedy audio: {e}")
             return None
     
+    def _render_remedy_audio(self, remedy_text):
+        """Render the guided remedy with gTTS"""
+        # Create guided audio for the remedy
+        guidance_text = f"Here's a helpful remedy: {remedy_text}. Take your time and be gentle with yourself."
+        
+        # Generate audio
+        tts = gTTS(text=guidance_text, lang='en', slow=True)
+        
+        # Save to bytes
+        audio_bytes = io.BytesIO()
+        with admission_controller.slot("tts"):
+            tts.write_to_fp(audio_bytes)
+        audio_bytes.seek(0)
+        
+        # Re-encoded for speech (smaller Opus/MP3) before it is cached
+        return audio_encoder.encode(audio_bytes.getvalue())
+    
     def cleanup_temp_files(self):
         """Clean up temporary audio files"""
         try:
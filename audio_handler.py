@@ -4,8 +4,18 @@ import io
 import tempfile
 import os
 from gtts import gTTS
-import base64
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from admission import admission_controller
+from tracing import traced
+from profiler import profiled
+from metrics import metrics
+from audio_cache import audio_cache, speech_key
+from audio_encoding import audio_encoder, audio_mime
+from media_worker import media_worker
+
+# Shared by every session so parallel chunk recognition stays bounded per process
+_stt_pool = ThreadPoolExecutor(int(os.getenv("STT_WORKERS", "4")), thread_name_prefix="stt")
 
 class AudioHandler:
     def __init__(self):
@@ -20,8 +30,54 @@ class AudioHandler:
             # Handle case where microphone is not available
             pass
 
+    @profiled("stt")
+    @traced("stt")
     def speech_to_text(self, audio_data):
-        """Convert speech audio to text"""
+        """Convert speech audio to text, sending only the voiced parts, in parallel chunks"""
+        try:
+            # Decoding, voice detection and chunking run in a media worker process
+            clip, pcm_chunks = media_worker.run('prepare_speech', audio_data.getvalue())
+            if not clip['wav']:
+                # Not a WAV recording (AIFF/FLAC): recognize the file as a whole
+                return self._recognize_file(audio_data)
+
+            if not pcm_chunks:
+                logging.warning("No speech detected in audio")
+                metrics.inc("stt_total", outcome="silent")
+                return None
+            chunks = [sr.AudioData(pcm, clip['rate'], 2) for pcm in pcm_chunks]
+            metrics.observe("stt_speech_ratio", clip['speech_seconds'] / clip['duration'] if clip['duration'] else 0.0)
+
+            if len(chunks) == 1:
+                parts = [self._recognize(chunks[0])]
+            else:
+                parts = list(_stt_pool.map(self._recognize, chunks))
+            text = " ".join(part for part in parts if part)
+            if not text:
+                logging.warning("Could not understand audio")
+                metrics.inc("stt_total", outcome="unintelligible")
+                return None
+            metrics.inc("stt_total", outcome="ok")
+            return text
+
+        except sr.RequestError as e:
+            logging.error(f"Speech recognition request failed: {e}")
+            metrics.inc("stt_total", outcome="failed")
+            return None
+        except Exception as e:
+            logging.error(f"Error in speech to text conversion: {e}")
+            metrics.inc("stt_total", outcome="failed")
+            return None
+
+    def _recognize(self, audio):
+        """Recognize one chunk; an empty string when it holds no recognizable words"""
+        try:
+            return self.recognizer.recognize_google(audio)
+        except sr.UnknownValueError:
+            return ""
+
+    def _recognize_file(self, audio_data):
+        """Recognize a recording that is not WAV through speech_recognition's own reader"""
         try:
             # Save audio data to temporary file
             with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_audio:
@@ -52,23 +108,31 @@ class AudioHandler:
             logging.error(f"Error in speech to text conversion: {e}")
             return None
 
+    @profiled("tts")
+    @traced("tts")
     def text_to_speech(self, text, language='en', slow=False):
         """Convert text to speech audio"""
         try:
-            # Create gTTS object
-            tts = gTTS(text=text, lang=language, slow=slow)
-            
-            # Save to bytes buffer
-            audio_buffer = io.BytesIO()
-            tts.write_to_fp(audio_buffer)
-            audio_buffer.seek(0)
-            
-            return audio_buffer.getvalue()
+            return audio_cache.get_or_render(speech_key(text, language, slow), self._render_speech, text, language, slow)
             
         except Exception as e:
             logging.error(f"Error in text to speech conversion: {e}")
             return None
 
+    def _render_speech(self, text, language, slow):
+        """Render text with gTTS"""
+        # Create gTTS object
+        tts = gTTS(text=text, lang=language, slow=slow)
+        
+        # Save to bytes buffer
+        audio_buffer = io.BytesIO()
+        with admission_controller.slot("tts"):
+            tts.write_to_fp(audio_buffer)
+        audio_buffer.seek(0)
+        
+        # Re-encoded for speech (smaller Opus/MP3) before it is cached
+        return audio_encoder.encode(audio_buffer.getvalue())
+
     def process_audio_input(self, audio_bytes):
         """Process uploaded audio file"""
         try:
@@ -80,15 +144,14 @@ class AudioHandler:
             return None
 
     def create_audio_response(self, response_text):
-        """Create audio response from text"""
+        """Create audio response from text as (audio bytes, MIME type)"""
         try:
             # Generate speech from text
             audio_data = self.text_to_speech(response_text)
             
             if audio_data:
-                # Encode audio data for web playback
-                audio_base64 = base64.b64encode(audio_data).decode()
-                return audio_base64
+                # Raw bytes; base64 would add a third to every reply
+                return audio_data, audio_mime(audio_data)
             
             return None
             
@@ -96,6 +159,7 @@ class AudioHandler:
             logging.error(f"Error creating audio response: {e}")
             return None
 
+    @profiled("audio_validate")
     def validate_audio_input(self, audio_data):
         """Validate that audio input is processable"""
         try:
@@ -106,6 +170,10 @@ class AudioHandler:
             if len(audio_data.getvalue()) < 1000:  # Minimum size check
                 return False, "Audio file too short"
             
+            clip, pcm_chunks = media_worker.run('prepare_speech', audio_data.getvalue())
+            if clip['wav'] and not pcm_chunks:
+                return False, "No speech detected"
+            
             return True, "Audio is valid"
             
         except Exception as e:
@@ -114,8 +182,11 @@ class AudioHandler:
     def get_audio_duration(self, audio_data):
         """Get duration of audio file (approximate)"""
         try:
-            # This is a rough estimation based on file size
-            # For more accurate duration, you'd need additional libraries
+            clip, _ = media_worker.run('wav_duration', audio_data.getvalue())
+            if clip['duration'] is not None:
+                return max(1, int(round(clip['duration'])))
+            
+            # Not WAV: rough estimation based on file size
             file_size = len(audio_data.getvalue())
             # Rough estimation: 16kHz, 16-bit mono = ~32KB per second
             estimated_duration = file_size / 32000
@@ -0,0 +1,176 @@
+"""Offline backfill of missing emotional analysis.
+
+Conversations saved without an emotional_context (model outage, deferred
+analysis with DEFER_EMOTIONAL_ANALYSIS, or rows older than the feature) are
+scanned in primary-key order and analyzed several messages per model request,
+with a bounded number of requests in flight. Each batch is written back with
+one bulk UPDATE and the last scanned id is checkpointed to a small JSON file,
+so an interrupted run resumes where it stopped instead of starting over.
+
+    python backfill.py run --batch-size 200 --items-per-prompt 10 --concurrency 4
+    python backfill.py run --loop 300      # keep draining new rows every 5 minutes
+    python backfill.py status
+    python backfill.py reset
+"""
+import os
+import sys
+import json
+import uuid
+import time
+import logging
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
+
+BACKFILL_CHECKPOINT = os.getenv("BACKFILL_CHECKPOINT", "backfill_checkpoint.json")
+
+
+def load_checkpoint(path):
+    """Progress saved by an earlier run, or a fresh one"""
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {'last_id': None, 'scanned': 0, 'updated': 0, 'failed': 0, 'requests': 0, 'passes': 0}
+
+
+def save_checkpoint(path, checkpoint):
+    """Write the checkpoint atomically so a crash never leaves a torn file"""
+    checkpoint['saved_at'] = datetime.utcnow().isoformat()
+    temporary = f"{path}.tmp"
+    with open(temporary, 'w') as fh:
+        json.dump(checkpoint, fh)
+    os.replace(temporary, path)
+
+
+def analyze_batch(therapy_bot, pool, texts, items_per_prompt):
+    """Analyses for texts, several per model request and requests run on pool"""
+    groups = [texts[i:i + items_per_prompt] for i in range(0, len(texts), items_per_prompt)]
+    results = []
+    for analyses in pool.map(therapy_bot.analyze_emotional_contexts, groups):
+        results.extend(analyses)
+    return results, len(groups)
+
+
+def backfill(engine, therapy_bot, checkpoint_path=BACKFILL_CHECKPOINT, batch_size=200,
+             items_per_prompt=10, concurrency=4, limit=None, dry_run=False):
+    """Analyze conversations with no emotional_context, resuming from the checkpoint"""
+    from sqlalchemy import select, update, bindparam
+    from database import Conversation
+
+    table = Conversation.__table__
+    # The IS NULL guard keeps an analysis written meanwhile by a live turn from being overwritten
+    statement = update(table).where(
+        table.c.id == bindparam('row_id'), table.c.emotional_context.is_(None)
+    ).values(emotional_context=bindparam('analysis'))
+    checkpoint = load_checkpoint(checkpoint_path)
+    last_id = checkpoint['last_id']
+    scanned = 0
+
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="backfill") as pool:
+        while limit is None or scanned < limit:
+            query = (
+                select(table.c.id, table.c.user_input)
+                .where(table.c.emotional_context.is_(None))
+                .order_by(table.c.id)
+                .limit(batch_size if limit is None else min(batch_size, limit - scanned))
+            )
+            if last_id is not None:
+                query = query.where(table.c.id > uuid.UUID(last_id))
+            with engine.connect() as conn:
+                rows = conn.execute(query).all()
+            if not rows:
+                if checkpoint['last_id'] is not None and not dry_run:
+                    # Pass complete: the next one starts over for new rows and earlier failures
+                    checkpoint['last_id'] = None
+                    checkpoint['passes'] = checkpoint.get('passes', 0) + 1
+                    save_checkpoint(checkpoint_path, checkpoint)
+                break
+
+            started = time.perf_counter()
+            analyses, requests = analyze_batch(therapy_bot, pool, [row.user_input or "" for row in rows], items_per_prompt)
+            changes = [
+                {'row_id': row.id, 'analysis': analysis}
+                for row, analysis in zip(rows, analyses) if analysis
+            ]
+            if changes and not dry_run:
+                with engine.begin() as conn:
+                    conn.execute(statement, changes)
+
+            last_id = str(rows[-1].id)
+            scanned += len(rows)
+            failed = len(rows) - len(changes)
+            metrics.inc("backfill_rows_total", len(changes), outcome="updated")
+            metrics.inc("backfill_rows_total", failed, outcome="failed")
+            metrics.observe("backfill_batch_seconds", time.perf_counter() - started)
+            if dry_run:
+                logging.info(f"Backfill dry run: {len(changes)}/{len(rows)} analyzed in {requests} requests")
+                continue
+
+            # Rows whose analysis failed are passed over until the next pass
+            checkpoint['last_id'] = last_id
+            checkpoint['scanned'] += len(rows)
+            checkpoint['updated'] += len(changes)
+            checkpoint['failed'] += failed
+            checkpoint['requests'] += requests
+            save_checkpoint(checkpoint_path, checkpoint)
+            logging.info(f"Backfill: {checkpoint['updated']} analyzed, {checkpoint['failed']} failed, "
+                         f"{checkpoint['requests']} requests, last id {checkpoint['last_id']}")
+    return checkpoint
+
+
+def pending_count(engine):
+    """Conversations that still have no emotional analysis"""
+    from sqlalchemy import select, func
+    from database import Conversation
+
+    with engine.connect() as conn:
+        return conn.execute(
+            select(func.count()).select_from(Conversation.__table__).where(Conversation.emotional_context.is_(None))
+        ).scalar()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backfill missing emotional analysis")
+    parser.add_argument('command', choices=['run', 'status', 'reset'])
+    parser.add_argument('--checkpoint', default=BACKFILL_CHECKPOINT)
+    parser.add_argument('--batch-size', type=int, default=200, help="Rows read and written per batch")
+    parser.add_argument('--items-per-prompt', type=int, default=10, help="Messages analyzed per model request")
+    parser.add_argument('--concurrency', type=int, default=4, help="Model requests in flight")
+    parser.add_argument('--limit', type=int, default=None, help="Stop after this many rows")
+    parser.add_argument('--loop', type=float, default=0, help="Repeat every N seconds to pick up new rows")
+    parser.add_argument('--dry-run', action='store_true', help="Analyze without writing rows or the checkpoint")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'reset':
+        if os.path.exists(args.checkpoint):
+            os.remove(args.checkpoint)
+        print(f"Removed checkpoint {args.checkpoint}; the next run starts from the first row")
+        return
+
+    from database import db_manager
+    engine = db_manager.engine
+    if args.command == 'status':
+        checkpoint = load_checkpoint(args.checkpoint)
+        print(f"pending rows: {pending_count(engine)}")
+        print(f"checkpoint: last id {checkpoint['last_id']}, {checkpoint['updated']} analyzed, "
+              f"{checkpoint['failed']} failed, {checkpoint['requests']} requests, saved {checkpoint.get('saved_at')}")
+        return
+
+    from therapy_bot import TherapyBot
+    therapy_bot = TherapyBot()
+    while True:
+        started = time.perf_counter()
+        checkpoint = backfill(engine, therapy_bot, args.checkpoint, args.batch_size, args.items_per_prompt,
+                              args.concurrency, args.limit, args.dry_run)
+        print(f"{checkpoint['updated']} rows analyzed, {checkpoint['failed']} failed in "
+              f"{time.perf_counter() - started:.1f}s{' (dry run)' if args.dry_run else ''}")
+        if not args.loop:
+            break
+        time.sleep(args.loop)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,167 @@
+"""Indexed soothing content catalog.
+
+Songs, remedies, jokes, quotes and the keywords that select them live in a
+versioned data file (soothing_catalog.json). It is loaded once into an
+immutable index from keyword to weighted categories, with the content for
+every primary/secondary category pair precomputed, so a lookup only scans the
+words of the text. The file is re-read when it changes on disk, without a
+restart.
+"""
+import os
+import re
+import json
+import time
+import random
+import logging
+import threading
+from types import MappingProxyType
+from metrics import metrics
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "soothing_catalog.json")
+CONTENT_KINDS = ('songs', 'remedies', 'jokes')
+WORD = re.compile(r"[a-z']+")
+
+# How many leading items the primary category keeps before the secondary category's first item
+PRIMARY_LEAD = 2
+
+
+def _blend(primary, secondary):
+    """Primary items first, the secondary category's best item third, then the rest of both"""
+    if not secondary:
+        return primary
+    lead = primary[:PRIMARY_LEAD] + secondary[:1]
+    rest = primary[PRIMARY_LEAD:] + secondary[1:]
+    return tuple(dict.fromkeys(lead + rest))
+
+
+class SoothingCatalog:
+    def __init__(self, data):
+        """Build the immutable keyword and content index from parsed catalog data"""
+        self.version = data['version']
+        self.default_category = data.get('default_category', 'default')
+        self.secondary_ratio = float(data.get('secondary_ratio', 0.5))
+        categories = data['categories']
+        if self.default_category not in categories:
+            raise ValueError(f"Catalog has no '{self.default_category}' category")
+
+        # Category order in the file breaks ties, as the old if-chains did
+        self.order = MappingProxyType({name: position for position, name in enumerate(categories)})
+
+        keyword_index = {}
+        for name, category in categories.items():
+            for keyword, weight in category.get('keywords', {}).items():
+                keyword_index.setdefault(keyword.lower(), []).append((name, float(weight)))
+        self.keywords = MappingProxyType({word: tuple(entries) for word, entries in keyword_index.items()})
+
+        self.content = MappingProxyType({
+            name: MappingProxyType({kind: tuple(category.get(kind, ())) for kind in CONTENT_KINDS})
+            for name, category in categories.items()
+        })
+        self.quotes = MappingProxyType({
+            name: tuple(category.get('quotes', ())) or tuple(categories[self.default_category].get('quotes', ()))
+            for name, category in categories.items()
+        })
+        self.blends = MappingProxyType({
+            (primary, secondary): MappingProxyType({
+                kind: _blend(self.content[primary][kind], self.content[secondary][kind]) for kind in CONTENT_KINDS
+            })
+            for primary in categories for secondary in categories
+            if primary != secondary and primary != self.default_category and secondary != self.default_category
+        })
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as fh:
+            return cls(json.load(fh))
+
+    def score(self, text):
+        """Return [(category, score)] for keyword matches in text, best first"""
+        scores = {}
+        for match in WORD.finditer(text.lower()):
+            entries = self.keywords.get(match.group(0))
+            if entries:
+                for category, weight in entries:
+                    scores[category] = scores.get(category, 0.0) + weight
+        return sorted(scores.items(), key=lambda item: (-item[1], self.order[item[0]]))
+
+    def classify(self, text):
+        """Return (primary, secondary or None, primary score) for text"""
+        ranked = self.score(text or "")
+        if not ranked:
+            return self.default_category, None, 0.0
+        primary, best = ranked[0]
+        secondary = None
+        if len(ranked) > 1 and ranked[1][1] >= best * self.secondary_ratio:
+            secondary = ranked[1][0]
+        return primary, secondary, best
+
+    def soothing_content(self, text=None, category=None, secondary=None):
+        """Read-only songs/remedies/jokes for text, or for an already known category"""
+        if category is None:
+            category, secondary, _ = self.classify(text)
+        if category not in self.content:
+            category, secondary = self.default_category, None
+        if secondary:
+            return self.blends.get((category, secondary), self.content[category])
+        return self.content[category]
+
+    def quote(self, text=None, category=None):
+        """A random motivational quote for text, or for an already known category"""
+        if category is None:
+            category, _, _ = self.classify(text)
+        quotes = self.quotes.get(category) or self.quotes[self.default_category]
+        return random.choice(quotes)
+
+
+class CatalogStore:
+    def __init__(self, path=CATALOG_PATH, check_interval=5.0):
+        """Hold the current catalog and swap in a new one when the data file changes"""
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._next_check = 0.0
+        self._catalog = None
+        self.reload()
+
+    def reload(self):
+        """Re-read the data file; a broken file is logged and the previous catalog kept"""
+        with self._lock:
+            mtime = None
+            try:
+                mtime = os.stat(self.path).st_mtime
+                catalog = SoothingCatalog.load(self.path)
+            except Exception as e:
+                logging.error(f"Error loading soothing catalog {self.path}: {e}")
+                metrics.inc("catalog_reloads_total", outcome="error")
+                if self._catalog is None:
+                    raise
+                # Do not retry until the file changes again
+                self._mtime = mtime
+                return False
+            self._catalog = catalog
+            self._mtime = mtime
+            metrics.inc("catalog_reloads_total", outcome="success")
+            metrics.set_gauge("catalog_version", catalog.version)
+            logging.info(f"Loaded soothing catalog version {catalog.version}")
+            return True
+
+    @property
+    def current(self):
+        """The live catalog, checking the file's mtime at most every check_interval seconds"""
+        now = time.monotonic()
+        if self.check_interval and now >= self._next_check:
+            self._next_check = now + self.check_interval
+            try:
+                if os.stat(self.path).st_mtime != self._mtime:
+                    self.reload()
+            except OSError as e:
+                logging.error(f"Error checking soothing catalog {self.path}: {e}")
+        return self._catalog
+
+
+# Process-wide catalog shared by every session
+catalog_store = CatalogStore(
+    os.getenv("SOOTHING_CATALOG_PATH", CATALOG_PATH),
+    check_interval=float(os.getenv("CATALOG_RELOAD_INTERVAL", "5"))
+)
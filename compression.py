@@ -0,0 +1,367 @@
+"""Transparent compression for long conversation text columns.
+
+CompressedText is a drop-in replacement for Text. With COMPRESS_TEXT_COLUMNS
+enabled, values longer than COMPRESSION_MIN_LENGTH are stored as
+"zc1:<codec><dict id>:<base85 payload>" using zstd (when the optional
+zstandard package is installed) or zlib. Reads decode any stored form, so
+plain and compressed rows can live side by side while a migration runs. An
+optional shared dictionary trained on existing responses improves the ratio
+for the short, repetitive prose of the emotional analysis.
+
+    python compression.py train --out ./conversation.dict
+    python compression.py migrate --batch-size 500
+    python compression.py stats
+"""
+import os
+import sys
+import time
+import zlib
+import base64
+import hashlib
+import logging
+import argparse
+from collections import Counter
+from sqlalchemy.types import TypeDecorator, Text
+from metrics import metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MARKER = "zc1:"
+CODEC_IDS = {'zlib': 'z', 'zstd': 's'}
+CODEC_NAMES = {v: k for k, v in CODEC_IDS.items()}
+
+
+def dictionary_id(data):
+    return hashlib.sha1(data).hexdigest()[:8]
+
+
+def train_dictionary(samples, size=16384, algorithm=None):
+    """Build a shared dictionary from sample texts (zstd training, or frequent sentences for zlib)"""
+    algorithm = algorithm or ('zstd' if zstandard else 'zlib')
+    encoded = [s.encode('utf-8') for s in samples if s]
+    if algorithm == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd dictionaries require the zstandard package")
+        return zstandard.train_dictionary(size, encoded).as_bytes()
+
+    # zlib uses the dictionary as preset history; the most frequent phrases go last (closest)
+    counts = Counter()
+    for sample in samples:
+        for sentence in sample.replace('\n', '. ').split('. '):
+            sentence = sentence.strip()
+            if len(sentence) >= 12:
+                counts[sentence + '. '] += 1
+    chosen = []
+    total = 0
+    for sentence, count in counts.most_common():
+        if count < 2:
+            break
+        piece = sentence.encode('utf-8')
+        if total + len(piece) > size:
+            continue
+        chosen.append(piece)
+        total += len(piece)
+    return b"".join(reversed(chosen))
+
+
+class TextCodec:
+    def __init__(self, enabled=False, algorithm=None, level=None, min_length=160, dictionaries=None):
+        """Compress and decompress text values for storage"""
+        self.enabled = enabled
+        self.algorithm = algorithm or ('zstd' if zstandard else 'zlib')
+        if self.algorithm not in CODEC_IDS:
+            raise ValueError(f"Unknown compression algorithm '{self.algorithm}'")
+        if self.algorithm == 'zstd' and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        self.level = level if level is not None else (6 if self.algorithm == 'zlib' else 9)
+        self.min_length = min_length
+        self.dictionaries = {}
+        self.active_dictionary = None
+        self._zstd_dicts = {}
+        for data in dictionaries or []:
+            self.add_dictionary(data, active=self.active_dictionary is None)
+
+    @classmethod
+    def from_env(cls):
+        """Build a codec from COMPRESS_TEXT_COLUMNS, COMPRESSION_* and COMPRESSION_DICT_PATH"""
+        dictionaries = []
+        # Comma separated; the first dictionary compresses new rows, the rest only decode old ones
+        for path in filter(None, (p.strip() for p in os.getenv("COMPRESSION_DICT_PATH", "").split(","))):
+            try:
+                with open(path, 'rb') as fh:
+                    dictionaries.append(fh.read())
+            except Exception as e:
+                logging.error(f"Error loading compression dictionary {path}: {e}")
+        level = os.getenv("COMPRESSION_LEVEL")
+        return cls(
+            enabled=os.getenv("COMPRESS_TEXT_COLUMNS", "").lower() in ('1', 'true', 'yes'),
+            algorithm=os.getenv("COMPRESSION_ALGORITHM") or None,
+            level=int(level) if level else None,
+            min_length=int(os.getenv("COMPRESSION_MIN_LENGTH", "160")),
+            dictionaries=dictionaries
+        )
+
+    def add_dictionary(self, data, active=False):
+        dict_id = dictionary_id(data)
+        self.dictionaries[dict_id] = data
+        if active:
+            self.active_dictionary = dict_id
+        return dict_id
+
+    def _zstd_dict(self, dict_id):
+        if dict_id not in self._zstd_dicts:
+            self._zstd_dicts[dict_id] = zstandard.ZstdCompressionDict(self.dictionaries[dict_id])
+        return self._zstd_dicts[dict_id]
+
+    def compress(self, data, algorithm, dict_id=None):
+        if algorithm == 'zstd':
+            options = {'level': self.level}
+            if dict_id:
+                options['dict_data'] = self._zstd_dict(dict_id)
+            return zstandard.ZstdCompressor(**options).compress(data)
+        options = {'zdict': self.dictionaries[dict_id]} if dict_id else {}
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, **options)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, payload, algorithm, dict_id=None):
+        if algorithm == 'zstd':
+            if zstandard is None:
+                raise ValueError("Stored value is zstd compressed but zstandard is not installed")
+            options = {'dict_data': self._zstd_dict(dict_id)} if dict_id else {}
+            return zstandard.ZstdDecompressor(**options).decompress(payload)
+        options = {'zdict': self.dictionaries[dict_id]} if dict_id else {}
+        decompressor = zlib.decompressobj(-15, **options)
+        return decompressor.decompress(payload) + decompressor.flush()
+
+    def encode(self, value, force=False):
+        """Return the stored form of value, compressed when enabled and worthwhile"""
+        if value is None or not (self.enabled or force):
+            return value
+        # Plain text that happens to look like a stored value must be compressed to stay unambiguous
+        ambiguous = value.startswith(MARKER)
+        if len(value) < self.min_length and not ambiguous:
+            return value
+        raw = value.encode('utf-8')
+        payload = self.compress(raw, self.algorithm, self.active_dictionary)
+        stored = f"{MARKER}{CODEC_IDS[self.algorithm]}{self.active_dictionary or ''}:{base64.b85encode(payload).decode('ascii')}"
+        if len(stored) >= len(value) and not ambiguous:
+            return value
+        metrics.inc("text_compression_bytes_total", len(raw), kind="raw")
+        metrics.inc("text_compression_bytes_total", len(stored), kind="stored")
+        return stored
+
+    def decode(self, value):
+        """Return the original text for a stored value (plain values pass through)"""
+        if not isinstance(value, str) or not value.startswith(MARKER):
+            return value
+        try:
+            header, payload = value[len(MARKER):].split(':', 1)
+            algorithm = CODEC_NAMES[header[0]]
+            dict_id = header[1:] or None
+            if dict_id and dict_id not in self.dictionaries:
+                raise ValueError(f"compression dictionary {dict_id} is not loaded (COMPRESSION_DICT_PATH)")
+            return self.decompress(base64.b85decode(payload), algorithm, dict_id).decode('utf-8')
+        except Exception as e:
+            logging.error(f"Error decompressing stored text: {e}")
+            metrics.inc("text_compression_errors_total")
+            return value
+
+    @staticmethod
+    def is_compressed(value):
+        return isinstance(value, str) and value.startswith(MARKER)
+
+
+class CompressedText(TypeDecorator):
+    """Text column that is transparently compressed when COMPRESS_TEXT_COLUMNS is enabled"""
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return text_codec.encode(value)
+
+    def process_result_value(self, value, dialect):
+        return text_codec.decode(value)
+
+
+# Global codec instance shared by every CompressedText column
+text_codec = TextCodec.from_env()
+
+COMPRESSED_COLUMNS = ('user_input', 'ai_response', 'emotional_context')
+
+
+def _stored_size(value):
+    return len(value.encode('utf-8')) if value else 0
+
+
+def migrate_rows(engine, codec, decompress=False, batch_size=500, dry_run=False):
+    """Rewrite every conversation's text columns in their compressed (or plain) stored form"""
+    from sqlalchemy import select, update, bindparam, type_coerce
+    from database import Conversation
+
+    table = Conversation.__table__
+    # type_coerce/bindparam(type_=Text) bypass CompressedText so raw stored values are read and written
+    raw_columns = [type_coerce(table.c[name], Text).label(name) for name in COMPRESSED_COLUMNS]
+    statement = update(table).where(table.c.id == bindparam('row_id')).values(
+        **{name: bindparam(f"new_{name}", type_=Text) for name in COMPRESSED_COLUMNS}
+    )
+    report = {'rows_scanned': 0, 'rows_rewritten': 0, 'bytes_before': 0, 'bytes_after': 0,
+              'encode_seconds': 0.0, 'decode_seconds': 0.0, 'values': 0}
+    last_id = None
+    while True:
+        query = select(table.c.id, *raw_columns).order_by(table.c.id).limit(batch_size)
+        if last_id is not None:
+            query = query.where(table.c.id > last_id)
+        with engine.connect() as conn:
+            rows = conn.execute(query).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        changes = []
+        for row in rows:
+            report['rows_scanned'] += 1
+            new_values = {}
+            for name in COMPRESSED_COLUMNS:
+                stored = getattr(row, name)
+                new_values[f"new_{name}"] = stored
+                if stored is None:
+                    continue
+                started = time.perf_counter()
+                plain = codec.decode(stored)
+                report['decode_seconds'] += time.perf_counter() - started
+                if codec.is_compressed(plain):
+                    raise ValueError(f"Cannot decode conversation {row.id} column {name}; load its dictionary first")
+                started = time.perf_counter()
+                rewritten = plain if decompress else codec.encode(plain, force=True)
+                report['encode_seconds'] += time.perf_counter() - started
+                if codec.decode(rewritten) != plain:
+                    raise ValueError(f"Round trip mismatch for conversation {row.id} column {name}")
+                report['values'] += 1
+                report['bytes_before'] += _stored_size(stored)
+                report['bytes_after'] += _stored_size(rewritten)
+                new_values[f"new_{name}"] = rewritten
+            if any(new_values[f"new_{name}"] != getattr(row, name) for name in COMPRESSED_COLUMNS):
+                changes.append({'row_id': row.id, **new_values})
+
+        if changes and not dry_run:
+            with engine.begin() as conn:
+                conn.execute(statement, changes)
+        report['rows_rewritten'] += len(changes)
+        logging.info(f"Compression migration: {report['rows_scanned']} rows scanned, {report['rows_rewritten']} rewritten")
+    return report
+
+
+def benchmark_codec(codec, samples, rounds=5):
+    """Measure average encode/decode microseconds and the size ratio on sample texts"""
+    samples = [s for s in samples if s]
+    if not samples:
+        return {'samples': 0}
+    stored = [codec.encode(s, force=True) for s in samples]
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for s in samples:
+            codec.encode(s, force=True)
+    encode_us = (time.perf_counter() - started) / (rounds * len(samples)) * 1e6
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for s in stored:
+            codec.decode(s)
+    decode_us = (time.perf_counter() - started) / (rounds * len(samples)) * 1e6
+    raw_bytes = sum(_stored_size(s) for s in samples)
+    stored_bytes = sum(_stored_size(s) for s in stored)
+    return {
+        'samples': len(samples),
+        'raw_bytes': raw_bytes,
+        'stored_bytes': stored_bytes,
+        'ratio': raw_bytes / stored_bytes if stored_bytes else 0.0,
+        'encode_us': encode_us,
+        'decode_us': decode_us
+    }
+
+
+def sample_texts(engine, limit=2000, columns=('ai_response', 'emotional_context')):
+    """Load recent decoded text values to train or benchmark on"""
+    from sqlalchemy import select
+    from database import Conversation
+
+    with engine.connect() as conn:
+        rows = conn.execute(
+            select(*(Conversation.__table__.c[name] for name in columns))
+            .order_by(Conversation.created_at.desc())
+            .limit(limit)
+        ).all()
+    return [value for row in rows for value in row if value]
+
+
+def table_size(engine):
+    """Total on-disk size of conversations (PostgreSQL only), or None"""
+    if engine.dialect.name != 'postgresql':
+        return None
+    from sqlalchemy import text
+    with engine.connect() as conn:
+        return conn.execute(text(
+            "SELECT coalesce(sum(pg_total_relation_size(c.oid)), 0) FROM pg_class c "
+            "WHERE c.relname = 'conversations' OR c.oid IN "
+            "(SELECT inhrelid FROM pg_inherits WHERE inhparent = 'conversations'::regclass)"
+        )).scalar()
+
+
+def print_benchmark(label, result):
+    if not result.get('samples'):
+        print(f"{label}: no samples")
+        return
+    print(f"{label}: {result['samples']} values, {result['raw_bytes']} -> {result['stored_bytes']} bytes "
+          f"(x{result['ratio']:.2f}), encode {result['encode_us']:.1f}us, decode {result['decode_us']:.1f}us")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Conversation text compression")
+    parser.add_argument('command', choices=['train', 'migrate', 'stats'])
+    parser.add_argument('--out', default='conversation.dict', help="Dictionary file written by train")
+    parser.add_argument('--dict-size', type=int, default=16384, help="Dictionary size in bytes")
+    parser.add_argument('--sample', type=int, default=2000, help="Rows sampled for training and stats")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--decompress', action='store_true', help="Rewrite rows back to plain text")
+    parser.add_argument('--dry-run', action='store_true', help="Measure savings without writing")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    from database import db_manager
+    engine = db_manager.engine
+
+    if args.command == 'train':
+        samples = sample_texts(engine, args.sample)
+        data = train_dictionary(samples, args.dict_size, text_codec.algorithm)
+        with open(args.out, 'wb') as fh:
+            fh.write(data)
+        print(f"Wrote {len(data)} byte {text_codec.algorithm} dictionary {dictionary_id(data)} to {args.out}")
+        plain = TextCodec(algorithm=text_codec.algorithm, level=text_codec.level, min_length=text_codec.min_length)
+        trained = TextCodec(algorithm=text_codec.algorithm, level=text_codec.level, min_length=text_codec.min_length, dictionaries=[data])
+        print_benchmark("without dictionary", benchmark_codec(plain, samples))
+        print_benchmark("with dictionary", benchmark_codec(trained, samples))
+    elif args.command == 'migrate':
+        size_before = table_size(engine)
+        started = time.perf_counter()
+        report = migrate_rows(engine, text_codec, args.decompress, args.batch_size, args.dry_run)
+        elapsed = time.perf_counter() - started
+        values = report['values'] or 1
+        print(f"{report['rows_rewritten']}/{report['rows_scanned']} rows rewritten in {elapsed:.1f}s"
+              f"{' (dry run)' if args.dry_run else ''}")
+        print(f"text bytes: {report['bytes_before']} -> {report['bytes_after']}"
+              f" ({100.0 * (1 - report['bytes_after'] / report['bytes_before']) if report['bytes_before'] else 0.0:.1f}% saved)")
+        print(f"per value: encode {report['encode_seconds'] / values * 1e6:.1f}us, decode {report['decode_seconds'] / values * 1e6:.1f}us")
+        if size_before is not None:
+            print(f"table size: {size_before} -> {table_size(engine)} bytes (run VACUUM FULL to return freed pages)")
+    else:
+        samples = sample_texts(engine, args.sample, COMPRESSED_COLUMNS)
+        print(f"codec: {text_codec.algorithm} level {text_codec.level}, enabled={text_codec.enabled}, "
+              f"dictionary={text_codec.active_dictionary}")
+        print(f"table size: {table_size(engine)}")
+        print_benchmark("current codec", benchmark_codec(text_codec, samples))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,11 +1,21 @@
 import os
+import time
+import atexit
 import logging
-from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean, Float
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, inspect, text, select, func, update, delete, Index, Column, Integer, BigInteger, String, Text, Date, DateTime, Boolean, Float, JSON
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects import postgresql, sqlite
 import uuid
+from admission import limited
+from tracing import traced
+from metrics import metrics
+from compression import CompressedText
+from search import ConversationSearch, query_terms, make_snippet
+from analytics import AnalyticsRollups
 
 # Database setup
 DATABASE_URL = os.getenv('DATABASE_URL')
@@ -31,13 +41,20 @@ class Conversation(Base):
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), nullable=False)
     session_id = Column(String(255), nullable=False)
-    user_input = Column(Text, nullable=False)
-    ai_response = Column(Text, nullable=False)
+    user_input = Column(CompressedText, nullable=False)
+    ai_response = Column(CompressedText, nullable=False)
     input_type = Column(String(50), nullable=False)  # text, audio, image
     has_audio_response = Column(Boolean, default=False)
-    emotional_context = Column(Text, nullable=True)
+    emotional_context = Column(CompressedText, nullable=True)  # Compressed when COMPRESS_TEXT_COLUMNS is set
     created_at = Column(DateTime, default=datetime.utcnow)
     response_time = Column(Float, nullable=True)  # Time taken to generate response
+    stage_timings = Column(JSON, nullable=True)  # Seconds spent per turn stage (llm_response, tts, ...)
+    token_usage = Column(JSON, nullable=True)  # Model tokens and cost per stage and model for the turn
+    
+    __table_args__ = (
+        # History lookups filter by session and order by time
+        Index('ix_conversations_session_created', 'session_id', 'created_at'),
+    )
 
 class UserFeedback(Base):
     __tablename__ = "user_feedback"
@@ -49,39 +66,214 @@ class UserFeedback(Base):
     feedback_text = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+class UserTokenUsage(Base):
+    __tablename__ = "user_token_usage"
+    
+    user_id = Column(UUID(as_uuid=True), primary_key=True)
+    day = Column(Date, primary_key=True)  # UTC
+    model = Column(String(100), primary_key=True)
+    calls = Column(Integer, nullable=False, default=0)
+    input_tokens = Column(BigInteger, nullable=False, default=0)
+    output_tokens = Column(BigInteger, nullable=False, default=0)
+    cached_tokens = Column(BigInteger, nullable=False, default=0)
+    cost = Column(Float, nullable=False, default=0.0)  # USD
+
+USAGE_COUNTERS = ('calls', 'input_tokens', 'output_tokens', 'cached_tokens', 'cost')
+
+def add_token_usage_statement(dialect_name, user_id, day, models):
+    """INSERT ... ON CONFLICT DO UPDATE adding a turn's per-model usage to the user's daily rows"""
+    dialects = {'postgresql': postgresql, 'sqlite': sqlite}
+    if dialect_name not in dialects:
+        raise ValueError(f"Upsert is not supported for database dialect '{dialect_name}'")
+    stmt = dialects[dialect_name].insert(UserTokenUsage).values([
+        {'user_id': user_id, 'day': day, 'model': model, **{name: totals.get(name, 0) for name in USAGE_COUNTERS}}
+        for model, totals in models.items()
+    ])
+    return stmt.on_conflict_do_update(
+        index_elements=[UserTokenUsage.user_id, UserTokenUsage.day, UserTokenUsage.model],
+        set_={name: getattr(UserTokenUsage, name) + getattr(stmt.excluded, name) for name in USAGE_COUNTERS}
+    )
+
+def upsert_user_statement(dialect_name, session_id):
+    """INSERT ... ON CONFLICT (session_id) DO UPDATE ... RETURNING for the users table"""
+    dialects = {'postgresql': postgresql, 'sqlite': sqlite}
+    if dialect_name not in dialects:
+        raise ValueError(f"Upsert is not supported for database dialect '{dialect_name}'")
+    now = datetime.utcnow()
+    stmt = dialects[dialect_name].insert(User).values(
+        id=uuid.uuid4(),
+        session_id=session_id,
+        created_at=now,
+        last_active=now,
+        total_conversations=0
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.session_id],
+        set_={'last_active': stmt.excluded.last_active}
+    )
+    return stmt.returning(User)
+
+class LastActiveCoalescer:
+    def __init__(self, session_factory, flush_interval=30.0):
+        """Buffer users.last_active bumps in memory and write them in one batch per interval"""
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._thread = None
+        self._stop = threading.Event()
+
+    def touch(self, user_id, when=None):
+        """Record activity for a user; the newest timestamp wins"""
+        when = when or datetime.utcnow()
+        with self._lock:
+            if self._pending.get(user_id) is None or self._pending[user_id] < when:
+                self._pending[user_id] = when
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="last-active-flush", daemon=True)
+                self._thread.start()
+
+    def pending_for(self, user_id):
+        """Unflushed last_active for a user, if any"""
+        with self._lock:
+            return self._pending.get(user_id)
+
+    def flush(self):
+        """Write all buffered timestamps with a single bulk UPDATE"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        db = self.session_factory()
+        try:
+            db.execute(update(User), [{'id': user_id, 'last_active': when} for user_id, when in pending.items()])
+            db.commit()
+            return len(pending)
+        except Exception as e:
+            db.rollback()
+            logging.error(f"Error flushing last_active updates: {e}")
+            # Put the batch back unless newer touches arrived meanwhile
+            with self._lock:
+                for user_id, when in pending.items():
+                    if self._pending.get(user_id) is None or self._pending[user_id] < when:
+                        self._pending[user_id] = when
+            return 0
+        finally:
+            db.close()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+class StatsCache:
+    def __init__(self, ttl=10.0, max_entries=10000, clock=time.monotonic):
+        """Per-session read-through cache for user stats, invalidated on writes
+
+        The cache is per process: a write invalidates it only in the process that made it, so other
+        API workers or replicas may serve stats up to ttl seconds old.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or self.clock() - entry[0] > self.ttl:
+                metrics.inc("user_stats_cache_total", result="miss")
+                return None
+            metrics.inc("user_stats_cache_total", result="hit")
+            return dict(entry[1])
+
+    def set(self, session_id, stats):
+        with self._lock:
+            self._entries.pop(session_id, None)
+            self._entries[session_id] = (self.clock(), dict(stats))
+            if len(self._entries) > self.max_entries:
+                # Dict order is insertion order, so the first key is the oldest entry
+                self._entries.pop(next(iter(self._entries)))
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
 class DatabaseManager:
     def __init__(self):
         self.engine = engine
         self.SessionLocal = SessionLocal
+        self.last_active = LastActiveCoalescer(
+            lambda: self.SessionLocal(),
+            flush_interval=float(os.getenv("LAST_ACTIVE_FLUSH_INTERVAL", "30"))
+        )
+        atexit.register(self.last_active.stop)
+        self.stats_cache = StatsCache(ttl=float(os.getenv("USER_STATS_CACHE_TTL", "10")))
+        self.search = ConversationSearch(self.engine, os.getenv("SEARCH_LANGUAGE", "english"))
+        self.analytics = AnalyticsRollups(self.engine, flush_interval=float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "10")))
+        atexit.register(self.analytics.stop)
+        self._reconcile_thread = None
         
     def create_tables(self):
         """Create all database tables"""
         try:
+            if os.getenv("CONVERSATION_PARTITIONING", "").lower() in ("1", "true", "yes"):
+                # Must run before create_all so conversations is created partitioned
+                from partitioning import partition_manager
+                partition_manager.create_partitioned_table()
             Base.metadata.create_all(bind=self.engine)
+            self._upgrade_schema()
+            self.search.create()
+            self.analytics.create()
             logging.info("Database tables created successfully")
         except Exception as e:
             logging.error(f"Error creating database tables: {e}")
             raise
     
+    def _upgrade_schema(self):
+        """Add nullable columns and indexes introduced after a table was first created"""
+        inspector = inspect(self.engine)
+        with self.engine.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                if not inspector.has_table(table.name):
+                    continue
+                existing = {column['name'] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name in existing or not column.nullable:
+                        continue
+                    column_type = column.type.compile(dialect=self.engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                    logging.info(f"Added column {table.name}.{column.name}")
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=self.engine, checkfirst=True)
+    
     def get_session(self):
         """Get database session"""
         return self.SessionLocal()
     
+    @traced("db.get_or_create_user")
+    @limited("db")
     def get_or_create_user(self, session_id):
         """Get existing user or create new one"""
         db = self.get_session()
         try:
-            user = db.query(User).filter(User.session_id == session_id).first()
-            if not user:
-                user = User(session_id=session_id)
-                db.add(user)
-                db.commit()
-                db.refresh(user)
-                logging.info(f"Created new user with session_id: {session_id}")
-            else:
-                # Update last active time
-                user.last_active = datetime.utcnow()
-                db.commit()
+            # One round trip that is safe when two tabs share a session
+            user = db.scalars(
+                upsert_user_statement(self.engine.dialect.name, session_id),
+                execution_options={'populate_existing': True}
+            ).one()
+            # Keep the loaded attributes usable after the session closes
+            db.expunge(user)
+            db.commit()
             return user
         except Exception as e:
             db.rollback()
@@ -90,11 +282,15 @@ class DatabaseManager:
         finally:
             db.close()
     
-    def save_conversation(self, user_id, session_id, user_input, ai_response, input_type, has_audio_response=False, emotional_context=None, response_time=None):
+    @traced("db.save_conversation")
+    @limited("db")
+    def save_conversation(self, user_id, session_id, user_input, ai_response, input_type, has_audio_response=False, emotional_context=None, response_time=None, stage_timings=None, token_usage=None):
         """Save conversation to database"""
         db = self.get_session()
         try:
             conversation = Conversation(
+                id=uuid.uuid4(),
+                created_at=datetime.utcnow(),
                 user_id=user_id,
                 session_id=session_id,
                 user_input=user_input,
@@ -102,18 +298,32 @@ class DatabaseManager:
                 input_type=input_type,
                 has_audio_response=has_audio_response,
                 emotional_context=emotional_context,
-                response_time=response_time
+                response_time=response_time,
+                stage_timings=stage_timings,
+                token_usage=token_usage
             )
             db.add(conversation)
             
-            # Update user's total conversation count
-            user = db.query(User).filter(User.id == user_id).first()
-            if user:
-                user.total_conversations += 1
-                user.last_active = datetime.utcnow()
+            # Daily per-user totals that budgets are checked against
+            if token_usage and token_usage.get('models'):
+                db.execute(add_token_usage_statement(self.engine.dialect.name, user_id, conversation.created_at.date(), token_usage['models']))
+            
+            # Index for full-text search in the same transaction
+            if self.search.enabled:
+                db.execute(self.search.index_statement(conversation.id, session_id, conversation.created_at, user_input, ai_response))
+            
+            # Update user's total conversation count atomically; last_active is batched separately
+            db.execute(
+                update(User)
+                .where(User.id == user_id)
+                .values(total_conversations=User.total_conversations + 1)
+            )
             
             db.commit()
+            self.last_active.touch(user_id)
+            self.stats_cache.invalidate(session_id)
             db.refresh(conversation)
+            self.analytics.record_conversation(conversation.created_at, input_type, has_audio_response, response_time)
             logging.info(f"Saved conversation for user {user_id}")
             return conversation
         except Exception as e:
@@ -123,6 +333,8 @@ class DatabaseManager:
         finally:
             db.close()
     
+    @traced("db.get_user_conversations")
+    @limited("db")
     def get_user_conversations(self, session_id, limit=50):
         """Get user's conversation history"""
         db = self.get_session()
@@ -141,7 +353,10 @@ class DatabaseManager:
                     'input_type': conv.input_type,
                     'has_audio_response': conv.has_audio_response,
                     'created_at': conv.created_at,
-                    'emotional_context': conv.emotional_context
+                    'emotional_context': conv.emotional_context,
+                    'response_time': conv.response_time,
+                    'stage_timings': conv.stage_timings,
+                    'token_usage': conv.token_usage
                 })
             
             return list(reversed(conversation_list))  # Return in chronological order
@@ -151,6 +366,8 @@ class DatabaseManager:
         finally:
             db.close()
     
+    @traced("db.save_user_feedback")
+    @limited("db")
     def save_user_feedback(self, conversation_id, user_id, rating=None, feedback_text=None):
         """Save user feedback for a conversation"""
         db = self.get_session()
@@ -162,7 +379,13 @@ class DatabaseManager:
                 feedback_text=feedback_text
             )
             db.add(feedback)
+            # Ratings are rolled up per input type of the rated conversation
+            input_type = None
+            if rating is not None:
+                input_type = db.execute(select(Conversation.input_type).where(Conversation.id == conversation_id)).scalar()
             db.commit()
+            if rating is not None:
+                self.analytics.record_feedback(datetime.utcnow(), input_type, rating)
             logging.info(f"Saved feedback for conversation {conversation_id}")
             return feedback
         except Exception as e:
@@ -172,49 +395,212 @@ class DatabaseManager:
         finally:
             db.close()
     
+    @traced("db.get_token_usage")
+    @limited("db")
+    def get_token_usage(self, user_id, days=1):
+        """A user's model usage per UTC day, newest first, for the last `days` days (today included)"""
+        db = self.get_session()
+        try:
+            since = datetime.utcnow().date() - timedelta(days=days - 1)
+            rows = db.execute(
+                select(UserTokenUsage.day, *(func.sum(getattr(UserTokenUsage, name)).label(name) for name in USAGE_COUNTERS))
+                .where(UserTokenUsage.user_id == user_id, UserTokenUsage.day >= since)
+                .group_by(UserTokenUsage.day)
+                .order_by(UserTokenUsage.day.desc())
+            ).all()
+            return [
+                {'day': row.day, 'tokens': int(row.input_tokens or 0) + int(row.output_tokens or 0),
+                 **{name: getattr(row, name) or 0 for name in USAGE_COUNTERS}}
+                for row in rows
+            ]
+        except Exception as e:
+            logging.error(f"Error getting token usage: {e}")
+            return []
+        finally:
+            db.close()
+    
+    @traced("db.get_user_stats")
     def get_user_stats(self, session_id):
         """Get user statistics"""
-        db = self.get_session()
         try:
-            user = db.query(User).filter(User.session_id == session_id).first()
-            if user:
-                total_conversations = db.query(Conversation).filter(
-                    Conversation.session_id == session_id
-                ).count()
-                
-                return {
-                    'total_conversations': total_conversations,
-                    'user_since': user.created_at,
-                    'last_active': user.last_active
-                }
-            return None
+            stats = self.stats_cache.get(session_id)
+            if stats is None:
+                stats = self._load_user_stats(session_id)
+                if stats is None:
+                    return None
+                self.stats_cache.set(session_id, stats)
+            
+            pending_last_active = self.last_active.pending_for(stats.pop('user_id'))
+            if pending_last_active and (stats['last_active'] is None or pending_last_active > stats['last_active']):
+                stats['last_active'] = pending_last_active
+            return stats
         except Exception as e:
             logging.error(f"Error getting user stats: {e}")
             return None
+    
+    @limited("db")
+    def _load_user_stats(self, session_id):
+        """Read stats from the maintained users.total_conversations counter"""
+        db = self.get_session()
+        try:
+            user = db.query(User).filter(User.session_id == session_id).first()
+            if not user:
+                return None
+            return {
+                'user_id': user.id,
+                'total_conversations': user.total_conversations or 0,
+                'user_since': user.created_at,
+                'last_active': user.last_active
+            }
         finally:
             db.close()
     
-    def clear_user_conversations(self, session_id):
-        """Clear all conversations for a user"""
+    @traced("db.reconcile_conversation_counts")
+    @limited("db")
+    def reconcile_conversation_counts(self, batch_size=500):
+        """Repair drift between users.total_conversations and the actual conversation rows"""
+        fixed = 0
+        last_id = None
+        while True:
+            db = self.get_session()
+            try:
+                query = select(User.id, User.session_id).order_by(User.id).limit(batch_size)
+                if last_id is not None:
+                    query = query.where(User.id > last_id)
+                users = db.execute(query).all()
+                if not users:
+                    break
+                last_id = users[-1].id
+                
+                # Correlated count in the same statement keeps the race window with concurrent saves small
+                actual_count = (
+                    select(func.count())
+                    .select_from(Conversation)
+                    .where(Conversation.user_id == User.id)
+                    .scalar_subquery()
+                )
+                result = db.execute(
+                    update(User)
+                    .where(User.id.in_([u.id for u in users]))
+                    .where(func.coalesce(User.total_conversations, 0) != actual_count)
+                    .values(total_conversations=actual_count)
+                    .execution_options(synchronize_session=False)
+                )
+                db.commit()
+                if result.rowcount:
+                    for u in users:
+                        self.stats_cache.invalidate(u.session_id)
+                    fixed += result.rowcount
+            except Exception as e:
+                db.rollback()
+                logging.error(f"Error reconciling conversation counts: {e}")
+                break
+            finally:
+                db.close()
+        if fixed:
+            logging.info(f"Reconciled conversation counts for {fixed} users")
+        metrics.inc("user_counter_drift_fixed_total", fixed)
+        return fixed
+    
+    def start_reconciliation(self, interval):
+        """Run reconcile_conversation_counts every interval seconds in a background thread"""
+        if self._reconcile_thread is not None or interval <= 0:
+            return
+        
+        def run():
+            while True:
+                time.sleep(interval)
+                self.reconcile_conversation_counts()
+        
+        self._reconcile_thread = threading.Thread(target=run, name="stats-reconcile", daemon=True)
+        self._reconcile_thread.start()
+    
+    @traced("db.search_conversations")
+    @limited("db")
+    def search_conversations(self, session_id, query, page=1, page_size=10):
+        """Full-text search a user's conversations; returns ranked snippets for one page"""
+        page = max(1, page)
+        statement = self.search.search_statement(session_id, query, page_size + 1, (page - 1) * page_size) if self.search.enabled else None
+        if statement is None:
+            return {'results': [], 'page': page, 'has_more': False}
         db = self.get_session()
         try:
-            db.query(Conversation).filter(
-                Conversation.session_id == session_id
-            ).delete()
+            # One extra row tells whether there is a next page without counting every match
+            hits = db.execute(statement).all()
+            has_more = len(hits) > page_size
+            hits = hits[:page_size]
+            ids = [uuid.UUID(str(hit.conversation_id)) for hit in hits]
+            conversations = {
+                conv.id: conv
+                for conv in db.query(Conversation).filter(Conversation.id.in_(ids), Conversation.session_id == session_id).all()
+            } if ids else {}
             
-            # Reset user's conversation count
-            user = db.query(User).filter(User.session_id == session_id).first()
-            if user:
-                user.total_conversations = 0
+            terms = query_terms(query)
+            results = []
+            for hit, conversation_id in zip(hits, ids):
+                conv = conversations.get(conversation_id)
+                if conv is None:
+                    # Conversation removed by retention after it was indexed
+                    continue
+                results.append({
+                    'id': str(conv.id),
+                    'created_at': conv.created_at,
+                    'input_type': conv.input_type,
+                    'rank': float(hit.rank),
+                    'user_snippet': make_snippet(conv.user_input, terms),
+                    'assistant_snippet': make_snippet(conv.ai_response, terms)
+                })
+            return {'results': results, 'page': page, 'has_more': has_more}
+        except Exception as e:
+            logging.error(f"Error searching conversations: {e}")
+            return {'results': [], 'page': page, 'has_more': False}
+        finally:
+            db.close()
+    
+    @traced("db.clear_user_conversations")
+    @limited("db")
+    def clear_user_conversations(self, session_id, batch_size=1000):
+        """Clear all conversations for a user"""
+        deleted = 0
+        try:
+            # Delete in short transactions so a long history never holds one huge lock
+            while True:
+                db = self.get_session()
+                try:
+                    chunk = (
+                        select(Conversation.id)
+                        .where(Conversation.session_id == session_id)
+                        .limit(batch_size)
+                        .scalar_subquery()
+                    )
+                    result = db.execute(
+                        delete(Conversation)
+                        .where(Conversation.id.in_(chunk))
+                        .execution_options(synchronize_session=False)
+                    )
+                    db.commit()
+                finally:
+                    db.close()
+                deleted += result.rowcount
+                if result.rowcount < batch_size:
+                    break
             
-            db.commit()
-            logging.info(f"Cleared conversations for session {session_id}")
+            # Reset user's conversation count and drop their search documents
+            db = self.get_session()
+            try:
+                db.execute(update(User).where(User.session_id == session_id).values(total_conversations=0))
+                if self.search.enabled:
+                    db.execute(self.search.delete_session_statement(session_id))
+                db.commit()
+            finally:
+                db.close()
+            self.stats_cache.invalidate(session_id)
+            logging.info(f"Cleared {deleted} conversations for session {session_id}")
         except Exception as e:
-            db.rollback()
             logging.error(f"Error clearing conversations: {e}")
+            # Rows deleted before the failure are fixed up by reconcile_conversation_counts
+            self.stats_cache.invalidate(session_id)
             raise
-        finally:
-            db.close()
 
 # Initialize database manager
 db_manager = DatabaseManager()
@@ -223,6 +609,9 @@ def init_database():
     """Initialize database tables"""
     try:
         db_manager.create_tables()
+        db_manager.start_reconciliation(float(os.getenv("STATS_RECONCILE_INTERVAL", "900")))
+        from partitioning import partition_manager
+        partition_manager.start_maintenance(float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "86400")))
         logging.info("Database initialized successfully")
     except Exception as e:
         logging.error(f"Failed to initialize database: {e}")
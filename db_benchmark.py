@@ -0,0 +1,142 @@
+"""Compare DatabaseManager (sync, psycopg2) with AsyncDatabaseManager (asyncpg) under concurrency.
+
+Each simulated session creates its user, saves a number of turns while reading
+its stats after every save (as the sidebar does), and finally loads its history.
+
+    python db_benchmark.py --database-url postgresql://localhost/therapy_bench --concurrency 64 --sessions 256
+"""
+import os
+import sys
+import time
+import uuid
+import asyncio
+import argparse
+import tempfile
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from load_test import percentile
+
+
+class Recorder:
+    def __init__(self):
+        """Collect per-operation latencies"""
+        self.samples = {}
+
+    def add(self, op, seconds):
+        self.samples.setdefault(op, []).append(seconds)
+
+    def summary(self, elapsed):
+        total_ops = sum(len(v) for v in self.samples.values())
+        return {
+            'elapsed_seconds': elapsed,
+            'ops': total_ops,
+            'ops_per_second': total_ops / elapsed if elapsed else 0.0,
+            'operations': {
+                op: {
+                    'count': len(v),
+                    'p50': percentile(v, 50),
+                    'p95': percentile(v, 95),
+                    'p99': percentile(v, 99),
+                }
+                for op, v in sorted(self.samples.items())
+            }
+        }
+
+
+def run_sync(db_manager, args):
+    """Run the workload on DatabaseManager from a thread pool"""
+    recorder = Recorder()
+
+    def timed(op, fn, *fn_args, **fn_kwargs):
+        start = time.perf_counter()
+        result = fn(*fn_args, **fn_kwargs)
+        recorder.add(op, time.perf_counter() - start)
+        return result
+
+    def session_workload(_):
+        session_id = f"bench-sync-{uuid.uuid4()}"
+        user = timed('get_or_create_user', db_manager.get_or_create_user, session_id)
+        for turn in range(args.turns):
+            timed('save_conversation', db_manager.save_conversation,
+                  user.id, session_id, f"message {turn}", "reply " * 40, "text", response_time=0.5)
+            timed('get_user_stats', db_manager.get_user_stats, session_id)
+        timed('get_user_conversations', db_manager.get_user_conversations, session_id)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(session_workload, range(args.sessions)))
+    return recorder.summary(time.perf_counter() - start)
+
+
+async def run_async(db_manager, args):
+    """Run the same workload on AsyncDatabaseManager from one event loop"""
+    recorder = Recorder()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def timed(op, coro):
+        start = time.perf_counter()
+        result = await coro
+        recorder.add(op, time.perf_counter() - start)
+        return result
+
+    async def session_workload():
+        async with semaphore:
+            session_id = f"bench-async-{uuid.uuid4()}"
+            user = await timed('get_or_create_user', db_manager.get_or_create_user(session_id))
+            for turn in range(args.turns):
+                await timed('save_conversation', db_manager.save_conversation(
+                    user.id, session_id, f"message {turn}", "reply " * 40, "text", response_time=0.5))
+                await timed('get_user_stats', db_manager.get_user_stats(session_id))
+            await timed('get_user_conversations', db_manager.get_user_conversations(session_id))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(session_workload() for _ in range(args.sessions)))
+    return recorder.summary(time.perf_counter() - start)
+
+
+def print_summary(label, summary):
+    print(f"\n{label}: {summary['ops']} ops in {summary['elapsed_seconds']:.2f}s ({summary['ops_per_second']:.1f} ops/s)")
+    for op, stats in summary['operations'].items():
+        print(f"  {op:<24} n={stats['count']:<6} p50 {stats['p50'] * 1000:7.2f}ms  p95 {stats['p95'] * 1000:7.2f}ms  p99 {stats['p99'] * 1000:7.2f}ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sync vs async database access benchmark")
+    parser.add_argument('--database-url', default=None, help="Sync database URL (default: temporary SQLite file)")
+    parser.add_argument('--concurrency', type=int, default=32, help="Sessions in flight at once")
+    parser.add_argument('--sessions', type=int, default=128, help="Total simulated sessions")
+    parser.add_argument('--turns', type=int, default=5, help="Conversations saved per session")
+    parser.add_argument('--pool-size', type=int, default=10, help="Connection pool size for both managers")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='therapy_dbbench_'), 'bench.db')}"
+    # Both managers read configuration at import time; cap the sync path only by its pool
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('ADMISSION_DB_CONCURRENCY', str(args.concurrency))
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import database
+    from async_database import AsyncDatabaseManager
+
+    sync_manager = database.DatabaseManager()
+    if not database_url.startswith('sqlite'):
+        sync_manager.engine = create_engine(database_url, pool_size=args.pool_size, max_overflow=0)
+        sync_manager.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=sync_manager.engine)
+    sync_manager.create_tables()
+    print_summary("sync (DatabaseManager)", run_sync(sync_manager, args))
+
+    async def async_main():
+        async_manager = AsyncDatabaseManager(database_url, pool_size=args.pool_size, max_overflow=0)
+        try:
+            await async_manager.create_tables()
+            return await run_async(async_manager, args)
+        finally:
+            await async_manager.dispose()
+
+    print_summary("async (AsyncDatabaseManager)", asyncio.run(async_main()))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,55 +1,202 @@
 import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
 from google import genai
 from google.genai import types
-from PIL import Image
 import io
 import base64
 import logging
+from resilience import ResilientClient, ResiliencePolicy
+from tracing import traced
+from profiler import profiled
+from media_worker import media_worker
+
+# Images analyzed together in one vision request
+MAX_IMAGES_PER_TURN = int(os.getenv("MAX_IMAGES_PER_TURN", "4"))
+# Larger images are downscaled (in a media worker) before they are uploaded for analysis
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "1536"))
+
+# Typed fields of the combined vision response
+ANALYSIS_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {
+        'images': {
+            'type': 'ARRAY',
+            'items': {
+                'type': 'OBJECT',
+                'properties': {
+                    'index': {'type': 'INTEGER'},
+                    'description': {'type': 'STRING'},
+                    'emotions': {'type': 'STRING'}
+                },
+                'required': ['index', 'description', 'emotions']
+            }
+        },
+        'relation': {'type': 'STRING'},
+        'insights': {'type': 'STRING'},
+        'questions': {'type': 'ARRAY', 'items': {'type': 'STRING'}}
+    },
+    'required': ['images', 'relation', 'questions']
+}
+
+
+class ImageAnalysis:
+    __slots__ = ('images', 'relation', 'insights', 'questions')
+
+    def __init__(self, images, relation=None, insights=None, questions=None):
+        """Result of one combined vision request: per-image description and mood, plus follow-up questions"""
+        self.images = images
+        self.relation = relation
+        self.insights = insights
+        self.questions = questions or []
+
+    @classmethod
+    def parse(cls, text, count):
+        """Build from the model's JSON, keeping plain text as the description when it is not JSON"""
+        try:
+            data = json.loads(text)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            return cls([{'description': text.strip(), 'emotions': None}])
+        images = [None] * count
+        for item in data.get('images') or []:
+            try:
+                index = int(item.get('index', 0)) - 1
+            except (TypeError, ValueError):
+                continue
+            if 0 <= index < count:
+                images[index] = {'description': item.get('description'), 'emotions': item.get('emotions')}
+        images = [image or {'description': None, 'emotions': None} for image in images]
+        questions = [q for q in data.get('questions') or [] if isinstance(q, str) and q.strip()]
+        return cls(images, data.get('relation'), data.get('insights'), questions)
+
+    @property
+    def description(self):
+        parts = []
+        for number, image in enumerate(self.images, 1):
+            if image['description']:
+                parts.append(image['description'] if len(self.images) == 1 else f"Image {number}: {image['description']}")
+        if self.relation:
+            parts.append(self.relation)
+        if self.insights:
+            parts.append(self.insights)
+        return "\n".join(parts) or None
+
+    @property
+    def emotions(self):
+        moods = [image['emotions'] for image in self.images if image['emotions']]
+        if len(self.images) > 1:
+            moods = [f"Image {number}: {image['emotions']}" for number, image in enumerate(self.images, 1) if image['emotions']]
+        return "\n".join(moods) or None
+
+    def questions_text(self):
+        return "\n".join(f"- {question}" for question in self.questions) or None
+
+    def to_text(self):
+        """Analysis text for the turn input: description, emotional read and questions to explore"""
+        parts = [self.description]
+        if self.emotions:
+            parts.append(f"Emotional tone: {self.emotions}")
+        if self.questions:
+            parts.append("Questions to explore:\n" + self.questions_text())
+        return "\n".join(part for part in parts if part) or None
+
+
+def _image_bytes(uploaded_file):
+    return uploaded_file.getvalue() if hasattr(uploaded_file, 'getvalue') else uploaded_file.read()
+
 
 class ImageHandler:
-    def __init__(self):
+    def __init__(self, client=None):
         """Initialize image handler with Gemini client for vision capabilities"""
         try:
-            self.client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+            # Vision calls upload image bytes, so hedging stays off unless configured
+            self.client = ResilientClient(
+                client or genai.Client(api_key=os.getenv("GEMINI_API_KEY")),
+                name="vision",
+                policy=ResiliencePolicy.from_env("VISION", timeout=45.0, max_attempts=2)
+            )
             self.model = "gemini-2.5-pro"  # Use pro model for better image analysis
+            # Recent combined analyses, so the emotion and question helpers reuse one request
+            self._recent = OrderedDict()
+            self._recent_lock = threading.Lock()
         except Exception as e:
             logging.error(f"Failed to initialize ImageHandler: {e}")
             raise Exception(f"Failed to initialize image analysis client: {e}")
 
-    def analyze_image_with_context(self, uploaded_file, user_context):
-        """Analyze image with therapeutic context"""
+    @profiled("image_analysis")
+    @traced("image_analysis")
+    def analyze_images(self, uploaded_files, user_context):
+        """Describe one or more images, their emotional tone and follow-up questions in a single vision request"""
         try:
-            # Read image data
-            image_data = uploaded_file.read()
-            
-            # Create therapeutic analysis prompt
-            therapeutic_prompt = f"""As a therapeutic AI assistant, analyze this image in the context of the user's question: "{user_context}"
+            return self._analyze_images(list(uploaded_files)[:MAX_IMAGES_PER_TURN], user_context)
+        except Exception as e:
+            logging.error(f"Error analyzing images: {e}")
+            return None
 
-Please provide:
-1. A compassionate description of what you observe in the image
-2. How this image might relate to the user's emotional state or concerns
-3. Therapeutic insights or gentle observations that might be helpful
-4. Questions that could help the user explore their feelings about this image
+    def _analyze_images(self, uploaded_files, user_context):
+        originals = [_image_bytes(uploaded_file) for uploaded_file in uploaded_files]
+        # Remembered by content so the emotion helper can reuse this request instead of re-uploading
+        key = tuple(hashlib.sha1(data).hexdigest() for data in originals)
+        images = [self._prepare_image(data) for data in originals]
+        count = len(images)
+        therapeutic_prompt = f"""As a therapeutic AI assistant, analyze {'this image' if count == 1 else f'these {count} images (numbered 1 to {count} in the order given)'} in the context of the user's question: "{user_context}"
 
-Remember to be empathetic, non-judgmental, and supportive in your analysis. Focus on emotional and psychological aspects that might be relevant for therapeutic discussion."""
+For each image provide:
+- description: a compassionate description of what you observe
+- emotions: the mood it conveys through colors, composition and symbolic elements
 
-            # Analyze image with Gemini Vision
-            response = self.client.models.generate_content(
-                model=self.model,
-                contents=[
-                    types.Part.from_bytes(
-                        data=image_data,
-                        mime_type=f"image/{uploaded_file.type.split('/')[-1]}",
-                    ),
-                    therapeutic_prompt
-                ],
-                config=types.GenerateContentConfig(
-                    temperature=0.7,
-                    max_output_tokens=400
-                )
+Then provide:
+- relation: how the image{'s relate' if count > 1 else ' might relate'} to the user's emotional state or concerns
+- insights: therapeutic insights or gentle observations that might be helpful
+- questions: 3-4 open-ended questions that could help the user explore their feelings about {'it' if count == 1 else 'them'}
+
+Remember to be empathetic, non-judgmental, and supportive. Focus on emotional and psychological aspects that might be relevant for therapeutic discussion."""
+
+        response = self.client.models.generate_content(
+            model=self.model,
+            contents=[
+                types.Part.from_bytes(data=data, mime_type=f"image/{uploaded_file.type.split('/')[-1]}")
+                for data, uploaded_file in zip(images, uploaded_files)
+            ] + [therapeutic_prompt],
+            config=types.GenerateContentConfig(
+                temperature=0.7,
+                max_output_tokens=500 + 250 * count,
+                response_mime_type="application/json",
+                response_schema=ANALYSIS_SCHEMA
             )
-            
-            return response.text if response.text else "I can see your image, but I'm having trouble analyzing it right now. Could you tell me more about what this image means to you?"
+        )
+        if not response.text:
+            return None
+        analysis = ImageAnalysis.parse(response.text, count)
+        with self._recent_lock:
+            self._recent[key] = analysis
+            self._recent.move_to_end(key)
+            while len(self._recent) > 32:
+                self._recent.popitem(last=False)
+        return analysis
+
+    def _prepare_image(self, data):
+        """Decode, verify and downscale one upload in a media worker; raises on a corrupt image"""
+        result, blobs = media_worker.run('prepare_image', data, VISION_MAX_SIDE, VISION_MAX_SIDE)
+        if 'error' in result:
+            raise ValueError(f"Invalid image: {result['error']}")
+        return blobs[0] if result['resized'] else data
+
+    def _cached(self, key):
+        """A recent analysis of exactly these images"""
+        with self._recent_lock:
+            return self._recent.get(key)
+
+    def analyze_image_with_context(self, uploaded_file, user_context):
+        """Analyze image with therapeutic context"""
+        try:
+            analysis = self.analyze_images([uploaded_file], user_context)
+            text = analysis.to_text() if analysis else None
+            return text or "I can see your image, but I'm having trouble analyzing it right now. Could you tell me more about what this image means to you?"
             
         except Exception as e:
             logging.error(f"Error analyzing image: {e}")
@@ -58,37 +205,17 @@ Remember to be empathetic, non-judgmental, and supportive in your analysis. Focu
     def analyze_image_emotions(self, uploaded_file):
         """Analyze potential emotions or mood conveyed by an image"""
         try:
-            image_data = uploaded_file.read()
-            
-            emotion_prompt = """Analyze this image for emotional content and mood. Consider:
-1. Colors and their psychological impact
-2. Composition and visual elements that might reflect emotions
-3. Symbolic elements that could relate to feelings or mental states
-4. Overall mood or atmosphere of the image
-
-Provide insights that could be relevant for therapeutic discussion, focusing on emotional and psychological aspects."""
-
-            response = self.client.models.generate_content(
-                model=self.model,
-                contents=[
-                    types.Part.from_bytes(
-                        data=image_data,
-                        mime_type=f"image/{uploaded_file.type.split('/')[-1]}",
-                    ),
-                    emotion_prompt
-                ],
-                config=types.GenerateContentConfig(
-                    temperature=0.6,
-                    max_output_tokens=300
-                )
-            )
-            
-            return response.text if response.text else None
+            # Usually already answered by the combined request for this image
+            digest = hashlib.sha1(_image_bytes(uploaded_file)).hexdigest()
+            analysis = self._cached((digest,)) or self.analyze_images([uploaded_file], "")
+            return analysis.emotions if analysis else None
             
         except Exception as e:
             logging.error(f"Error analyzing image emotions: {e}")
             return None
 
+    @profiled("image_validate")
+    @traced("image_validate")
     def validate_image(self, uploaded_file):
         """Validate uploaded image file"""
         try:
@@ -104,63 +231,61 @@ Provide insights that could be relevant for therapeutic discussion, focusing on
             if uploaded_file.type not in allowed_types:
                 return False, "Unsupported image format (use PNG or JPEG)"
             
-            # Try to open with PIL to validate
-            try:
-                image = Image.open(uploaded_file)
-                image.verify()
-                uploaded_file.seek(0)  # Reset file pointer
-                return True, "Image is valid"
-            except Exception:
+            # Decoded and verified in a media worker process
+            info, _ = media_worker.run('inspect_image', _image_bytes(uploaded_file))
+            uploaded_file.seek(0)  # Reset file pointer
+            if 'error' in info:
                 return False, "Invalid or corrupted image file"
+            return True, "Image is valid"
                 
         except Exception as e:
             return False, f"Image validation error: {str(e)}"
 
+    @profiled("image_info")
     def get_image_info(self, uploaded_file):
         """Get basic information about the uploaded image"""
         try:
-            image = Image.open(uploaded_file)
-            info = {
-                'format': image.format,
-                'mode': image.mode,
-                'size': image.size,
-                'width': image.width,
-                'height': image.height
-            }
+            info, _ = media_worker.run('inspect_image', _image_bytes(uploaded_file))
             uploaded_file.seek(0)  # Reset file pointer
-            return info
+            if 'error' in info:
+                raise ValueError(info['error'])
+            return {
+                'format': info['format'],
+                'mode': info['mode'],
+                'size': (info['width'], info['height']),
+                'width': info['width'],
+                'height': info['height']
+            }
         except Exception as e:
             logging.error(f"Error getting image info: {e}")
             return None
 
+    @profiled("image_resize")
     def resize_image_if_needed(self, uploaded_file, max_size=(1024, 1024)):
         """Resize image if it's too large for processing"""
         try:
-            image = Image.open(uploaded_file)
-            
-            # Check if resize is needed
-            if image.width > max_size[0] or image.height > max_size[1]:
-                # Resize while maintaining aspect ratio
-                image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                
-                # Save resized image to bytes
-                img_byte_arr = io.BytesIO()
-                image.save(img_byte_arr, format=image.format or 'JPEG')
-                img_byte_arr.seek(0)
-                
-                return img_byte_arr
-            else:
-                uploaded_file.seek(0)
-                return uploaded_file
+            # Resized in a media worker process, keeping the aspect ratio
+            result, blobs = media_worker.run('resize_image', _image_bytes(uploaded_file), max_size[0], max_size[1])
+            if result['resized']:
+                return io.BytesIO(blobs[0])
+            uploaded_file.seek(0)
+            return uploaded_file
                 
         except Exception as e:
             logging.error(f"Error resizing image: {e}")
             uploaded_file.seek(0)
             return uploaded_file
 
+    @traced("image_questions")
     def generate_therapeutic_questions(self, image_analysis):
         """Generate therapeutic questions based on image analysis"""
         try:
+            # A combined analysis already carries its questions
+            if isinstance(image_analysis, ImageAnalysis):
+                if image_analysis.questions:
+                    return image_analysis.questions_text()
+                image_analysis = image_analysis.description
+            
             prompt = f"""Based on this image analysis: "{image_analysis}"
 
 Generate 3-4 thoughtful, open-ended questions that a therapist might ask to help someone explore their feelings and thoughts about this image. The questions should:
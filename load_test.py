@@ -0,0 +1,369 @@
+"""Offline load test for the conversation turn pipeline.
+
+Drives TherapyBot, ImageHandler, AudioHandler and DatabaseManager through the
+same TurnPipeline that app.process_user_input uses, with latency-injecting local
+stand-ins for Gemini, gTTS and Google Speech Recognition. No network access or
+API keys are needed; the database defaults to a throwaway SQLite file.
+
+    python load_test.py --concurrency 16 --turns 400 --mix text=0.7,audio=0.2,image=0.1
+"""
+import os
+import io
+import sys
+import json
+import math
+import time
+import wave
+import random
+import logging
+import argparse
+import tempfile
+import threading
+import uuid
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+SAMPLE_MESSAGES = [
+    "I've been feeling really anxious about work lately",
+    "I feel so lonely since I moved to a new city",
+    "Everything is overwhelming and I can't keep up with the pressure",
+    "I get so angry and frustrated with my family",
+    "I'm feeling a bit down today",
+    "I'm worried that I'm not good enough",
+    "Feeling stressed about everything going on",
+]
+
+
+class LatencyModel:
+    def __init__(self, median, p99, error_rate=0.0):
+        """Log-normal latency with the given median and p99 (seconds) plus a transient error rate"""
+        self.mu = math.log(max(median, 1e-6))
+        # 2.326 is the z-score of the 99th percentile
+        self.sigma = max(0.0, (math.log(max(p99, median)) - self.mu) / 2.326)
+        self.error_rate = error_rate
+
+    def sleep(self):
+        time.sleep(random.lognormvariate(self.mu, self.sigma))
+
+    def maybe_fail(self):
+        if self.error_rate and random.random() < self.error_rate:
+            error = Exception("503 UNAVAILABLE (injected)")
+            error.code = 503
+            raise error
+
+
+class FakeGeminiClient:
+    def __init__(self, latency):
+        """Stand-in for genai.Client whose models.generate_content sleeps and returns canned text"""
+        self.latency = latency
+        self.models = self
+
+    def generate_content(self, model, contents, config=None):
+        self.latency.sleep()
+        self.latency.maybe_fail()
+        text = ("Primary emotions: anxiety and worry\nUrgency level: low\n"
+                "It sounds like you're carrying a lot right now. What feels heaviest today?")
+        return SimpleNamespace(
+            text=text,
+            usage_metadata=SimpleNamespace(prompt_token_count=400, candidates_token_count=60, cached_content_token_count=0)
+        )
+
+
+class FakeGTTS:
+    latency = None
+
+    def __init__(self, text, lang='en', slow=False):
+        """Stand-in for gTTS that writes MP3-sized placeholder bytes after a delay"""
+        self.text = text
+
+    def write_to_fp(self, fp):
+        FakeGTTS.latency.sleep()
+        FakeGTTS.latency.maybe_fail()
+        # ~1KB of 32kbps MP3 per 15 characters of speech
+        fp.write(b"\xff\xfb" + os.urandom(max(256, len(self.text) * 70)))
+
+
+def make_fake_recognizer(latency):
+    """Build a speech_recognition Recognizer whose Google request is replaced by a delay"""
+    import speech_recognition as sr
+
+    class FakeRecognizer(sr.Recognizer):
+        def recognize_google(self, audio_data, *args, **kwargs):
+            latency.sleep()
+            latency.maybe_fail()
+            return random.choice(SAMPLE_MESSAGES)
+
+    return FakeRecognizer()
+
+
+class FakeUpload(io.BytesIO):
+    def __init__(self, data, name, mime_type):
+        """Mimic Streamlit's UploadedFile for the handlers"""
+        super().__init__(data)
+        self.name = name
+        self.type = mime_type
+        self.size = len(data)
+
+
+def make_wav(seconds=3.0, rate=16000):
+    """Generate a mono 16-bit WAV with a tone in the middle and silence around it"""
+    frames = bytearray()
+    total = int(seconds * rate)
+    for i in range(total):
+        voiced = total * 0.2 < i < total * 0.8
+        sample = int(8000 * math.sin(2 * math.pi * 220 * i / rate)) if voiced else 0
+        frames += sample.to_bytes(2, 'little', signed=True)
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(bytes(frames))
+    return buffer.getvalue()
+
+
+def make_png(size=(800, 600)):
+    """Generate a PNG image for image turns"""
+    from PIL import Image
+    image = Image.new('RGB', size, (90, 140, 200))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(math.ceil(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class VirtualUser:
+    def __init__(self, harness):
+        """One simulated browser session with its own handlers, like a Streamlit session_state"""
+        from therapy_bot import TherapyBot
+        from audio_handler import AudioHandler
+        from image_handler import ImageHandler
+        from turn_pipeline import TurnPipeline
+
+        self.harness = harness
+        self.session_id = str(uuid.uuid4())
+        audio_handler = AudioHandler()
+        audio_handler.recognizer = make_fake_recognizer(harness.stt_latency)
+        self.pipeline = TurnPipeline(
+            TherapyBot(client=FakeGeminiClient(harness.llm_latency)),
+            audio_handler=audio_handler,
+            image_handler=ImageHandler(client=FakeGeminiClient(harness.vision_latency)),
+            db_manager=harness.db_manager,
+            memory=harness.memory
+        )
+        self.user = harness.db_manager.get_or_create_user(self.session_id)
+        self.history = []
+
+    def run_turn(self, input_type):
+        """Run one turn and return (latency_seconds, stage_timings, outcome)"""
+        from tracing import start_trace
+
+        start = time.perf_counter()
+        with start_trace("turn") as trace:
+            user_input = random.choice(SAMPLE_MESSAGES)
+            if input_type == 'audio':
+                user_input = self.pipeline.transcribe_audio(FakeUpload(self.harness.wav_bytes, 'voice.wav', 'audio/wav'))
+                if not user_input:
+                    return time.perf_counter() - start, trace.stage_totals(), 'stt_failed'
+            elif input_type == 'image':
+                upload = FakeUpload(self.harness.png_bytes, 'photo.png', 'image/png')
+                user_input = self.pipeline.analyze_image(upload, "This is where I feel calm")
+                if not user_input:
+                    return time.perf_counter() - start, trace.stage_totals(), 'image_failed'
+
+            entry, warnings = self.pipeline.process_turn(
+                user_input,
+                input_type,
+                self.history,
+                user_id=self.user.id,
+                session_id=self.session_id,
+                enable_audio_output=self.harness.audio_output
+            )
+        self.history.append(entry)
+        return time.perf_counter() - start, trace.stage_totals(), 'warning' if warnings else 'ok'
+
+
+class LoadTestHarness:
+    def __init__(self, args):
+        """Wire fake backends and the database according to the command line options"""
+        self.args = args
+        self.llm_latency = LatencyModel(args.llm_median, args.llm_p99, args.error_rate)
+        self.vision_latency = LatencyModel(args.vision_median, args.vision_p99, args.error_rate)
+        self.tts_latency = LatencyModel(args.tts_median, args.tts_p99, args.error_rate)
+        self.stt_latency = LatencyModel(args.stt_median, args.stt_p99, args.error_rate)
+        self.audio_output = not args.no_audio
+        self.mix = self._parse_mix(args.mix)
+        self.wav_bytes = make_wav()
+        self.png_bytes = make_png()
+
+        # The database module reads DATABASE_URL at import time
+        os.environ['DATABASE_URL'] = args.database_url
+        import database
+        import audio_handler
+        import audio_generator
+        audio_handler.gTTS = FakeGTTS
+        audio_generator.gTTS = FakeGTTS
+        FakeGTTS.latency = self.tts_latency
+        # Fake replies are canned text, so cached TTS would hide the backend's latency
+        from audio_cache import audio_cache
+        audio_cache.max_bytes = 0
+        # Fake TTS bytes are not decodable audio, so ffmpeg re-encoding is skipped
+        from audio_encoding import audio_encoder
+        audio_encoder.format = 'source'
+        self.db_manager = database.db_manager
+        self.db_manager.create_tables()
+        self.memory = None
+        if args.memory:
+            from memory import ConversationMemory, HashingEmbedder
+            self.memory = ConversationMemory(embedder=HashingEmbedder())
+
+    @staticmethod
+    def _parse_mix(mix):
+        weights = {}
+        for part in mix.split(','):
+            name, _, weight = part.partition('=')
+            if name.strip() not in ('text', 'audio', 'image'):
+                raise ValueError(f"Unknown input type in --mix: {name}")
+            weights[name.strip()] = float(weight or 1)
+        return weights
+
+    def run(self):
+        """Run the configured number of turns across the virtual users and return a report dict"""
+        from admission import admission_controller, BusyError
+
+        args = self.args
+        users = [VirtualUser(self) for _ in range(args.users or args.concurrency)]
+        user_locks = [threading.Lock() for _ in users]
+        kinds, weights = zip(*self.mix.items())
+        results = []
+        results_lock = threading.Lock()
+
+        def one_turn(index):
+            slot = index % len(users)
+            # A session only ever runs one turn at a time, as in the UI
+            with user_locks[slot]:
+                input_type = random.choices(kinds, weights)[0]
+                if args.rate_limit:
+                    try:
+                        admission_controller.admit_turn(users[slot].session_id)
+                    except BusyError:
+                        with results_lock:
+                            results.append((input_type, 0.0, {}, 'busy'))
+                        return
+                try:
+                    latency, timings, outcome = users[slot].run_turn(input_type)
+                except BusyError:
+                    latency, timings, outcome = 0.0, {}, 'busy'
+                except Exception as e:
+                    logging.error(f"Turn failed: {e}")
+                    latency, timings, outcome = 0.0, {}, 'error'
+                if args.think_time:
+                    time.sleep(random.uniform(0, 2 * args.think_time))
+            with results_lock:
+                results.append((input_type, latency, timings, outcome))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(one_turn, range(args.turns)))
+        elapsed = time.perf_counter() - start
+        return self._report(results, elapsed)
+
+    def _report(self, results, elapsed):
+        completed = [r for r in results if r[3] in ('ok', 'warning')]
+        latencies = [r[1] for r in completed]
+        outcomes = {}
+        for r in results:
+            outcomes[r[3]] = outcomes.get(r[3], 0) + 1
+
+        stages = {}
+        for r in completed:
+            for stage, seconds in r[2].items():
+                stages.setdefault(stage, []).append(seconds)
+
+        by_type = {}
+        for r in completed:
+            by_type.setdefault(r[0], []).append(r[1])
+
+        def summary(values):
+            return {
+                'count': len(values),
+                'mean': sum(values) / len(values) if values else 0.0,
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'p99': percentile(values, 99),
+            }
+
+        return {
+            'concurrency': self.args.concurrency,
+            'turns': len(results),
+            'elapsed_seconds': elapsed,
+            'throughput_turns_per_second': len(completed) / elapsed if elapsed else 0.0,
+            'outcomes': outcomes,
+            'latency': summary(latencies),
+            'latency_by_input_type': {k: summary(v) for k, v in by_type.items()},
+            'stages': {k: summary(v) for k, v in sorted(stages.items())},
+        }
+
+
+def print_report(report):
+    """Print a human-readable summary of a load test report"""
+    print(f"Turns: {report['turns']}  concurrency: {report['concurrency']}  elapsed: {report['elapsed_seconds']:.2f}s")
+    print(f"Throughput: {report['throughput_turns_per_second']:.2f} turns/s  outcomes: {report['outcomes']}")
+    lat = report['latency']
+    print(f"Turn latency  p50 {lat['p50'] * 1000:8.1f}ms  p95 {lat['p95'] * 1000:8.1f}ms  p99 {lat['p99'] * 1000:8.1f}ms")
+    print("\nBy input type:")
+    for name, stats in report['latency_by_input_type'].items():
+        print(f"  {name:<8} n={stats['count']:<5} p50 {stats['p50'] * 1000:8.1f}ms  p95 {stats['p95'] * 1000:8.1f}ms  p99 {stats['p99'] * 1000:8.1f}ms")
+    print("\nPer stage:")
+    for name, stats in report['stages'].items():
+        print(f"  {name:<20} n={stats['count']:<5} mean {stats['mean'] * 1000:8.1f}ms  p95 {stats['p95'] * 1000:8.1f}ms  p99 {stats['p99'] * 1000:8.1f}ms")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test for the AI Therapy Assistant turn pipeline")
+    parser.add_argument('--concurrency', type=int, default=8, help="Turns running at once")
+    parser.add_argument('--users', type=int, default=0, help="Virtual user sessions (default: same as concurrency)")
+    parser.add_argument('--turns', type=int, default=200, help="Total turns to run")
+    parser.add_argument('--mix', default='text=0.7,audio=0.2,image=0.1', help="Weighted input type mix")
+    parser.add_argument('--think-time', type=float, default=0.0, help="Mean pause between a user's turns (s)")
+    parser.add_argument('--no-audio', action='store_true', help="Disable TTS responses")
+    parser.add_argument('--rate-limit', action='store_true', help="Apply per-session admission rate limits")
+    parser.add_argument('--memory', action='store_true', help="Enable long-term memory recall with the local hashing embedder")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Injected transient error rate per backend call")
+    parser.add_argument('--llm-median', type=float, default=0.8)
+    parser.add_argument('--llm-p99', type=float, default=3.0)
+    parser.add_argument('--vision-median', type=float, default=2.0)
+    parser.add_argument('--vision-p99', type=float, default=6.0)
+    parser.add_argument('--tts-median', type=float, default=0.4)
+    parser.add_argument('--tts-p99', type=float, default=1.5)
+    parser.add_argument('--stt-median', type=float, default=0.6)
+    parser.add_argument('--stt-p99', type=float, default=2.0)
+    parser.add_argument('--database-url', default=None, help="Database URL (default: temporary SQLite file)")
+    parser.add_argument('--json', dest='json_path', help="Also write the report as JSON to this path")
+    args = parser.parse_args(argv)
+    if not args.database_url:
+        args.database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='therapy_loadtest_'), 'loadtest.db')}"
+    return args
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.WARNING)
+    args = parse_args(argv)
+    report = LoadTestHarness(args).run()
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as fh:
+            json.dump(report, fh, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,251 @@
+"""Process pool for CPU-bound media work.
+
+PIL decoding, verification and resizing, and WAV decoding, resampling and
+voice detection hold the GIL. On the Streamlit script thread, or on an API
+request thread, one large upload stalls every other session in the process.
+The image and audio handlers therefore submit these jobs to MEDIA_WORKERS
+worker processes and wait for the result.
+
+Input bytes are copied once into a shared memory block that the worker
+attaches to by name, so a multi-megabyte upload is never pickled through the
+pool's pipe. Large outputs (resized images, speech PCM) come back the same
+way. Inputs smaller than MEDIA_WORKER_MIN_BYTES run in-process, where a round
+trip to the pool would cost more than the work. MEDIA_WORKERS=0 also runs jobs
+in-process, and so does a pool that cannot start.
+"""
+import io
+import os
+import time
+import atexit
+import logging
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from metrics import metrics
+
+# Outputs at least this large are returned through shared memory instead of the pipe
+SHARED_OUTPUT_BYTES = 64 * 1024
+
+
+def inspect_image(data):
+    """Verify an image and read its header: ({'format', 'mode', 'width', 'height'}, []), or ({'error'}, [])"""
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            info = {'format': image.format, 'mode': image.mode, 'width': image.width, 'height': image.height}
+            # verify() leaves the image unusable, so the header is read first
+            image.verify()
+        return info, []
+    except Exception as e:
+        return {'error': str(e)}, []
+
+
+def resize_image(data, max_width, max_height):
+    """The image shrunk to fit max_width x max_height, in its own format; no blob when it already fits"""
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as image:
+        if image.width <= max_width and image.height <= max_height:
+            return {'resized': False, 'width': image.width, 'height': image.height}, []
+        image_format = image.format or 'JPEG'
+        image.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, format=image_format)
+        return {'resized': True, 'width': image.width, 'height': image.height}, [output.getvalue()]
+
+
+def prepare_image(data, max_width, max_height):
+    """Verify an image and shrink it to fit before upload: ({'error'}, []) when invalid, otherwise as resize_image"""
+    info, _ = inspect_image(data)
+    if 'error' in info:
+        return info, []
+    return resize_image(data, max_width, max_height)
+
+
+def prepare_speech(data):
+    """Decode a WAV recording and cut its speech into recognition chunks
+
+    Returns rate, duration and speech seconds with one PCM blob per chunk, or
+    {'wav': False} for recordings that are not WAV.
+    """
+    from vad import decode_wav, detect_speech, chunk_segments, chunk_pcm
+    clip = decode_wav(data)
+    if clip is None:
+        return {'wav': False}, []
+    segments = detect_speech(clip)
+    chunks = [chunk_pcm(clip, chunk) for chunk in chunk_segments(segments, clip.rate)]
+    speech_seconds = sum(end - begin for begin, end in segments) / clip.rate
+    return {'wav': True, 'rate': clip.rate, 'duration': clip.duration, 'speech_seconds': speech_seconds}, chunks
+
+
+def wav_duration(data):
+    """Duration in seconds of a WAV recording at its own rate, or None for other formats"""
+    from vad import decode_wav
+    clip = decode_wav(data, target_rate=None)
+    return {'duration': clip.duration if clip is not None else None}, []
+
+
+JOBS = {
+    'inspect_image': inspect_image,
+    'resize_image': resize_image,
+    'prepare_image': prepare_image,
+    'prepare_speech': prepare_speech,
+    'wav_duration': wav_duration,
+}
+
+
+def _run_shared(job, name, size, args):
+    """Worker side: run a job on input in shared memory; large outputs go back in a new block"""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        data = bytes(block.buf[:size])
+    finally:
+        block.close()
+    meta, blobs = JOBS[job](data, *args)
+    total = sum(len(blob) for blob in blobs)
+    if total < SHARED_OUTPUT_BYTES:
+        return meta, blobs, None
+    # The parent reads and unlinks the output block
+    output = shared_memory.SharedMemory(create=True, size=total)
+    try:
+        offset = 0
+        sizes = []
+        for blob in blobs:
+            output.buf[offset:offset + len(blob)] = blob
+            offset += len(blob)
+            sizes.append(len(blob))
+    except BaseException:
+        output.close()
+        output.unlink()
+        raise
+    output.close()
+    return meta, sizes, output.name
+
+
+def _discard_output(future):
+    """Free the output block of a job the parent stopped waiting for"""
+    try:
+        _, _, name = future.result()
+    except BaseException:
+        return
+    if name is not None:
+        try:
+            block = shared_memory.SharedMemory(name=name)
+            block.close()
+            block.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _collect(sizes, name):
+    """Parent side: copy the output blobs out of the worker's block and free it"""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        blobs = []
+        offset = 0
+        for size in sizes:
+            blobs.append(bytes(block.buf[offset:offset + size]))
+            offset += size
+        return blobs
+    finally:
+        block.close()
+        block.unlink()
+
+
+class _HandoffError(Exception):
+    """The input could not be placed in shared memory"""
+
+
+class MediaWorker:
+    def __init__(self, workers=2, min_bytes=256 * 1024, timeout=60.0, start_method="spawn"):
+        """Run media jobs in worker processes, handing buffers over through shared memory"""
+        self.workers = workers
+        self.min_bytes = min_bytes
+        self.timeout = timeout
+        self.start_method = start_method
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            workers=int(os.getenv("MEDIA_WORKERS", "2")),
+            min_bytes=int(os.getenv("MEDIA_WORKER_MIN_BYTES", str(256 * 1024))),
+            timeout=float(os.getenv("MEDIA_WORKER_TIMEOUT", "60")),
+            start_method=os.getenv("MEDIA_WORKER_START_METHOD", "spawn")
+        )
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None and self.workers > 0:
+                # spawn: forking a process that runs Streamlit and client threads is unsafe
+                self._pool = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context(self.start_method)
+                )
+            return self._pool
+
+    def _discard(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, job, data, *args):
+        """Run a job on data and wait for its (meta, blobs); in-process for small inputs or without a pool
+
+        Errors raised by the job and MEDIA_WORKER_TIMEOUT expiring propagate to the caller; only a pool
+        that cannot run jobs at all falls back to running them here.
+        """
+        started = time.perf_counter()
+        pool = self._get_pool() if len(data) >= self.min_bytes else None
+        if pool is not None:
+            try:
+                result = self._submit(pool, job, data, args)
+            except BrokenProcessPool as e:
+                logging.error(f"Media worker pool failed, running {job} in-process: {e}")
+                self._discard(pool)
+            except _HandoffError as e:
+                logging.error(f"Media worker handoff failed, running {job} in-process: {e}")
+            else:
+                metrics.inc("media_jobs_total", job=job, where="pool")
+                metrics.observe("media_job_seconds", time.perf_counter() - started, job=job, where="pool")
+                return result
+        result = JOBS[job](data, *args)
+        metrics.inc("media_jobs_total", job=job, where="inline")
+        metrics.observe("media_job_seconds", time.perf_counter() - started, job=job, where="inline")
+        return result
+
+    def _submit(self, pool, job, data, args):
+        try:
+            block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        except OSError as e:
+            # Shared memory unavailable (e.g. a tiny /dev/shm in a container)
+            raise _HandoffError(e)
+        try:
+            block.buf[:len(data)] = data
+            future = pool.submit(_run_shared, job, block.name, len(data), args)
+            try:
+                meta, blobs, name = future.result(self.timeout)
+            except FutureTimeoutError:
+                # The job keeps running; its output block is freed whenever it finishes
+                future.add_done_callback(_discard_output)
+                metrics.inc("media_jobs_total", job=job, where="timeout")
+                raise
+        finally:
+            block.close()
+            block.unlink()
+        if name is not None:
+            blobs = _collect(blobs, name)
+        return meta, blobs
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Process-wide pool shared by the image and audio handlers
+media_worker = MediaWorker.from_env()
+atexit.register(media_worker.shutdown)
@@ -0,0 +1,396 @@
+"""Long-term conversational memory backed by a local vector index.
+
+Every saved turn is embedded on a background pool and appended to its
+session's index (a numpy matrix of unit vectors); changed indexes are written
+to MEMORY_DIR every MEMORY_SAVE_INTERVAL seconds and at shutdown. Before a reply is generated the user's message is
+embedded and the top-k most similar earlier turns are injected into the
+prompt, so older context is recalled while the prompt stays a fixed size no
+matter how long the history grows. Embeddings come from the Gemini embedding
+model, or from a local feature-hashing embedder when MEMORY_EMBEDDER=hash or
+no API key is configured.
+"""
+import os
+import re
+import json
+import time
+import zlib
+import atexit
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from tracing import traced
+from metrics import metrics
+
+WORD = re.compile(r"[a-z0-9']+")
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+class HashingEmbedder:
+    def __init__(self, dimensions=512):
+        """Local embedder: signed feature hashing of word unigrams and bigrams"""
+        self.dimensions = dimensions
+        self.name = f"hash-{dimensions}"
+        # Sparse hashed vectors score lower than learned embeddings for the same relatedness
+        self.min_score = 0.15
+
+    def embed(self, texts, task_type=None):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = WORD.findall(text.lower())
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                digest = zlib.crc32(feature.encode('utf-8'))
+                vectors[row, digest % self.dimensions] += 1.0 if digest & 0x80000000 else -1.0
+        return _normalize(vectors)
+
+
+class GeminiEmbedder:
+    def __init__(self, client=None, model=None, dimensions=256):
+        """Embed text with the Gemini embedding model through the resilience layer"""
+        from google import genai
+        from resilience import ResilientClient, ResiliencePolicy
+
+        self.client = ResilientClient(
+            client or genai.Client(api_key=os.getenv("GEMINI_API_KEY")),
+            name="embedding",
+            policy=ResiliencePolicy.from_env("EMBEDDING", timeout=10.0)
+        )
+        self.model = model or os.getenv("MEMORY_EMBEDDING_MODEL", "gemini-embedding-001")
+        self.dimensions = dimensions
+        self.name = f"{self.model}-{dimensions}"
+        self.min_score = 0.6
+
+    def embed(self, texts, task_type="RETRIEVAL_DOCUMENT"):
+        from google.genai import types
+
+        response = self.client.call(
+            self.client.client.models.embed_content,
+            model=self.model,
+            contents=list(texts),
+            config=types.EmbedContentConfig(task_type=task_type, output_dimensionality=self.dimensions)
+        )
+        return _normalize(np.array([embedding.values for embedding in response.embeddings], dtype=np.float32))
+
+
+class VectorIndex:
+    def __init__(self, dimensions, embedder_name, capacity=64):
+        """Append-only matrix of unit vectors with brute-force cosine top-k search"""
+        self.dimensions = dimensions
+        self.embedder_name = embedder_name
+        self.vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        self.items = []
+        self.lock = threading.Lock()
+        self.dirty = False
+        # Compared with the session's forget time: an index built before it holds cleared turns
+        self.created_at = time.time()
+
+    def __len__(self):
+        return len(self.items)
+
+    def contains(self, item_id):
+        return any(item['id'] == item_id for item in self.items)
+
+    def add(self, vectors, items, max_entries=None):
+        with self.lock:
+            size = len(self.items)
+            needed = size + len(items)
+            if needed > len(self.vectors):
+                capacity = max(needed, len(self.vectors) * 2)
+                grown = np.zeros((capacity, self.dimensions), dtype=np.float32)
+                grown[:size] = self.vectors[:size]
+                self.vectors = grown
+            self.vectors[size:needed] = vectors
+            self.items.extend(items)
+            if max_entries and len(self.items) > max_entries:
+                # Forget the oldest turns first
+                drop = len(self.items) - max_entries
+                self.vectors[:max_entries] = self.vectors[drop:len(self.items)].copy()
+                self.items = self.items[drop:]
+            self.dirty = True
+
+    def search(self, query, k, exclude=(), min_score=0.0):
+        """Return [(score, item)] for the k most similar items, best first"""
+        with self.lock:
+            size = len(self.items)
+            if size == 0 or k <= 0:
+                return []
+            scores = self.vectors[:size] @ query
+            for position, item in enumerate(self.items):
+                if item['id'] in exclude or item['user'] in exclude:
+                    scores[position] = -np.inf
+            k = min(k, size)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(float(scores[i]), self.items[i]) for i in top if scores[i] >= min_score]
+
+    def save(self, path):
+        """Write the index to a temporary file and swap it in, so readers never see a partial file"""
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with self.lock:
+            size = len(self.items)
+            try:
+                with open(temp_path, 'wb') as fh:
+                    np.savez_compressed(
+                        fh,
+                        vectors=self.vectors[:size].astype(np.float16),
+                        items=np.array(json.dumps(self.items)),
+                        embedder=np.array(self.embedder_name)
+                    )
+                os.replace(temp_path, path)
+            except BaseException:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+                raise
+            self.dirty = False
+
+    @classmethod
+    def load(cls, path, embedder_name):
+        """Load a saved index, or None if it is missing or was built by a different embedder"""
+        with np.load(path, allow_pickle=False) as data:
+            if str(data['embedder']) != embedder_name:
+                return None
+            vectors = data['vectors'].astype(np.float32)
+            index = cls(vectors.shape[1], embedder_name, capacity=max(64, len(vectors)))
+            index.vectors[:len(vectors)] = vectors
+            index.items = json.loads(str(data['items']))
+        return index
+
+
+class ConversationMemory:
+    def __init__(self, embedder=None, top_k=3, min_score=None, max_entries=2000, max_users=1000, storage_dir=None, snippet_chars=300, workers=2, save_interval=30.0):
+        """Per-session long-term memory of past turns with top-k semantic recall"""
+        self._embedder = embedder
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_entries = max_entries
+        self.max_users = max_users
+        self.storage_dir = storage_dir
+        self.snippet_chars = snippet_chars
+        self._indexes = OrderedDict()
+        # session_id -> time of the last forget, used when there is no MEMORY_DIR to hold tombstones
+        self._forgotten = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="memory")
+        self.save_interval = save_interval
+        self._saver = None
+
+    @classmethod
+    def from_env(cls):
+        """Build the memory from MEMORY_* environment variables"""
+        return cls(
+            top_k=int(os.getenv("MEMORY_TOP_K", "3")),
+            min_score=float(os.getenv("MEMORY_MIN_SCORE")) if os.getenv("MEMORY_MIN_SCORE") else None,
+            max_entries=int(os.getenv("MEMORY_MAX_ENTRIES", "2000")),
+            max_users=int(os.getenv("MEMORY_MAX_USERS", "1000")),
+            storage_dir=os.getenv("MEMORY_DIR") or None,
+            snippet_chars=int(os.getenv("MEMORY_SNIPPET_CHARS", "300")),
+            save_interval=float(os.getenv("MEMORY_SAVE_INTERVAL", "30"))
+        )
+
+    @property
+    def enabled(self):
+        return self.top_k > 0
+
+    @property
+    def embedder(self):
+        # Created on first use so importing this module never needs an API key
+        if self._embedder is None:
+            choice = os.getenv("MEMORY_EMBEDDER") or ("gemini" if os.getenv("GEMINI_API_KEY") else "hash")
+            if choice == "hash":
+                self._embedder = HashingEmbedder()
+            else:
+                self._embedder = GeminiEmbedder(dimensions=int(os.getenv("MEMORY_DIMENSIONS", "256")))
+        return self._embedder
+
+    def _path(self, session_id):
+        digest = hashlib.sha1(session_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.storage_dir, f"{digest}.npz")
+
+    def _tombstone_path(self, session_id):
+        return self._path(session_id)[:-len(".npz")] + ".forgotten"
+
+    def _forgotten_at(self, session_id):
+        """When the session's memories were last forgotten by any worker sharing MEMORY_DIR, or 0"""
+        if not self.storage_dir:
+            return self._forgotten.get(session_id, 0.0)
+        try:
+            return os.path.getmtime(self._tombstone_path(session_id))
+        except OSError:
+            return 0.0
+
+    def _get_index(self, session_id, history=None):
+        """Get a session's index from memory, disk, or by embedding its loaded history"""
+        forgotten_at = self._forgotten_at(session_id)
+        with self._lock:
+            index = self._indexes.get(session_id)
+            if index is not None:
+                if index.created_at > forgotten_at:
+                    self._indexes.move_to_end(session_id)
+                    return index
+                # Another worker cleared this session since the index was built
+                self._indexes.pop(session_id)
+
+        embedder = self.embedder
+        index = None
+        if self.storage_dir and os.path.exists(self._path(session_id)):
+            try:
+                index = VectorIndex.load(self._path(session_id), embedder.name)
+            except Exception as e:
+                logging.error(f"Error loading memory index for {session_id}: {e}")
+        entries = []
+        if index is None:
+            index = VectorIndex(embedder.dimensions, embedder.name)
+            entries = [entry for entry in history or [] if entry.get('user') and entry.get('assistant')]
+
+        with self._lock:
+            existing = self._indexes.get(session_id)
+            if existing is not None:
+                index, entries = existing, []
+            self._indexes[session_id] = index
+            self._indexes.move_to_end(session_id)
+            while len(self._indexes) > self.max_users:
+                evicted_id, evicted = self._indexes.popitem(last=False)
+                self._save(evicted_id, evicted)
+        if entries:
+            # Embedding the loaded history is left to the background pool; recall finds it from the next turn on
+            self._executor.submit(self._backfill, index, entries)
+        return index
+
+    def _backfill(self, index, entries):
+        try:
+            self._add_entries(index, entries)
+            metrics.inc("memory_backfilled_turns_total", len(entries))
+            self._schedule_save()
+        except Exception as e:
+            logging.error(f"Error backfilling memories: {e}")
+
+    def _add_entries(self, index, entries):
+        texts = [f"User: {entry['user']}\nAssistant: {entry['assistant']}"[:2000] for entry in entries]
+        vectors = self.embedder.embed(texts)
+        items = [{
+            'id': str(entry.get('id') or ''),
+            'user': self._snippet(entry['user']),
+            'assistant': self._snippet(entry['assistant']),
+            'created_at': str(entry.get('created_at') or '')
+        } for entry in entries]
+        index.add(vectors, items, self.max_entries)
+
+    def _snippet(self, text):
+        return " ".join(text.split())[:self.snippet_chars]
+
+    def _save(self, session_id, index):
+        if not self.storage_dir or not index.dirty:
+            return
+        # An index built before the session was forgotten must not write the cleared turns back
+        if index.created_at <= self._forgotten_at(session_id):
+            return
+        try:
+            os.makedirs(self.storage_dir, exist_ok=True)
+            index.save(self._path(session_id))
+            if index.created_at <= self._forgotten_at(session_id):
+                # Forgotten while the file was being written
+                os.remove(self._path(session_id))
+        except Exception as e:
+            logging.error(f"Error saving memory index for {session_id}: {e}")
+
+    @traced("memory_recall")
+    def recall(self, session_id, query, conversation_history=None):
+        """Return up to top_k earlier turns relevant to query, excluding the recent ones already in the prompt"""
+        if not self.enabled or not session_id or not query:
+            return []
+        try:
+            index = self._get_index(session_id, conversation_history)
+            recent = conversation_history[-3:] if conversation_history else []
+            exclude = {str(entry['id']) for entry in recent if entry.get('id')} | {self._snippet(entry['user']) for entry in recent}
+            query_vector = self.embedder.embed([query[:2000]], task_type="RETRIEVAL_QUERY")[0]
+            min_score = self.min_score if self.min_score is not None else self.embedder.min_score
+            results = index.search(query_vector, self.top_k, exclude, min_score)
+            metrics.inc("memory_recalls_total", outcome="hit" if results else "miss")
+            return [dict(item, score=round(score, 4)) for score, item in results]
+        except Exception as e:
+            logging.error(f"Error recalling memories: {e}")
+            metrics.inc("memory_recalls_total", outcome="error")
+            return []
+
+    def _schedule_save(self):
+        """Start the periodic writer of changed indexes on first use"""
+        if not self.storage_dir:
+            return
+        with self._lock:
+            if self._saver is None:
+                self._saver = threading.Thread(target=self._run_saver, name="memory-save", daemon=True)
+                self._saver.start()
+
+    def _run_saver(self):
+        while True:
+            time.sleep(self.save_interval)
+            self.flush()
+
+    def remember(self, session_id, conversation_id, user_input, response, created_at=None, queued_at=None):
+        """Embed one saved turn and append it to the session's index
+
+        A turn queued before the session was forgotten belongs to the cleared history and is skipped.
+        """
+        try:
+            if queued_at is not None and queued_at <= self._forgotten_at(session_id):
+                return
+            index = self._get_index(session_id)
+            if conversation_id and index.contains(str(conversation_id)):
+                return
+            entry = {'id': conversation_id, 'user': user_input, 'assistant': response, 'created_at': created_at}
+            self._add_entries(index, [entry])
+            self._schedule_save()
+        except Exception as e:
+            logging.error(f"Error remembering conversation: {e}")
+
+    def remember_async(self, session_id, conversation_id, user_input, response, created_at=None):
+        """Index a turn on the background pool so it adds no latency to the reply"""
+        if not self.enabled or not session_id:
+            return None
+        return self._executor.submit(self.remember, session_id, conversation_id, user_input, response, created_at, time.time())
+
+    def forget(self, session_id):
+        """Drop a session's memories, e.g. when its conversation history is cleared
+
+        A tombstone in MEMORY_DIR records the time, so other workers drop their cached index instead of
+        saving it back, and turns queued before the forget are not indexed afterwards.
+        """
+        with self._lock:
+            self._indexes.pop(session_id, None)
+            if not self.storage_dir:
+                self._forgotten[session_id] = time.time()
+                self._forgotten.move_to_end(session_id)
+                while len(self._forgotten) > self.max_users:
+                    self._forgotten.popitem(last=False)
+        if self.storage_dir:
+            try:
+                os.makedirs(self.storage_dir, exist_ok=True)
+                with open(self._tombstone_path(session_id), 'w'):
+                    pass
+                os.utime(self._tombstone_path(session_id))
+                os.remove(self._path(session_id))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logging.error(f"Error deleting memory index for {session_id}: {e}")
+
+    def flush(self):
+        """Persist every index with unsaved turns"""
+        with self._lock:
+            indexes = list(self._indexes.items())
+        for session_id, index in indexes:
+            self._save(session_id, index)
+
+
+# Process-wide memory shared by every session
+conversation_memory = ConversationMemory.from_env()
+atexit.register(conversation_memory.flush)
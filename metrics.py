@@ -0,0 +1,154 @@
+import threading
+import bisect
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Default latency buckets (seconds) shared by every histogram
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class MetricsRegistry:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """Initialize a thread-safe registry of counters, gauges and histograms"""
+        self._lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        """Increment a counter"""
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        """Set a gauge to an absolute value"""
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] = value
+
+    def add_gauge(self, name, amount, **labels):
+        """Move a gauge up or down by amount"""
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """Record a value in a histogram"""
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+                self.histograms[key] = hist
+            hist['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def get_counter(self, name, **labels):
+        """Get the current value of a counter"""
+        with self._lock:
+            return self.counters.get(self._key(name, labels), 0)
+
+    def get_gauge(self, name, **labels):
+        """Get the current value of a gauge"""
+        with self._lock:
+            return self.gauges.get(self._key(name, labels))
+
+    def snapshot(self):
+        """Get a plain-dict copy of all metrics"""
+        def flatten(key):
+            name, labels = key
+            if not labels:
+                return name
+            return name + "{" + ",".join(f"{k}={v}" for k, v in labels) + "}"
+
+        with self._lock:
+            return {
+                'counters': {flatten(k): v for k, v in self.counters.items()},
+                'gauges': {flatten(k): v for k, v in self.gauges.items()},
+                'histograms': {flatten(k): {'count': h['count'], 'sum': h['sum']} for k, h in self.histograms.items()}
+            }
+
+    def render_prometheus(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        def fmt_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+            return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+        lines = []
+        with self._lock:
+            for kind, series in (('counter', self.counters), ('gauge', self.gauges)):
+                seen = set()
+                for (name, labels), value in sorted(series.items()):
+                    if name not in seen:
+                        lines.append(f"# TYPE {name} {kind}")
+                        seen.add(name)
+                    lines.append(f"{name}{fmt_labels(labels)} {value}")
+
+            seen = set()
+            for (name, labels), hist in sorted(self.histograms.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                cumulative = 0
+                for bound, count in zip(self.buckets, hist['counts']):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{fmt_labels(labels, [('le', str(bound))])} {cumulative}")
+                lines.append(f"{name}_bucket{fmt_labels(labels, [('le', '+Inf')])} {hist['count']}")
+                lines.append(f"{name}_sum{fmt_labels(labels)} {hist['sum']}")
+                lines.append(f"{name}_count{fmt_labels(labels)} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """Drop all recorded metrics"""
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+
+# Process-wide registry shared by all handlers and sessions
+metrics = MetricsRegistry()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = metrics
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            body = self.registry.render_prometheus().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path.split('?')[0] == '/healthz':
+            body = b'ok\n'
+            content_type = 'text/plain; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent; keep them out of the application log
+        pass
+
+
+def start_metrics_server(port, host='0.0.0.0', registry=metrics):
+    """Serve /metrics in Prometheus text format from a background thread"""
+    handler = type('MetricsRequestHandler', (_MetricsRequestHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    logging.info(f"Metrics endpoint listening on {host}:{port}/metrics")
+    return server
@@ -0,0 +1,350 @@
+"""Time-based partitioning, retention and archival for the conversations table.
+
+On PostgreSQL, conversations is a declarative RANGE partitioned table on
+created_at with one partition per month plus a DEFAULT partition. Expired
+months are archived to gzip JSON-lines files and then detached and dropped,
+so table size, index size and vacuum work stay bounded. On SQLite the same
+month boundaries are emulated with range deletes on the single table so the
+retention logic can be exercised locally.
+
+    python partitioning.py status
+    python partitioning.py migrate          # convert an existing PostgreSQL table
+    python partitioning.py retention --days 365 --archive-dir ./archive
+"""
+import os
+import re
+import sys
+import gzip
+import json
+import logging
+import argparse
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import text, inspect, select, delete
+from database import Conversation, db_manager
+
+PARTITION_NAME = re.compile(r'^conversations_y(\d{4})m(\d{2})$')
+
+
+def month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+
+def add_months(moment, months):
+    month_index = moment.year * 12 + moment.month - 1 + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"conversations_y{month.year:04d}m{month.month:02d}"
+
+
+def partitioned_table_ddl(table, dialect):
+    """CREATE TABLE ... PARTITION BY RANGE (created_at) for a SQLAlchemy table"""
+    columns = []
+    for column in table.columns:
+        definition = f"{column.name} {column.type.compile(dialect=dialect)}"
+        if not column.nullable or column.name == 'created_at':
+            definition += " NOT NULL"
+        columns.append(definition)
+    # PostgreSQL requires the partition key in every unique constraint
+    columns.append("PRIMARY KEY (id, created_at)")
+    return f"CREATE TABLE {table.name} (\n    " + ",\n    ".join(columns) + "\n) PARTITION BY RANGE (created_at)"
+
+
+class ConversationPartitionManager:
+    def __init__(self, engine, retention_days=0, archive_dir=None, months_ahead=2):
+        """Manage monthly conversation partitions and the retention policy"""
+        self.engine = engine
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+        self.months_ahead = months_ahead
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, engine):
+        """Build a manager from CONVERSATION_RETENTION_DAYS and CONVERSATION_ARCHIVE_DIR"""
+        return cls(
+            engine,
+            retention_days=int(os.getenv("CONVERSATION_RETENTION_DAYS", "0")),
+            archive_dir=os.getenv("CONVERSATION_ARCHIVE_DIR") or None,
+            months_ahead=int(os.getenv("CONVERSATION_PARTITIONS_AHEAD", "2"))
+        )
+
+    @property
+    def is_postgres(self):
+        return self.engine.dialect.name == 'postgresql'
+
+    def is_partitioned(self):
+        """Check whether conversations is a native partitioned table"""
+        if not self.is_postgres:
+            return False
+        with self.engine.connect() as conn:
+            kind = conn.execute(text("SELECT relkind FROM pg_class WHERE relname = 'conversations' AND relkind IN ('r', 'p')")).scalar()
+        return kind == 'p'
+
+    def create_partitioned_table(self):
+        """Create conversations as a partitioned table on a fresh PostgreSQL database"""
+        if not self.is_postgres or inspect(self.engine).has_table('conversations'):
+            return False
+        with self.engine.begin() as conn:
+            conn.execute(text(partitioned_table_ddl(Conversation.__table__, self.engine.dialect)))
+            conn.execute(text("CREATE TABLE IF NOT EXISTS conversations_default PARTITION OF conversations DEFAULT"))
+        logging.info("Created partitioned conversations table")
+        self.ensure_partitions()
+        return True
+
+    def ensure_partitions(self, now=None):
+        """Create partitions for the current month and the next months_ahead months"""
+        if not self.is_partitioned():
+            return []
+        current = month_start(now or datetime.utcnow())
+        created = []
+        with self.engine.begin() as conn:
+            for offset in range(self.months_ahead + 1):
+                month = add_months(current, offset)
+                created.append(self._create_partition(conn, month))
+        return [name for name in created if name]
+
+    def _create_partition(self, conn, month):
+        name = partition_name(month)
+        exists = conn.execute(text("SELECT 1 FROM pg_class WHERE relname = :name"), {'name': name}).scalar()
+        if exists:
+            return None
+        conn.execute(text(
+            f"CREATE TABLE {name} PARTITION OF conversations "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{add_months(month, 1):%Y-%m-%d}')"
+        ))
+        logging.info(f"Created partition {name}")
+        return name
+
+    def migrate_existing_table(self, keep_old=True):
+        """Convert a plain conversations table into a partitioned one, copying every row"""
+        if not self.is_postgres:
+            raise ValueError("Native partitioning requires PostgreSQL")
+        if self.is_partitioned():
+            return False
+        columns = ", ".join(column.name for column in Conversation.__table__.columns)
+        with self.engine.begin() as conn:
+            conn.execute(text("ALTER TABLE conversations RENAME TO conversations_unpartitioned"))
+            conn.execute(text("ALTER INDEX IF EXISTS ix_conversations_session_created RENAME TO ix_conversations_unpartitioned_session_created"))
+            conn.execute(text(partitioned_table_ddl(Conversation.__table__, self.engine.dialect)))
+            conn.execute(text("CREATE TABLE conversations_default PARTITION OF conversations DEFAULT"))
+            bounds = conn.execute(text("SELECT min(created_at), max(created_at) FROM conversations_unpartitioned")).one()
+            if bounds[0] is not None:
+                month = month_start(bounds[0])
+                while month <= bounds[1]:
+                    self._create_partition(conn, month)
+                    month = add_months(month, 1)
+            conn.execute(text(
+                f"INSERT INTO conversations ({columns}) "
+                f"SELECT {columns.replace('created_at', 'COALESCE(created_at, now())')} FROM conversations_unpartitioned"
+            ))
+            if not keep_old:
+                conn.execute(text("DROP TABLE conversations_unpartitioned"))
+        # Recreate indexes declared on the model; they cascade to every partition
+        for index in Conversation.__table__.indexes:
+            index.create(bind=self.engine, checkfirst=True)
+        self.ensure_partitions()
+        logging.info("Migrated conversations to a partitioned table")
+        return True
+
+    def list_partitions(self):
+        """Return [(month_start, name)] for monthly partitions, oldest first"""
+        if self.is_partitioned():
+            with self.engine.connect() as conn:
+                names = conn.execute(text(
+                    "SELECT c.relname FROM pg_inherits i "
+                    "JOIN pg_class c ON c.oid = i.inhrelid "
+                    "JOIN pg_class p ON p.oid = i.inhparent "
+                    "WHERE p.relname = 'conversations'"
+                )).scalars().all()
+            partitions = []
+            for name in names:
+                match = PARTITION_NAME.match(name)
+                if match:
+                    partitions.append((datetime(int(match.group(1)), int(match.group(2)), 1), name))
+            return sorted(partitions)
+
+        # Emulated partitions: one per month that has rows
+        with self.engine.connect() as conn:
+            bounds = conn.execute(select(Conversation.created_at).order_by(Conversation.created_at).limit(1)).scalar()
+        if bounds is None:
+            return []
+        partitions = []
+        month = month_start(bounds)
+        end = month_start(datetime.utcnow())
+        while month <= end:
+            partitions.append((month, partition_name(month)))
+            month = add_months(month, 1)
+        return partitions
+
+    def partition_sizes(self):
+        """Rows (and bytes on PostgreSQL) per partition"""
+        sizes = {}
+        with self.engine.connect() as conn:
+            for month, name in self.list_partitions():
+                if self.is_postgres:
+                    row = conn.execute(text(
+                        f"SELECT count(*), pg_total_relation_size('{name}') FROM {name}"
+                    )).one()
+                    sizes[name] = {'rows': row[0], 'bytes': row[1]}
+                else:
+                    rows = conn.execute(text(
+                        "SELECT count(*) FROM conversations WHERE created_at >= :start AND created_at < :end"
+                    ), {'start': month, 'end': add_months(month, 1)}).scalar()
+                    sizes[name] = {'rows': rows}
+        return sizes
+
+    def apply_retention(self, now=None, batch_size=5000):
+        """Archive (if configured) and drop every month that is entirely older than the retention window"""
+        if self.retention_days <= 0:
+            return []
+        cutoff = (now or datetime.utcnow()) - timedelta(days=self.retention_days)
+        expired = [(month, name) for month, name in self.list_partitions() if add_months(month, 1) <= cutoff]
+        dropped = []
+        removed_before = None
+        for month, name in expired:
+            try:
+                if self.archive_dir:
+                    self.archive_partition(month, name, batch_size)
+                self._drop_partition(month, name, batch_size)
+                dropped.append(name)
+                removed_before = add_months(month, 1)
+                logging.info(f"Retention removed partition {name}")
+            except Exception as e:
+                logging.error(f"Error applying retention to {name}: {e}")
+                break
+        # Skip the sweep after a failed month; the next run retries both in order
+        if self.is_partitioned() and len(dropped) == len(expired):
+            # Rows outside every monthly range land in the DEFAULT partition; age them out row-wise
+            boundary = month_start(cutoff)
+            try:
+                if self.archive_dir:
+                    self.archive_partition(None, "conversations_default", batch_size, before=boundary)
+                if self._delete_range(None, boundary, batch_size, partition="conversations_default"):
+                    dropped.append("conversations_default")
+                    removed_before = max(removed_before or boundary, boundary)
+            except Exception as e:
+                logging.error(f"Error applying retention to conversations_default: {e}")
+        if dropped:
+            # Dropped rows are no longer reflected in users.total_conversations or the search index
+            db_manager.reconcile_conversation_counts()
+            if db_manager.search.enabled:
+                with self.engine.begin() as conn:
+                    conn.execute(db_manager.search.prune_statement(removed_before))
+        return dropped
+
+    def archive_partition(self, month, name, batch_size=5000, before=None):
+        """Stream one month (or, with before, older default-partition rows) to <archive_dir>/<name>.jsonl.gz"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        if before is not None:
+            path = os.path.join(self.archive_dir, f"{name}_before_{before:%Y%m%d}_{datetime.utcnow():%Y%m%d%H%M%S}.jsonl.gz")
+            source = text(f"SELECT * FROM {name} WHERE created_at < :before").bindparams(before=before).columns(*Conversation.__table__.columns)
+        elif self.is_partitioned():
+            path = os.path.join(self.archive_dir, f"{name}.jsonl.gz")
+            # Typed columns so compressed text is archived in its readable form
+            source = text(f"SELECT * FROM {name}").columns(*Conversation.__table__.columns)
+        else:
+            path = os.path.join(self.archive_dir, f"{name}.jsonl.gz")
+            source = (
+                select(Conversation.__table__)
+                .where(Conversation.created_at >= month)
+                .where(Conversation.created_at < add_months(month, 1))
+            )
+        rows = 0
+        temp_path = path + ".partial"
+        with self.engine.connect() as conn, gzip.open(temp_path, 'wt', encoding='utf-8') as fh:
+            result = conn.execution_options(yield_per=batch_size).execute(source)
+            for row in result.mappings():
+                fh.write(json.dumps(dict(row), default=str) + "\n")
+                rows += 1
+        # Only publish the archive once it is complete
+        os.replace(temp_path, path)
+        logging.info(f"Archived {rows} conversations from {name} to {path}")
+        return path
+
+    def _drop_partition(self, month, name, batch_size):
+        if self.is_partitioned():
+            with self.engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE conversations DETACH PARTITION {name}"))
+                conn.execute(text(f"DROP TABLE {name}"))
+            return
+        # Emulation: delete the month in bounded chunks so locks stay short
+        self._delete_range(month, add_months(month, 1), batch_size)
+
+    def _delete_range(self, start, end, batch_size, partition=None):
+        """Delete conversations with start <= created_at < end in chunks, returning the row count
+
+        With partition, only rows stored in that partition are deleted (the rows archive_partition read).
+        """
+        total = 0
+        while True:
+            with self.engine.begin() as conn:
+                if partition is not None:
+                    since = " AND created_at >= :start" if start is not None else ""
+                    deleted = conn.execute(text(
+                        f"DELETE FROM {partition} WHERE id IN "
+                        f"(SELECT id FROM {partition} WHERE created_at < :end{since} LIMIT :limit)"
+                    ), {'end': end, 'start': start, 'limit': batch_size}).rowcount
+                else:
+                    chunk = select(Conversation.id).where(Conversation.created_at < end)
+                    if start is not None:
+                        chunk = chunk.where(Conversation.created_at >= start)
+                    chunk = chunk.limit(batch_size).scalar_subquery()
+                    deleted = conn.execute(delete(Conversation).where(Conversation.id.in_(chunk))).rowcount
+            total += deleted
+            if deleted < batch_size:
+                return total
+
+    def start_maintenance(self, interval):
+        """Create upcoming partitions and apply retention every interval seconds in a background thread"""
+        if self._thread is not None or interval <= 0:
+            return
+
+        def run():
+            while True:
+                try:
+                    self.ensure_partitions()
+                    self.apply_retention()
+                except Exception as e:
+                    logging.error(f"Partition maintenance failed: {e}")
+                time.sleep(interval)
+
+        self._thread = threading.Thread(target=run, name="partition-maintenance", daemon=True)
+        self._thread.start()
+
+
+partition_manager = ConversationPartitionManager.from_env(db_manager.engine)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Conversation partition maintenance")
+    parser.add_argument('command', choices=['status', 'ensure', 'migrate', 'retention'])
+    parser.add_argument('--days', type=int, default=None, help="Retention window in days (overrides CONVERSATION_RETENTION_DAYS)")
+    parser.add_argument('--archive-dir', default=None, help="Archive expired months here before dropping them")
+    parser.add_argument('--drop-old-table', action='store_true', help="With migrate: drop the unpartitioned copy")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    manager = partition_manager
+    if args.days is not None:
+        manager.retention_days = args.days
+    if args.archive_dir:
+        manager.archive_dir = args.archive_dir
+
+    if args.command == 'status':
+        print(f"Native partitioning: {manager.is_partitioned()}")
+        for name, size in manager.partition_sizes().items():
+            print(f"  {name}: {size}")
+    elif args.command == 'ensure':
+        print(f"Created: {manager.ensure_partitions()}")
+    elif args.command == 'migrate':
+        print(f"Migrated: {manager.migrate_existing_table(keep_old=not args.drop_old_table)}")
+    elif args.command == 'retention':
+        print(f"Removed: {manager.apply_retention()}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
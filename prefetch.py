@@ -0,0 +1,184 @@
+"""Speculative, low-priority prefetch of turn enrichment audio.
+
+When a reply is produced, the audio the user is likely to want next (the
+top catalog songs and remedies) is rendered into the shared audio cache by a
+background worker, so the matching buttons play instantly. The spoken reply
+itself is rendered on the turn's own path, not here. Prefetch work only
+starts while the TTS backend has spare slots. A session that starts a new
+turn or clears its history withdraws from its queued tasks; a task is dropped
+once no session still waits for it.
+"""
+import os
+import time
+import logging
+import itertools
+import threading
+from queue import PriorityQueue, Empty
+from concurrent.futures import Future
+from admission import admission_controller
+from audio_cache import audio_cache, song_key, remedy_key
+from metrics import metrics
+
+# Lower runs first
+PRIORITY_SONG = 1
+PRIORITY_REMEDY = 2
+
+
+class _Task:
+    __slots__ = ('waiters', 'key', 'fn', 'args', 'future', 'created')
+
+    def __init__(self, key, fn, args):
+        # Sessions that scheduled this key, with their turn generation at the time
+        self.waiters = {}
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.future = Future()
+        self.created = time.monotonic()
+
+
+class Prefetcher:
+    def __init__(self, workers=1, tts_reserve=2, max_age=60.0, busy_delay=0.25, top_n=3):
+        """Background renderer that fills the audio cache ahead of button clicks"""
+        self.workers = workers
+        self.tts_reserve = tts_reserve
+        self.max_age = max_age
+        self.busy_delay = busy_delay
+        self.top_n = top_n
+        self._queue = PriorityQueue()
+        self._sequence = itertools.count()
+        # Only sessions with queued tasks have entries, so neither dict grows with the number of sessions
+        self._generations = {}
+        self._pending = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._audio_generator = None
+
+    @classmethod
+    def from_env(cls):
+        """Build a prefetcher from PREFETCH_* environment variables"""
+        return cls(
+            workers=int(os.getenv("PREFETCH_WORKERS", "1")),
+            tts_reserve=int(os.getenv("PREFETCH_TTS_RESERVE", "2")),
+            max_age=float(os.getenv("PREFETCH_MAX_AGE", "60")),
+            top_n=int(os.getenv("PREFETCH_CATALOG_ITEMS", "3"))
+        )
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._threads:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"prefetch-{number}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def schedule(self, session_id, priority, key, fn, *args):
+        """Queue fn(*args) to fill key unless it is cached; returns a Future for its audio"""
+        with self._lock:
+            generation = self._generations.get(session_id, 0)
+            existing = self._tasks.get(key)
+            if existing is not None:
+                # Shared with the sessions already waiting; this one keeps it alive too
+                if session_id not in existing.waiters:
+                    self._pending[session_id] = self._pending.get(session_id, 0) + 1
+                existing.waiters[session_id] = generation
+                return existing.future
+            task = _Task(key, fn, args)
+            task.waiters[session_id] = generation
+            self._pending[session_id] = self._pending.get(session_id, 0) + 1
+            self._tasks[key] = task
+        if key in audio_cache:
+            self._finish(task, audio_cache.get(key))
+            return task.future
+        self._ensure_started()
+        self._queue.put((priority, next(self._sequence), task))
+        metrics.inc("prefetch_tasks_total", outcome="scheduled")
+        return task.future
+
+    def cancel(self, session_id):
+        """Withdraw a session from its queued tasks (a new turn or a cleared history)"""
+        with self._lock:
+            # Nothing queued means nothing to withdraw from
+            if session_id in self._pending:
+                self._generations[session_id] = self._generations.get(session_id, 0) + 1
+
+    def _is_stale(self, task):
+        """True once every session that scheduled the task has moved on"""
+        with self._lock:
+            return all(self._generations.get(session_id, 0) != generation for session_id, generation in task.waiters.items())
+
+    def _finish(self, task, result=None, error=None, outcome=None):
+        with self._lock:
+            if self._tasks.get(task.key) is task:
+                del self._tasks[task.key]
+                for session_id in task.waiters:
+                    self._pending[session_id] -= 1
+                    if not self._pending[session_id]:
+                        del self._pending[session_id]
+                        self._generations.pop(session_id, None)
+        if outcome:
+            metrics.inc("prefetch_tasks_total", outcome=outcome)
+        if error is not None:
+            task.future.set_exception(error)
+        elif outcome in ("cancelled", "expired"):
+            task.future.cancel()
+        else:
+            task.future.set_result(result)
+
+    def _run(self):
+        while True:
+            try:
+                priority, sequence, task = self._queue.get(timeout=5.0)
+            except Empty:
+                continue
+            if self._is_stale(task):
+                self._finish(task, outcome="cancelled")
+                continue
+            if time.monotonic() - task.created > self.max_age:
+                self._finish(task, outcome="expired")
+                continue
+            if not admission_controller.has_capacity("tts", self.tts_reserve):
+                # Foreground requests come first; look again shortly
+                time.sleep(self.busy_delay)
+                self._queue.put((priority, sequence, task))
+                continue
+            try:
+                self._finish(task, task.fn(*task.args), outcome="completed")
+            except Exception as e:
+                logging.warning(f"Prefetch of {task.key[:40]!r} failed: {e}")
+                self._finish(task, error=e, outcome="failed")
+
+    def prefetch_enrichment(self, session_id, soothing_content, emotion_type):
+        """Render audio for the top songs and remedies shown with a reply"""
+        if not soothing_content:
+            return
+        if self._audio_generator is None:
+            from audio_generator import AudioGenerator
+            self._audio_generator = AudioGenerator()
+        generator = self._audio_generator
+        # Same arguments as the buttons in app.main so the cache keys match
+        for song in soothing_content.get('songs', ())[:self.top_n]:
+            self.schedule(session_id, PRIORITY_SONG, song_key(song, emotion_type), generator.create_song_audio, song, emotion_type)
+        for remedy in soothing_content.get('remedies', ())[:self.top_n]:
+            self.schedule(session_id, PRIORITY_REMEDY, remedy_key(remedy), generator.create_remedy_audio, remedy)
+
+    def result(self, key, timeout=0.0):
+        """Audio for key from the cache, waiting up to timeout for a prefetch in flight"""
+        data = audio_cache.get(key)
+        if data is not None or not timeout:
+            return data
+        with self._lock:
+            task = self._tasks.get(key)
+        if task is None:
+            return audio_cache.get(key)
+        try:
+            return task.future.result(timeout)
+        except Exception:
+            return None
+
+
+# Process-wide prefetcher shared by every session
+prefetcher = Prefetcher.from_env()
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() in ('1', 'true', 'yes')
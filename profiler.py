@@ -0,0 +1,164 @@
+"""Opt-in sampling profiler for slow turns.
+
+Wrapped entry points (the app's turn handler, the service turns and the
+image, audio and reply handlers) are profiled when PROFILE_SAMPLE_RATE picks
+the call or PROFILE_SLOW_SECONDS is set. One background thread samples the
+Python stack of every profiled thread each PROFILE_INTERVAL_MS. When the call
+finishes, the profile is kept if the call was sampled by rate or ran longer
+than PROFILE_SLOW_SECONDS. It is written as collapsed stacks ("a;b;c 12" per
+line) that flamegraph.pl, speedscope and inferno read directly. The oldest
+files are pruned past PROFILE_MAX_FILES or PROFILE_MAX_MB. With neither
+trigger set a hook is a single attribute check.
+
+Only the thread that entered the hook is sampled; time spent waiting on model
+calls, TTS or the database shows up as the frame that waits for them.
+"""
+import os
+import sys
+import time
+import random
+import logging
+import threading
+import functools
+from collections import Counter
+from contextlib import contextmanager
+from metrics import metrics
+
+
+class SamplingProfiler:
+    def __init__(self, directory="profiles", sample_rate=0.0, slow_seconds=None, interval=0.01,
+                 max_files=50, max_bytes=20 * 1024 * 1024, max_depth=96):
+        """Sample stacks of hooked calls and keep the sampled or slow ones as .folded files"""
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.interval = interval
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_depth = max_depth
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls):
+        slow = os.getenv("PROFILE_SLOW_SECONDS")
+        return cls(
+            directory=os.getenv("PROFILE_DIR", "profiles"),
+            sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+            slow_seconds=float(slow) if slow else None,
+            interval=float(os.getenv("PROFILE_INTERVAL_MS", "10")) / 1000.0,
+            max_files=int(os.getenv("PROFILE_MAX_FILES", "50")),
+            max_bytes=int(float(os.getenv("PROFILE_MAX_MB", "20")) * 1024 * 1024)
+        )
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 or self.slow_seconds is not None
+
+    def configure(self, sample_rate=0.0, slow_seconds=None):
+        """Replace both triggers at runtime, e.g. from a debugging shell; the defaults turn profiling off"""
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+
+    @contextmanager
+    def profile(self, name):
+        """Profile the enclosed code on this thread; nested hooks join the outer profile"""
+        if not self.enabled:
+            yield
+            return
+        ident = threading.get_ident()
+        sampled = random.random() < self.sample_rate
+        if ident in self._active or (not sampled and self.slow_seconds is None):
+            yield
+            return
+
+        stacks = Counter()
+        with self._lock:
+            self._active[ident] = stacks
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                self._active.pop(ident, None)
+            if stacks and (sampled or (self.slow_seconds is not None and duration >= self.slow_seconds)):
+                self._write(name, duration, stacks)
+
+    def _run(self):
+        while True:
+            if not self._active:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            self._sample()
+            time.sleep(self.interval)
+
+    def _sample(self):
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, stacks in self._active.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks[self._collapse(frame)] += 1
+
+    def _collapse(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def _write(self, name, duration, stacks):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(
+                self.directory,
+                f"{time.strftime('%Y%m%dT%H%M%S')}-{int(time.time() * 1000) % 1000:03d}-{name}-{int(duration * 1000)}ms.folded"
+            )
+            with open(path, 'w', encoding='utf-8') as fh:
+                for stack, count in stacks.most_common():
+                    fh.write(f"{stack} {count}\n")
+            metrics.inc("profiles_written_total", hook=name)
+            logging.info(f"Wrote {sum(stacks.values())}-sample profile of {name} ({duration:.2f}s) to {path}")
+            self._prune()
+        except Exception as e:
+            logging.error(f"Error writing profile: {e}")
+
+    def _prune(self):
+        """Delete the oldest profiles beyond the file count and size limits"""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".folded") and entry.is_file():
+                info = entry.stat()
+                files.append((info.st_mtime, info.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        while files and (len(files) > self.max_files or total > self.max_bytes):
+            _, size, path = files.pop(0)
+            os.remove(path)
+            total -= size
+
+
+# Process-wide profiler shared by every hook
+profiler = SamplingProfiler.from_env()
+
+
+def profiled(name):
+    """Decorator that runs a function under profiler.profile(name)"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return fn(*args, **kwargs)
+            with profiler.profile(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,240 @@
+import os
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from metrics import metrics
+from admission import admission_controller
+from token_usage import effective_model, record_usage
+
+# HTTP status codes worth retrying (timeouts, rate limits and server errors)
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Shared worker pool that runs model attempts so they can be abandoned on deadline
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("MODEL_CALL_WORKERS", "32")),
+    thread_name_prefix="model-call"
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the backend circuit is open"""
+
+
+class DeadlineExceededError(TimeoutError):
+    """Raised when a model call does not finish within its deadline"""
+
+
+def is_retryable(error):
+    """Check whether a model call error is transient and worth retrying"""
+    if isinstance(error, (DeadlineExceededError, TimeoutError, ConnectionError)):
+        return True
+    code = getattr(error, 'code', None)
+    return isinstance(code, int) and code in RETRYABLE_STATUS_CODES
+
+
+class ResiliencePolicy:
+    def __init__(self, timeout=30.0, max_attempts=3, base_backoff=0.5, max_backoff=8.0, hedge_delay=None):
+        """Per-backend deadline, retry and hedging settings"""
+        self.timeout = timeout
+        self.max_attempts = max(1, max_attempts)
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.hedge_delay = hedge_delay
+
+    @classmethod
+    def from_env(cls, prefix, **defaults):
+        """Build a policy from <PREFIX>_TIMEOUT, <PREFIX>_MAX_ATTEMPTS and <PREFIX>_HEDGE_DELAY"""
+        policy = cls(**defaults)
+        if os.getenv(f"{prefix}_TIMEOUT"):
+            policy.timeout = float(os.getenv(f"{prefix}_TIMEOUT"))
+        if os.getenv(f"{prefix}_MAX_ATTEMPTS"):
+            policy.max_attempts = max(1, int(os.getenv(f"{prefix}_MAX_ATTEMPTS")))
+        if os.getenv(f"{prefix}_HEDGE_DELAY"):
+            policy.hedge_delay = float(os.getenv(f"{prefix}_HEDGE_DELAY")) or None
+        return policy
+
+    def backoff(self, attempt):
+        """Full-jitter exponential backoff for the given retry number"""
+        ceiling = min(self.max_backoff, self.base_backoff * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        """Initialize a breaker that opens after consecutive transient failures"""
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._publish()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow_request(self):
+        """Check whether a call may go through, letting a single probe through when half-open"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if self.clock() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = False
+                self._publish()
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            if self._state != self.CLOSED:
+                logging.info(f"Circuit '{self.name}' closed")
+                self._state = self.CLOSED
+                self._publish()
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logging.warning(f"Circuit '{self.name}' opened after {self._failures} failures")
+                    metrics.inc("circuit_open_total", backend=self.name)
+                self._state = self.OPEN
+                self._opened_at = self.clock()
+                self._publish()
+
+    def _publish(self):
+        states = (self.CLOSED, self.HALF_OPEN, self.OPEN)
+        metrics.set_gauge("circuit_state", states.index(self._state), backend=self.name)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """Get the process-wide circuit breaker for a backend, shared by every session"""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")),
+                reset_timeout=float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+            )
+        return _breakers[name]
+
+
+class _ResilientModels:
+    def __init__(self, owner):
+        self._owner = owner
+
+    def generate_content(self, **kwargs):
+        # A user over their daily budget is served by the cheaper fallback model
+        kwargs['model'] = effective_model(kwargs.get('model'))
+        response = self._owner.call(self._owner.client.models.generate_content, **kwargs)
+        # Only the winning attempt is counted; a losing hedged request may also be billed
+        record_usage(kwargs['model'], response)
+        return response
+
+
+class ResilientClient:
+    def __init__(self, client, name, policy=None, breaker=None, sleep=time.sleep):
+        """Wrap a Gemini client so model calls get deadlines, retries, hedging and a circuit breaker"""
+        self.client = client
+        self.name = name
+        self.policy = policy or ResiliencePolicy()
+        self.breaker = breaker or get_breaker(name)
+        self.sleep = sleep
+        self.models = _ResilientModels(self)
+
+    def call(self, fn, *args, **kwargs):
+        """Run fn with the configured policy, raising the last error when all attempts fail"""
+        # Hold a backend concurrency slot for the whole call, retries included
+        with admission_controller.slot(self.name):
+            return self._call(fn, args, kwargs)
+
+    def _call(self, fn, args, kwargs):
+        if not self.breaker.allow_request():
+            metrics.inc("model_calls_total", backend=self.name, outcome="rejected")
+            raise CircuitOpenError(f"Circuit for '{self.name}' is open")
+
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                result = self._attempt(fn, args, kwargs)
+            except Exception as e:
+                retryable = is_retryable(e)
+                if retryable:
+                    self.breaker.record_failure()
+                else:
+                    # The backend answered, so it is healthy even though the request was bad
+                    self.breaker.record_success()
+                attempt += 1
+                if not retryable or attempt >= self.policy.max_attempts or not self.breaker.allow_request():
+                    outcome = "timeout" if isinstance(e, DeadlineExceededError) else "error"
+                    metrics.inc("model_calls_total", backend=self.name, outcome=outcome)
+                    metrics.observe("model_call_seconds", time.monotonic() - start, backend=self.name)
+                    raise
+                delay = self.policy.backoff(attempt - 1)
+                logging.warning(f"Retrying '{self.name}' call in {delay:.2f}s after error: {e}")
+                metrics.inc("model_call_retries_total", backend=self.name)
+                self.sleep(delay)
+                continue
+
+            self.breaker.record_success()
+            metrics.inc("model_calls_total", backend=self.name, outcome="success")
+            metrics.observe("model_call_seconds", time.monotonic() - start, backend=self.name)
+            return result
+
+    def _attempt(self, fn, args, kwargs):
+        """Run one attempt under the deadline, optionally hedged with a second request"""
+        deadline = time.monotonic() + self.policy.timeout
+        pending = {_executor.submit(fn, *args, **kwargs)}
+
+        if self.policy.hedge_delay is not None and self.policy.hedge_delay < self.policy.timeout:
+            done, _ = wait(pending, timeout=self.policy.hedge_delay)
+            if not done:
+                metrics.inc("model_call_hedges_total", backend=self.name)
+                pending.add(_executor.submit(fn, *args, **kwargs))
+
+        last_error = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+                last_error = error
+
+        if pending:
+            # Abandon in-flight requests; their worker threads finish in the background
+            for future in pending:
+                future.cancel()
+            raise DeadlineExceededError(f"'{self.name}' call exceeded {self.policy.timeout}s deadline")
+        raise last_error
@@ -0,0 +1,222 @@
+"""Full-text search over conversation history.
+
+Search documents live in a side table, conversation_search, written in the
+same transaction as each conversation so the index is maintained
+incrementally. On PostgreSQL it holds a weighted tsvector (user text 'A',
+reply 'B') under a GIN index that also covers session_id when the btree_gin
+extension is available; on SQLite it is an FTS5 table with the porter
+tokenizer. Keeping documents out of conversations means search keeps working
+when the text columns are compressed and when conversations is partitioned.
+
+    python search.py rebuild      # index conversations saved before search existed
+"""
+import re
+import sys
+import logging
+import argparse
+from datetime import datetime
+from sqlalchemy import text
+
+SEARCH_TABLE = "conversation_search"
+WORD = re.compile(r"\w+", re.UNICODE)
+MAX_TERMS = 16
+
+
+def query_terms(query):
+    """Lowercased search words, capped so one request cannot build a huge query"""
+    return WORD.findall((query or "").lower())[:MAX_TERMS]
+
+
+def _fts5_phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def make_snippet(content, terms, width=160):
+    """Cut a window of content around the first matching word and bold every match"""
+    if not content:
+        return ""
+    # Match stems loosely so "worried" highlights "worry" the way the stemmed index matched it
+    stems = [term[:max(3, len(term) - 2)] for term in terms]
+    pattern = re.compile(r"\b(" + "|".join(re.escape(stem) for stem in stems) + r")\w*", re.IGNORECASE) if stems else None
+    match = pattern.search(content) if pattern else None
+    start = 0
+    if match and match.start() > width // 3:
+        start = content.rfind(" ", 0, match.start() - width // 3) + 1
+    window = content[start:start + width]
+    if start + width < len(content):
+        window = window[:window.rfind(" ")] if " " in window else window
+    window = " ".join(window.split())
+    if pattern:
+        window = pattern.sub(lambda m: f"**{m.group(0)}**", window)
+    return ("…" if start > 0 else "") + window + ("…" if start + width < len(content) else "")
+
+
+class ConversationSearch:
+    def __init__(self, engine, language="english"):
+        """Build and query the conversation full-text index for the engine's dialect"""
+        self.engine = engine
+        self.dialect = engine.dialect.name
+        self.language = language
+        self.enabled = False
+
+    def create(self):
+        """Create the search table and indexes if needed; disables search on failure"""
+        try:
+            if self.dialect == 'postgresql':
+                self._create_postgres()
+            elif self.dialect == 'sqlite':
+                with self.engine.begin() as conn:
+                    conn.execute(text(
+                        f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+                        "user_text, ai_text, session_key, "
+                        "conversation_id UNINDEXED, created_at UNINDEXED, "
+                        "tokenize='porter unicode61')"
+                    ))
+            else:
+                logging.warning(f"Full-text search is not supported on {self.dialect}")
+                return False
+            self.enabled = True
+        except Exception as e:
+            logging.error(f"Error creating conversation search index: {e}")
+            self.enabled = False
+        return self.enabled
+
+    def _create_postgres(self):
+        with self.engine.begin() as conn:
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ("
+                "conversation_id UUID PRIMARY KEY, "
+                "session_id VARCHAR(255) NOT NULL, "
+                "created_at TIMESTAMP NOT NULL, "
+                "document TSVECTOR NOT NULL)"
+            ))
+        try:
+            # One GIN index over (session_id, document) answers "this user's matches" directly
+            with self.engine.begin() as conn:
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gin"))
+                conn.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_session_document "
+                    f"ON {SEARCH_TABLE} USING GIN (session_id, document)"
+                ))
+        except Exception as e:
+            logging.warning(f"btree_gin unavailable, indexing search documents separately: {e}")
+            with self.engine.begin() as conn:
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_document ON {SEARCH_TABLE} USING GIN (document)"))
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_session ON {SEARCH_TABLE} (session_id)"))
+        with self.engine.begin() as conn:
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_created ON {SEARCH_TABLE} (created_at)"))
+
+    def table_exists(self, conn):
+        """Mark search enabled if the index table already exists (for managers that do not create it)"""
+        from sqlalchemy import inspect
+        self.enabled = self.dialect in ('postgresql', 'sqlite') and inspect(conn).has_table(SEARCH_TABLE)
+        return self.enabled
+
+    def index_statement(self, conversation_id, session_id, created_at, user_input, ai_response):
+        """Statement adding one conversation to the index, run in the saving transaction"""
+        if self.dialect == 'postgresql':
+            return text(
+                f"INSERT INTO {SEARCH_TABLE} (conversation_id, session_id, created_at, document) "
+                "VALUES (:conversation_id, :session_id, :created_at, "
+                "setweight(to_tsvector(CAST(:language AS regconfig), :user_input), 'A') || "
+                "setweight(to_tsvector(CAST(:language AS regconfig), :ai_response), 'B')) "
+                "ON CONFLICT (conversation_id) DO NOTHING"
+            ).bindparams(
+                conversation_id=str(conversation_id), session_id=session_id, created_at=created_at,
+                language=self.language, user_input=user_input, ai_response=ai_response
+            )
+        return text(
+            f"INSERT INTO {SEARCH_TABLE} (user_text, ai_text, session_key, conversation_id, created_at) "
+            "VALUES (:user_input, :ai_response, :session_id, :conversation_id, :created_at)"
+        ).bindparams(
+            user_input=user_input, ai_response=ai_response, session_id=session_id,
+            conversation_id=str(conversation_id), created_at=created_at.isoformat(' ')
+        )
+
+    def _session_match(self, session_id):
+        # Narrows candidates through the index; the tokenized phrase is not exact, so callers also compare session_key
+        return f"session_key : {_fts5_phrase(session_id)}"
+
+    def search_statement(self, session_id, query, limit, offset=0):
+        """Statement returning (conversation_id, created_at, rank) best first, or None for an empty query"""
+        terms = query_terms(query)
+        if not terms:
+            return None
+        # The last word is a prefix so results appear while the user is still typing
+        if self.dialect == 'postgresql':
+            tsquery = " & ".join([f"'{term}'" for term in terms[:-1]] + [f"'{terms[-1]}':*"])
+            return text(
+                f"SELECT s.conversation_id, s.created_at, ts_rank_cd(s.document, q) AS rank "
+                f"FROM {SEARCH_TABLE} s, to_tsquery(CAST(:language AS regconfig), :query) q "
+                "WHERE s.session_id = :session_id AND s.document @@ q "
+                "ORDER BY rank DESC, s.created_at DESC LIMIT :limit OFFSET :offset"
+            ).bindparams(language=self.language, query=tsquery, session_id=session_id, limit=limit, offset=offset)
+        words = " AND ".join(_fts5_phrase(term) for term in terms[:-1])
+        last = _fts5_phrase(terms[-1]) + "*"
+        terms_match = f"({words} AND {last})" if words else last
+        match = f"{self._session_match(session_id)} AND {{user_text ai_text}} : {terms_match}"
+        # bm25 is lower-is-better; negate so rank is higher-is-better on both backends
+        return text(
+            f"SELECT conversation_id, created_at, -bm25({SEARCH_TABLE}, 2.0, 1.0, 0.0) AS rank "
+            f"FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :match AND session_key = :session_id "
+            "ORDER BY rank DESC, created_at DESC LIMIT :limit OFFSET :offset"
+        ).bindparams(match=match, session_id=session_id, limit=limit, offset=offset)
+
+    def delete_session_statement(self, session_id):
+        if self.dialect == 'postgresql':
+            return text(f"DELETE FROM {SEARCH_TABLE} WHERE session_id = :session_id").bindparams(session_id=session_id)
+        return text(
+            f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN "
+            f"(SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :match AND session_key = :session_id)"
+        ).bindparams(match=self._session_match(session_id), session_id=session_id)
+
+    def prune_statement(self, before):
+        """Statement removing documents of conversations older than before (retention)"""
+        if self.dialect == 'postgresql':
+            return text(f"DELETE FROM {SEARCH_TABLE} WHERE created_at < :before").bindparams(before=before)
+        return text(f"DELETE FROM {SEARCH_TABLE} WHERE created_at < :before").bindparams(before=before.isoformat(' '))
+
+    def rebuild(self, batch_size=1000):
+        """Index every conversation that is missing from the search table"""
+        from sqlalchemy import select
+        from database import Conversation
+
+        if not self.enabled and not self.create():
+            return 0
+        with self.engine.connect() as conn:
+            indexed = {str(value) for value in conn.execute(text(f"SELECT conversation_id FROM {SEARCH_TABLE}")).scalars()}
+        added = 0
+        last_id = None
+        while True:
+            query = select(Conversation.__table__).order_by(Conversation.id).limit(batch_size)
+            if last_id is not None:
+                query = query.where(Conversation.id > last_id)
+            with self.engine.begin() as conn:
+                rows = conn.execute(query).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                for row in rows:
+                    if str(row.id) in indexed:
+                        continue
+                    conn.execute(self.index_statement(
+                        row.id, row.session_id, row.created_at or datetime.utcnow(), row.user_input, row.ai_response
+                    ))
+                    added += 1
+            logging.info(f"Search rebuild: {added} conversations indexed")
+        return added
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Conversation full-text search maintenance")
+    parser.add_argument('command', choices=['rebuild'])
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    from database import db_manager
+    print(f"Indexed {db_manager.search.rebuild(args.batch_size)} conversations")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,273 @@
+"""UI-independent entry points for the therapy assistant.
+
+TherapyService owns the process-wide bot, handlers and turn pipeline and
+exposes each user action (text, audio and image turns, history, stats,
+feedback, search and on-demand audio) as a plain method. The HTTP API in
+api.py serves it from any number of worker processes, and the Streamlit app
+calls either it directly or ApiClient, which has the same methods.
+"""
+import os
+import time
+import uuid
+import logging
+from datetime import datetime
+from therapy_bot import TherapyBot
+from audio_handler import AudioHandler
+from image_handler import ImageHandler
+from audio_generator import AudioGenerator
+from turn_pipeline import TurnPipeline
+from memory import conversation_memory
+from prefetch import prefetcher, PREFETCH_ENABLED
+from admission import admission_controller
+from tracing import start_trace
+from session_store import session_store, compact_entry
+from audio_cache import audio_id, speech_key
+from token_usage import usage_budget
+from profiler import profiled
+
+# Earlier exchanges loaded for a turn when the caller does not supply its own history
+HISTORY_WINDOW = int(os.getenv("API_HISTORY_WINDOW", "10"))
+# Seconds a turn waits for its background-rendered reply audio before returning without it
+AUDIO_WAIT = float(os.getenv("API_AUDIO_WAIT", "15"))
+
+
+class UploadedMedia:
+    def __init__(self, data, name="upload", type="application/octet-stream"):
+        """Uploaded bytes with the read()/getvalue()/type surface the handlers expect"""
+        self.data = data
+        self.name = name
+        self.type = type
+
+    def read(self):
+        return self.data
+
+    def getvalue(self):
+        return self.data
+
+
+class TranscriptionError(Exception):
+    """Raised when an audio turn could not be transcribed"""
+
+
+class ImageAnalysisError(Exception):
+    """Raised when an image turn could not be analyzed"""
+
+
+class TherapyService:
+    def __init__(self, therapy_bot=None, audio_handler=None, image_handler=None, db=None, memory=None, prefetch=None, sessions=None):
+        """Build the shared handlers and pipeline; db is None when the database is unavailable"""
+        self.therapy_bot = therapy_bot or TherapyBot()
+        self.audio_handler = audio_handler or AudioHandler()
+        self.image_handler = image_handler or ImageHandler()
+        self.audio_generator = AudioGenerator()
+        self.db = db
+        self.memory = memory
+        self.prefetch = prefetch
+        self.sessions = sessions
+        self.pipeline = TurnPipeline(
+            self.therapy_bot,
+            audio_handler=self.audio_handler,
+            image_handler=self.image_handler,
+            db_manager=db,
+            memory=memory,
+            prefetcher=prefetch
+        )
+
+    @classmethod
+    def from_env(cls):
+        """Service backed by the configured database, memory and prefetcher"""
+        db = None
+        # Workers starting together race to create the tables; the loser succeeds on a retry
+        for attempt in range(3):
+            try:
+                from database import db_manager, init_database
+                init_database()
+                db = db_manager
+                break
+            except Exception as e:
+                if attempt == 2:
+                    logging.error(f"Database unavailable, continuing without persistence: {e}")
+                else:
+                    time.sleep(0.5 * (attempt + 1))
+        return cls(
+            db=db,
+            memory=conversation_memory if conversation_memory.enabled else None,
+            prefetch=prefetcher if PREFETCH_ENABLED else None,
+            sessions=session_store
+        )
+
+    def status(self):
+        """Which optional backends this service has"""
+        return {
+            'database': self.db is not None,
+            'search': self.db is not None and self.db.search.enabled,
+            'memory': self.memory is not None,
+            'prefetch': self.prefetch is not None,
+            'sessions': self.sessions.name if self.sessions else None
+        }
+
+    def _user_id(self, session_id):
+        if not self.db:
+            return None
+        try:
+            return self.db.get_or_create_user(session_id).id
+        except Exception as e:
+            logging.error(f"Error loading user for session {session_id}: {e}")
+            return None
+
+    def _session(self, session_id):
+        """The session's stored state, loaded from the database only when no replica has cached it"""
+        state = self.sessions.get(session_id) if self.sessions else None
+        if state is not None and self.db and not state['user_id']:
+            # Cached while the database was unreachable
+            state = None
+        if state is None:
+            user_id = self._user_id(session_id)
+            history = self.db.get_user_conversations(session_id, limit=self.sessions.history_limit if self.sessions else 50) if self.db else []
+            state = {
+                'user_id': str(user_id) if user_id else None,
+                'history': [compact_entry(self._with_audio_id(entry)) for entry in history]
+            }
+            if self.sessions:
+                self.sessions.set(session_id, state)
+        return state
+
+    @staticmethod
+    def _with_audio_id(entry):
+        # Database rows predate the entry's audio id; it is derived from the reply text
+        if entry.get('has_audio_response') and not entry.get('audio_id'):
+            entry['audio_id'] = audio_id(speech_key(entry['assistant']))
+        return entry
+
+    def start_session(self, session_id=None):
+        """Register a session (a new one when session_id is None); returns its id and history"""
+        session_id = session_id or str(uuid.uuid4())
+        return {'session_id': session_id, 'history': self._session(session_id)['history']}
+
+    def history(self, session_id, limit=50):
+        if self.sessions and limit <= self.sessions.history_limit:
+            return self._session(session_id)['history'][-limit:]
+        if not self.db:
+            return []
+        return self.db.get_user_conversations(session_id, limit=limit)
+
+    def stats(self, session_id):
+        if not self.db:
+            return None
+        return self.db.get_user_stats(session_id)
+
+    def usage(self, session_id, days=7):
+        """The session's model tokens and cost per day and its budget status today"""
+        user_id = self._session(session_id)['user_id']
+        if not self.db or user_id is None:
+            return {'days': [], 'budget': 'ok'}
+        usage = self.db.get_token_usage(uuid.UUID(user_id), days=days)
+        today = usage[0] if usage and usage[0]['day'] == datetime.utcnow().date() else None
+        return {
+            'days': usage,
+            'budget': usage_budget.status(today),
+            'daily_token_budget': usage_budget.daily_tokens,
+            'daily_cost_budget': usage_budget.daily_cost
+        }
+
+    def analytics(self, period='hour', since=None, until=None, input_type=None):
+        """Rolled-up usage, latency and rating buckets for dashboards, or None without a database"""
+        if not self.db:
+            return None
+        return self.db.analytics.query(period, since, until, input_type)
+
+    def clear(self, session_id):
+        """Delete a session's conversations, long-term memories and queued prefetches"""
+        if self.db:
+            self.db.clear_user_conversations(session_id)
+        if self.sessions:
+            self.sessions.delete(session_id)
+        if self.memory:
+            self.memory.forget(session_id)
+        if self.prefetch:
+            self.prefetch.cancel(session_id)
+
+    def search(self, session_id, query, page=1, page_size=10):
+        if not self.db:
+            return {'results': [], 'page': page, 'has_more': False}
+        return self.db.search_conversations(session_id, query, page=page, page_size=page_size)
+
+    def feedback(self, session_id, conversation_id, rating=None, feedback_text=None):
+        """Record a rating and/or comment for one of the session's conversations; True when saved"""
+        user_id = self._session(session_id)['user_id']
+        if user_id is None:
+            return False
+        try:
+            self.db.save_user_feedback(uuid.UUID(str(conversation_id)), uuid.UUID(user_id), rating=rating, feedback_text=feedback_text)
+            return True
+        except Exception:
+            return False
+
+    @profiled("text_turn")
+    def text_turn(self, session_id, text, enable_audio_output=True, history=None, on_progress=None):
+        """Run a text turn; raises BusyError when the session is over its rate limit"""
+        admission_controller.admit_turn(session_id)
+        return self._turn(session_id, text, "text", enable_audio_output, history, on_progress)
+
+    @profiled("audio_turn")
+    def audio_turn(self, session_id, audio, enable_audio_output=True, history=None, on_progress=None):
+        """Transcribe a recording and run it as a turn"""
+        admission_controller.admit_turn(session_id)
+        with start_trace("turn"):
+            text = self.pipeline.transcribe_audio(audio)
+            if not text:
+                raise TranscriptionError("Could not transcribe audio. Please try again.")
+            return self._turn(session_id, text, "audio", enable_audio_output, history, on_progress)
+
+    @profiled("image_turn")
+    def image_turn(self, session_id, image, image_context, enable_audio_output=True, history=None, on_progress=None):
+        """Analyze an image (or a list of up to MAX_IMAGES_PER_TURN) with the user's description and run it as a turn"""
+        admission_controller.admit_turn(session_id)
+        with start_trace("turn"):
+            state = self._session(session_id)
+            # Image analysis is the costliest call, so it is subject to the budget as well
+            budget = self.pipeline.budget_status(uuid.UUID(state['user_id']) if state['user_id'] else None)
+            with usage_budget.applied(budget):
+                combined_input = self.pipeline.analyze_image(image, image_context)
+            if not combined_input:
+                raise ImageAnalysisError("Could not analyze image. Please try again.")
+            return self._turn(session_id, combined_input, "image", enable_audio_output, history, on_progress, budget)
+
+    def _turn(self, session_id, user_input, input_type, enable_audio_output, history, on_progress, budget=None):
+        state = self._session(session_id)
+        if history is None:
+            history = state['history'][-HISTORY_WINDOW:]
+        entry, warnings = self.pipeline.process_turn(
+            user_input,
+            input_type,
+            history,
+            user_id=uuid.UUID(state['user_id']) if state['user_id'] else None,
+            session_id=session_id,
+            enable_audio_output=enable_audio_output,
+            on_progress=on_progress,
+            budget=budget
+        )
+        if self.sessions:
+            # Appended in the store, not written back from this copy, so concurrent turns do not overwrite each other
+            self.sessions.append(session_id, compact_entry(entry), state)
+        return entry, warnings
+
+    def reply_audio(self, entry, timeout=AUDIO_WAIT):
+        """The entry's spoken reply; entries restored from the session store render it again when timeout is set"""
+        if entry.get('audio_data') is None and timeout and entry.get('audio_id'):
+            # Render again (or hit the shared cache)
+            entry['audio_data'] = self.audio_handler.text_to_speech(entry['assistant'])
+        return entry.get('audio_data')
+
+    def speech_audio(self, session_id, speech_id):
+        """Spoken reply speech_id from the session's recent history, or None when unknown"""
+        for entry in reversed(self._session(session_id)['history']):
+            if entry.get('audio_id') == speech_id:
+                return self.audio_handler.text_to_speech(entry['assistant'])
+        return None
+
+    def song_audio(self, song, emotion_type=None):
+        return self.audio_generator.create_song_audio(song, emotion_type)
+
+    def remedy_audio(self, remedy):
+        return self.audio_generator.create_remedy_audio(remedy)
@@ -0,0 +1,254 @@
+"""Pluggable store for per-session state shared by every process.
+
+A session's state (its user id and recent conversation history, without
+audio) is kept as compressed JSON with a TTL so any app or API replica can
+serve any session, and a restarted process resumes without re-querying
+the database. Backends, chosen with SESSION_STORE:
+
+    memory   in-process dict (default; one process only)
+    sqlite   a local SQLite file shared by processes on one host
+    redis    any Redis-compatible server (`pip install redis`)
+"""
+import os
+import json
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from metrics import metrics
+
+SESSION_TTL = float(os.getenv("SESSION_TTL", "86400"))
+# Recent exchanges kept per session; older ones stay in the database only
+SESSION_HISTORY_LIMIT = int(os.getenv("SESSION_HISTORY_LIMIT", "50"))
+# Large, re-renderable or process-local fields are not worth storing
+TRANSIENT_FIELDS = ('audio_data',)
+
+
+def _default(value):
+    if isinstance(value, Mapping):
+        return dict(value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_state(state):
+    """Serialize session state to compact compressed JSON"""
+    return zlib.compress(json.dumps(state, separators=(',', ':'), default=_default).encode('utf-8'), 6)
+
+
+def decode_state(blob):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+def compact_entry(entry):
+    """A conversation entry without its audio, ready to store"""
+    return {key: value for key, value in entry.items() if key not in TRANSIENT_FIELDS}
+
+
+class MemorySessionStore:
+    def __init__(self, ttl=SESSION_TTL, max_sessions=10000, clock=time.monotonic):
+        """LRU of serialized session state in this process"""
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry[0] <= self.clock():
+                self._entries.pop(session_id, None)
+                return None
+            self._entries.move_to_end(session_id)
+            blob = entry[1]
+        return decode_state(blob)
+
+    def set(self, session_id, state):
+        blob = encode_state(state)
+        with self._lock:
+            self._entries[session_id] = (self.clock() + self.ttl, blob)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_sessions:
+                self._entries.popitem(last=False)
+
+    def update(self, session_id, change):
+        """Replace the state with change(state or None) under the store lock"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            state = decode_state(entry[1]) if entry is not None and entry[0] > self.clock() else None
+            self._entries[session_id] = (self.clock() + self.ttl, encode_state(change(state)))
+            self._entries.move_to_end(session_id)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+
+class SQLiteSessionStore:
+    def __init__(self, path, ttl=SESSION_TTL, prune_interval=300.0):
+        """Session state in a SQLite file (WAL mode) that processes on the same host share"""
+        self.path = path
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self._local = threading.local()
+        self._next_prune = 0.0
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, state BLOB NOT NULL, expires_at REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS ix_sessions_expires ON sessions (expires_at)")
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10.0)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def get(self, session_id):
+        row = self._connect().execute(
+            "SELECT state FROM sessions WHERE session_id = ? AND expires_at > ?", (session_id, time.time())
+        ).fetchone()
+        return decode_state(row[0]) if row else None
+
+    def set(self, session_id, state):
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO sessions (session_id, state, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at",
+                (session_id, encode_state(state), now + self.ttl)
+            )
+            if now >= self._next_prune:
+                self._next_prune = now + self.prune_interval
+                db.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+
+    def update(self, session_id, change):
+        """Read, change and write the state in one write transaction, so concurrent writers queue"""
+        db = self._connect()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT state FROM sessions WHERE session_id = ? AND expires_at > ?", (session_id, now)
+            ).fetchone()
+            db.execute(
+                "INSERT INTO sessions (session_id, state, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at",
+                (session_id, encode_state(change(decode_state(row[0]) if row else None)), now + self.ttl)
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def delete(self, session_id):
+        with self._connect() as db:
+            db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+
+class RedisSessionStore:
+    def __init__(self, url, ttl=SESSION_TTL, prefix="therapy:session:"):
+        """Session state in Redis (or a compatible server), expired by the server"""
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, session_id):
+        blob = self.client.get(self.prefix + session_id)
+        return decode_state(blob) if blob else None
+
+    def set(self, session_id, state):
+        self.client.set(self.prefix + session_id, encode_state(state), ex=max(int(self.ttl), 1))
+
+    def update(self, session_id, change):
+        """Optimistic WATCH/MULTI update, retried when another writer changed the key first"""
+        key = self.prefix + session_id
+
+        def apply(pipe):
+            blob = pipe.get(key)
+            state = encode_state(change(decode_state(blob) if blob else None))
+            pipe.multi()
+            pipe.set(key, state, ex=max(int(self.ttl), 1))
+
+        self.client.transaction(apply, key)
+
+    def delete(self, session_id):
+        self.client.delete(self.prefix + session_id)
+
+
+class SessionStore:
+    def __init__(self, backend, history_limit=SESSION_HISTORY_LIMIT):
+        """Front for a backend that records metrics and never lets a store outage fail a turn"""
+        self.backend = backend
+        self.history_limit = history_limit
+        self.name = type(backend).__name__
+
+    def get(self, session_id):
+        """The session's state, or None when it is unknown, expired or the store is unreachable"""
+        try:
+            state = self.backend.get(session_id)
+        except Exception as e:
+            logging.error(f"Error reading session {session_id} from {self.name}: {e}")
+            metrics.inc("session_store_total", op="get", result="error")
+            return None
+        metrics.inc("session_store_total", op="get", result="hit" if state is not None else "miss")
+        return state
+
+    def set(self, session_id, state):
+        try:
+            state['history'] = state.get('history', [])[-self.history_limit:]
+            self.backend.set(session_id, state)
+            metrics.inc("session_store_total", op="set", result="ok")
+        except Exception as e:
+            logging.error(f"Error writing session {session_id} to {self.name}: {e}")
+            metrics.inc("session_store_total", op="set", result="error")
+
+    def append(self, session_id, entry, initial):
+        """Atomically add an entry to the session's history, so concurrent turns of one session all land
+
+        initial is the state to start from when the stored one expired meanwhile.
+        """
+        def add(state):
+            state = state if state is not None else dict(initial)
+            state['history'] = (state.get('history', []) + [entry])[-self.history_limit:]
+            return state
+
+        try:
+            self.backend.update(session_id, add)
+            metrics.inc("session_store_total", op="append", result="ok")
+        except Exception as e:
+            logging.error(f"Error appending to session {session_id} in {self.name}: {e}")
+            metrics.inc("session_store_total", op="append", result="error")
+
+    def delete(self, session_id):
+        try:
+            self.backend.delete(session_id)
+        except Exception as e:
+            logging.error(f"Error deleting session {session_id} from {self.name}: {e}")
+
+    @classmethod
+    def from_env(cls):
+        """Store selected by SESSION_STORE (memory, sqlite or redis)"""
+        kind = os.getenv("SESSION_STORE", "memory").lower()
+        try:
+            if kind == "redis":
+                backend = RedisSessionStore(os.getenv("SESSION_STORE_URL", "redis://localhost:6379/0"))
+            elif kind == "sqlite":
+                backend = SQLiteSessionStore(os.getenv("SESSION_STORE_PATH", "sessions.db"))
+            else:
+                backend = MemorySessionStore(max_sessions=int(os.getenv("SESSION_STORE_MAX_SESSIONS", "10000")))
+        except Exception as e:
+            logging.error(f"Failed to open {kind} session store, using in-memory sessions: {e}")
+            backend = MemorySessionStore()
+        return cls(backend)
+
+
+# Process-wide session store
+session_store = SessionStore.from_env()
@@ -0,0 +1,48 @@
+import re
+import threading
+from concurrent.futures import Future
+from metrics import metrics
+
+
+def normalize_key(*parts):
+    """Build a coalescing key that ignores case and whitespace differences"""
+    return "\x1f".join(re.sub(r'\s+', ' ', str(part)).strip().lower() for part in parts)
+
+
+class SingleFlight:
+    def __init__(self, name):
+        """Initialize a group that collapses concurrent identical calls into one"""
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """Run fn once per key at a time; concurrent callers with the same key share its result"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+
+        if not leader:
+            metrics.inc("singleflight_calls_total", group=self.name, role="shared")
+            return future.result()
+
+        metrics.inc("singleflight_calls_total", group=self.name, role="leader")
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def in_flight(self):
+        """Number of distinct keys currently being computed"""
+        with self._lock:
+            return len(self._calls)
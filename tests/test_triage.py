@@ -0,0 +1,14 @@
+import pytest
+from triage import CRISIS_PATTERN, CRISIS_EXAMPLES, NOT_CRISIS_EXAMPLES, triage_message
+
+
+@pytest.mark.parametrize("text", CRISIS_EXAMPLES)
+def test_crisis_phrasings_are_detected(text):
+    assert CRISIS_PATTERN.search(text)
+    assert triage_message(text).crisis
+
+
+@pytest.mark.parametrize("text", NOT_CRISIS_EXAMPLES)
+def test_everyday_phrasings_are_not_crisis(text):
+    assert not CRISIS_PATTERN.search(text)
+    assert not triage_message(text).crisis
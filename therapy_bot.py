@@ -1,13 +1,52 @@
 import os
+import json
 from google import genai
 from google.genai import types
 import logging
+from resilience import ResilientClient, ResiliencePolicy
+from admission import BusyError
+from tracing import traced
+from profiler import profiled
+from singleflight import SingleFlight, normalize_key
+from catalog import catalog_store
+from token_usage import effective_model
+from triage import triage_message, CRISIS_RESPONSE
+
+# Shared by every session in the process so identical concurrent requests hit the model once
+_coping_flight = SingleFlight("coping_strategies")
+
+
+def _parse_batch_analysis(text, count):
+    """Turn the model's JSON array into per-text analyses in the stored format"""
+    text = (text or "").strip()
+    if text.startswith("```"):
+        text = text.strip("`").removeprefix("json").strip()
+    results = [None] * count
+    for item in json.loads(text):
+        try:
+            index = int(item['id']) - 1
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 0 <= index < count and item.get('emotions'):
+            results[index] = (
+                f"Primary emotions: {item['emotions']}\n"
+                f"Urgency level: {item.get('urgency') or 'low'}\n"
+                f"Key themes: {item.get('themes') or 'not identified'}\n"
+                f"Suggested approach: {item.get('approach') or 'supportive listening'}"
+            )
+    return results
+
 
 class TherapyBot:
-    def __init__(self):
+    def __init__(self, client=None):
         """Initialize the therapy bot with Gemini client"""
         try:
-            self.client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+            # Model calls go through the resilience layer (deadline, retries, circuit breaker)
+            self.client = ResilientClient(
+                client or genai.Client(api_key=os.getenv("GEMINI_API_KEY")),
+                name="llm",
+                policy=ResiliencePolicy.from_env("LLM", timeout=20.0)
+            )
             self.model = "gemini-2.5-flash"
             
             # Therapeutic system prompt
@@ -45,9 +84,21 @@ If someone expresses thoughts of self-harm or harm to others, encourage them to
             logging.error(f"Failed to initialize TherapyBot: {e}")
             raise Exception(f"Failed to initialize AI client: {e}")
 
-    def get_response(self, user_input, conversation_history=None):
+    @traced("triage")
+    def triage(self, user_input):
+        """Run local crisis detection and emotion classification (no model call)"""
+        return triage_message(user_input)
+
+    @profiled("llm_response")
+    @traced("llm_response")
+    def get_response(self, user_input, conversation_history=None, memories=None, triage=None):
         """Generate a therapeutic response to user input"""
         try:
+            # Crisis language gets the safety response immediately, ahead of every other rule
+            triage = triage or triage_message(user_input)
+            if triage.crisis:
+                return CRISIS_RESPONSE
+            
             # Pre-filter: Check if input contains mathematical or non-emotional content
             if self._contains_non_emotional_content(user_input):
                 return self._redirect_to_emotional_support()
@@ -55,6 +106,13 @@ If someone expresses thoughts of self-harm or harm to others, encourage them to
             # Build conversation context
             context_messages = []
             
+            # Add relevant earlier turns recalled from long-term memory
+            if memories:
+                context_messages.append("Relevant moments from earlier in our conversations:")
+                for memory in memories:
+                    context_messages.append(f"- User said: {memory['user']} | You replied: {memory['assistant']}")
+                context_messages.append("")
+            
             # Add recent conversation history for context
             if conversation_history:
                 for entry in conversation_history[-3:]:  # Last 3 exchanges for context
@@ -87,6 +145,9 @@ If someone expresses thoughts of self-harm or harm to others, encourage them to
             else:
                 return "I'm here to listen and support you. Could you share a bit more about what's on your mind?"
                 
+        except BusyError:
+            # Load shedding is not a reply: the caller answers 429 or shows the busy notice instead
+            raise
         except Exception as e:
             logging.error(f"Error generating response: {e}")
             return "I apologize, but I'm having trouble processing your message right now. Please try again, and remember that if you're in crisis, please reach out to a mental health professional or emergency services."
@@ -155,6 +216,7 @@ If someone expresses thoughts of self-harm or harm to others, encourage them to
         import random
         return random.choice(redirections)
 
+    @traced("emotional_analysis")
     def analyze_emotional_context(self, text):
         """Analyze the emotional context of user input"""
         try:
@@ -183,202 +245,82 @@ Provide a brief analysis focusing on therapeutic relevance."""
             logging.error(f"Error analyzing emotional context: {e}")
             return None
 
-    def generate_coping_strategies(self, emotional_state):
-        """Generate personalized coping strategies"""
+    @traced("emotional_analysis_batch")
+    def analyze_emotional_contexts(self, texts, max_chars=1500):
+        """Analyze several texts in one request; returns analyses aligned with texts (None where missing)"""
         try:
-            prompt = f"""Based on someone experiencing {emotional_state}, suggest 3-4 practical, evidence-based coping strategies that are:
-1. Immediately actionable
-2. Appropriate for the emotional state
-3. Based on cognitive-behavioral or mindfulness techniques
-4. Safe and healthy
+            numbered = "\n\n".join(f"[{index}] {text[:max_chars]}" for index, text in enumerate(texts, 1))
+            prompt = f"""Analyze the emotional context of each numbered text below and identify:
+1. Primary emotions expressed
+2. Urgency level (low/medium/high)
+3. Key themes or concerns
+4. Suggested therapeutic approach
 
-Keep suggestions brief and practical."""
+{numbered}
+
+Respond with only a JSON array containing one object per text, in the form
+{{"id": <number>, "emotions": "...", "urgency": "low|medium|high", "themes": "...", "approach": "..."}}"""
 
             response = self.client.models.generate_content(
                 model=self.model,
                 contents=prompt,
                 config=types.GenerateContentConfig(
-                    temperature=0.6,
-                    max_output_tokens=300
+                    temperature=0.3,
+                    max_output_tokens=120 * len(texts) + 100,
+                    response_mime_type="application/json"
                 )
             )
-            
-            return response.text if response.text else None
+            return _parse_batch_analysis(response.text, len(texts))
+
+        except Exception as e:
+            logging.error(f"Error analyzing emotional context batch: {e}")
+            return [None] * len(texts)
+
+    @traced("coping_strategies")
+    def generate_coping_strategies(self, emotional_state):
+        """Generate personalized coping strategies"""
+        try:
+            # Keyed by the model actually called, so budget-downgraded requests never share a result with full ones
+            return _coping_flight.do(
+                normalize_key(effective_model(self.model), emotional_state),
+                self._request_coping_strategies,
+                emotional_state
+            )
             
         except Exception as e:
             logging.error(f"Error generating coping strategies: {e}")
             return None
 
-    def get_soothing_content(self, emotional_state):
-        """Get soothing songs and uplifting content based on emotional state"""
+    def _request_coping_strategies(self, emotional_state):
+        """Ask the model for coping strategies (called once per in-flight emotional state)"""
+        prompt = f"""Based on someone experiencing {emotional_state}, suggest 3-4 practical, evidence-based coping strategies that are:
+1. Immediately actionable
+2. Appropriate for the emotional state
+3. Based on cognitive-behavioral or mindfulness techniques
+4. Safe and healthy
+
+Keep suggestions brief and practical."""
+
+        response = self.client.models.generate_content(
+            model=self.model,
+            contents=prompt,
+            config=types.GenerateContentConfig(
+                temperature=0.6,
+                max_output_tokens=300
+            )
+        )
+        
+        return response.text if response.text else None
+
+    def get_soothing_content(self, emotional_state, category=None, secondary=None):
+        """Get soothing songs and uplifting content based on emotional state (or a triaged category)"""
+        catalog = catalog_store.current
         try:
-            # Define content based on emotional states
-            soothing_content = {
-                'anxiety': {
-                    'songs': [
-                        'Weightless by Marconi Union (scientifically proven to reduce anxiety)',
-                        'Clair de Lune by Claude Debussy',
-                        'Gymnopédie No.1 by Erik Satie',
-                        'River by Joni Mitchell',
-                        'Mad World by Gary Jules'
-                    ],
-                    'remedies': [
-                        'Deep Breathing: Take 4 slow breaths - inhale for 4 counts, hold for 4, exhale for 6',
-                        'Progressive Muscle Relaxation: Tense and release each muscle group for 5 seconds',
-                        'Grounding Technique: Name 5 things you see, 4 you hear, 3 you touch, 2 you smell, 1 you taste',
-                        'Calming Visualization: Picture a peaceful place and focus on the details',
-                        'Mindful Walking: Take slow, deliberate steps while focusing on each movement'
-                    ],
-                    'jokes': [
-                        'Why don\'t scientists trust atoms? Because they make up everything!',
-                        'I told my wife she was drawing her eyebrows too high. She looked surprised.',
-                        'What do you call a bear with no teeth? A gummy bear!',
-                        'Why don\'t eggs tell jokes? They\'d crack each other up!'
-                    ]
-                },
-                'sadness': {
-                    'songs': [
-                        'Here Comes the Sun by The Beatles',
-                        'Three Little Birds by Bob Marley',
-                        'Don\'t Stop Me Now by Queen',
-                        'Good as Hell by Lizzo',
-                        'Walking on Sunshine by Katrina and the Waves'
-                    ],
-                    'remedies': [
-                        'Journaling: Write down your feelings without judgment for 10 minutes',
-                        'Gratitude Practice: List 3 things you are grateful for today',
-                        'Gentle Movement: Do light stretching or take a short walk outside',
-                        'Self-Compassion: Talk to yourself as you would a good friend',
-                        'Creative Expression: Draw, paint, or do any creative activity that brings you joy'
-                    ],
-                    'jokes': [
-                        'What\'s the best thing about Switzerland? I don\'t know, but the flag is a big plus.',
-                        'Why did the coffee file a police report? It got mugged!',
-                        'What do you call a dinosaur that crashes his car? Tyrannosaurus Wrecks!',
-                        'Why don\'t skeletons fight each other? They don\'t have the guts!'
-                    ]
-                },
-                'stress': {
-                    'songs': [
-                        'Breathe Me by Sia',
-                        'The Sound of Silence by Simon & Garfunkel',
-                        'Zen Garden (Nature Sounds)',
-                        'Om Namah Shivaya (Meditation Chant)',
-                        'Relaxing Piano Music for Stress Relief'
-                    ],
-                    'remedies': [
-                        'Box Breathing: Breathe in for 4, hold for 4, out for 4, hold for 4 - repeat 5 times',
-                        'Time Management: Write down tasks and prioritize the top 3 for today',
-                        'Body Scan: Lie down and notice tension in each body part, then consciously relax',
-                        'Nature Break: Step outside for 5 minutes and focus on natural sounds',
-                        'Stress Ball Exercise: Squeeze and release a stress ball 10 times'
-                    ],
-                    'jokes': [
-                        'I\'m reading a book about anti-gravity. It\'s impossible to put down!',
-                        'Why did the scarecrow win an award? He was outstanding in his field!',
-                        'What do you call a fake noodle? An impasta!',
-                        'Why don\'t programmers like nature? It has too many bugs!'
-                    ]
-                },
-                'anger': {
-                    'songs': [
-                        'Let It Be by The Beatles',
-                        'Calm Down by Rema',
-                        'Peace Train by Cat Stevens',
-                        'Imagine by John Lennon',
-                        'The Long and Winding Road by The Beatles'
-                    ],
-                    'remedies': [
-                        'Anger Release: Count to 10 slowly while taking deep breaths',
-                        'Physical Release: Do 10 jumping jacks or push-ups to release tension',
-                        'Cooling Technique: Hold ice cubes or splash cold water on your face',
-                        'Perspective Shift: Ask yourself "Will this matter in 5 years?"',
-                        'Safe Expression: Write an angry letter but don\'t send it - then tear it up'
-                    ],
-                    'jokes': [
-                        'Why was the math book sad? Because it had too many problems!',
-                        'What do you call a sleeping bull? A bulldozer!',
-                        'Why did the banana go to the doctor? It wasn\'t peeling well!',
-                        'What\'s orange and sounds like a parrot? A carrot!'
-                    ]
-                },
-                'default': {
-                    'songs': [
-                        'Happy by Pharrell Williams',
-                        'Good Vibes by Chris Janson',
-                        'Count on Me by Bruno Mars',
-                        'What a Wonderful World by Louis Armstrong',
-                        'Somewhere Over the Rainbow by Israel Kamakawiwoʻole'
-                    ],
-                    'remedies': [
-                        'Mindfulness Moment: Take 3 deep breaths and notice 3 things around you',
-                        'Positive Affirmation: Say "I am capable and worthy" 3 times',
-                        'Gentle Movement: Do 5 shoulder rolls and neck stretches',
-                        'Hydration Break: Drink a glass of water slowly and mindfully',
-                        'Smile Exercise: Smile for 10 seconds - even forced smiles can boost mood'
-                    ],
-                    'jokes': [
-                        'Why don\'t scientists trust atoms? Because they make up everything!',
-                        'What do you call a bear with no teeth? A gummy bear!',
-                        'Why did the bicycle fall over? It was two tired!',
-                        'What\'s the best thing about Switzerland? I don\'t know, but the flag is a big plus!'
-                    ]
-                }
-            }
-            
-            # Determine emotional category
-            emotional_state_lower = emotional_state.lower()
-            if any(word in emotional_state_lower for word in ['anxious', 'anxiety', 'worried', 'nervous']):
-                category = 'anxiety'
-            elif any(word in emotional_state_lower for word in ['sad', 'sadness', 'depressed', 'down', 'lonely']):
-                category = 'sadness'
-            elif any(word in emotional_state_lower for word in ['stress', 'stressed', 'overwhelmed', 'pressure']):
-                category = 'stress'
-            elif any(word in emotional_state_lower for word in ['angry', 'anger', 'frustrated', 'mad', 'irritated']):
-                category = 'anger'
-            else:
-                category = 'default'
-            
-            return soothing_content[category]
-            
+            return catalog.soothing_content(emotional_state, category, secondary)
         except Exception as e:
             logging.error(f"Error getting soothing content: {e}")
-            return soothing_content['default']
+            return catalog.content[catalog.default_category]
 
-    def get_motivational_quote(self, emotional_state):
-        """Get a motivational quote based on emotional state"""
-        quotes = {
-            'anxiety': [
-                "You are braver than you believe, stronger than you seem, and smarter than you think. - A.A. Milne",
-                "Anxiety is the dizziness of freedom. - Søren Kierkegaard",
-                "Nothing can bring you peace but yourself. - Ralph Waldo Emerson"
-            ],
-            'sadness': [
-                "The sun will rise and we will try again. - Twenty One Pilots",
-                "Every storm runs out of rain. - Maya Angelou",
-                "This too shall pass. - Persian Proverb"
-            ],
-            'stress': [
-                "You have been assigned this mountain to show others it can be moved. - Mel Robbins",
-                "Stress is caused by being 'here' but wanting to be 'there'. - Eckhart Tolle",
-                "Take time to make your soul happy. - Unknown"
-            ],
-            'default': [
-                "Be yourself; everyone else is already taken. - Oscar Wilde",
-                "You are enough just as you are. - Meghan Markle",
-                "Believe you can and you're halfway there. - Theodore Roosevelt"
-            ]
-        }
-        
-        emotional_state_lower = emotional_state.lower()
-        if any(word in emotional_state_lower for word in ['anxious', 'anxiety', 'worried']):
-            category = 'anxiety'
-        elif any(word in emotional_state_lower for word in ['sad', 'sadness', 'depressed']):
-            category = 'sadness'
-        elif any(word in emotional_state_lower for word in ['stress', 'stressed', 'overwhelmed']):
-            category = 'stress'
-        else:
-            category = 'default'
-        
-        import random
-        return random.choice(quotes[category])
+    def get_motivational_quote(self, emotional_state, category=None):
+        """Get a motivational quote based on emotional state (or a triaged category)"""
+        return catalog_store.current.quote(emotional_state, category)
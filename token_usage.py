@@ -0,0 +1,163 @@
+"""Token and cost accounting for model calls, with per-user daily budgets.
+
+Every generate_content call made through a ResilientClient reports the
+response's usage metadata (input, output and cached tokens) with the model
+and the stage (span) that made it. The record goes to the metrics registry
+and to the current turn's trace; the turn's summary is saved with its
+conversation and added to the user's daily totals in user_token_usage.
+
+With USER_DAILY_TOKEN_BUDGET or USER_DAILY_COST_BUDGET set, a user past
+BUDGET_DOWNGRADE_RATIO of their budget gets the cheaper models in
+BUDGET_FALLBACK_MODELS, and a user over budget also skips the optional
+enrichment calls (emotional analysis and coping strategies). Replies and crisis
+responses are never withheld.
+"""
+import os
+import json
+import logging
+import contextvars
+from contextlib import contextmanager
+from metrics import metrics
+from tracing import current_trace, current_span
+
+# USD per million tokens: (input, output, cached input); override with MODEL_PRICES JSON
+DEFAULT_PRICES = {
+    'gemini-2.5-pro': (1.25, 10.0, 0.31),
+    'gemini-2.5-flash': (0.30, 2.50, 0.075),
+    'gemini-2.5-flash-lite': (0.10, 0.40, 0.025),
+}
+DEFAULT_FALLBACK_MODELS = "gemini-2.5-pro=gemini-2.5-flash,gemini-2.5-flash=gemini-2.5-flash-lite"
+
+_model_overrides = contextvars.ContextVar("model_overrides", default=None)
+
+
+def _load_prices():
+    prices = dict(DEFAULT_PRICES)
+    try:
+        for model, values in json.loads(os.getenv("MODEL_PRICES") or "{}").items():
+            prices[model] = tuple(float(v) for v in values)
+    except Exception as e:
+        logging.error(f"Ignoring invalid MODEL_PRICES: {e}")
+    return prices
+
+
+MODEL_PRICES = _load_prices()
+
+
+def parse_fallbacks(spec):
+    """'model=cheaper,...' to a dict"""
+    pairs = (item.split('=', 1) for item in spec.split(',') if '=' in item)
+    return {model.strip(): fallback.strip() for model, fallback in pairs}
+
+
+def call_cost(model, input_tokens, output_tokens, cached_tokens):
+    """USD cost of one call; unknown models cost 0 and are still counted in tokens"""
+    price_in, price_out, price_cached = MODEL_PRICES.get(model, (0.0, 0.0, 0.0))
+    uncached = max(input_tokens - cached_tokens, 0)
+    return (uncached * price_in + cached_tokens * price_cached + output_tokens * price_out) / 1e6
+
+
+def usage_record(model, response, stage=None):
+    """Accounting record for a response, from its usage_metadata"""
+    usage = getattr(response, 'usage_metadata', None)
+    input_tokens = getattr(usage, 'prompt_token_count', None) or 0
+    output_tokens = getattr(usage, 'candidates_token_count', None) or 0
+    cached_tokens = getattr(usage, 'cached_content_token_count', None) or 0
+    return {
+        'stage': stage or 'unknown',
+        'model': model,
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'cached_tokens': cached_tokens,
+        'cost': call_cost(model, input_tokens, output_tokens, cached_tokens)
+    }
+
+
+def record_usage(model, response):
+    """Count a successful model call in metrics and on the running turn's trace"""
+    try:
+        record = usage_record(model, response, current_span())
+    except Exception as e:
+        logging.error(f"Error reading model usage metadata: {e}")
+        return None
+    for kind in ('input', 'output', 'cached'):
+        metrics.inc("llm_tokens_total", record[f'{kind}_tokens'], model=model, stage=record['stage'], kind=kind)
+    metrics.inc("llm_cost_usd_total", record['cost'], model=model, stage=record['stage'])
+    trace = current_trace()
+    if trace is not None:
+        trace.add_usage(record)
+    return record
+
+
+def summarize(records):
+    """Per-stage and per-model totals of a turn's call records, as saved with the conversation"""
+    if not records:
+        return None
+    summary = {'calls': 0, 'input_tokens': 0, 'output_tokens': 0, 'cached_tokens': 0, 'cost': 0.0, 'stages': {}, 'models': {}}
+    for record in records:
+        for bucket in (summary, summary['stages'].setdefault(record['stage'], {}), summary['models'].setdefault(record['model'], {})):
+            bucket['calls'] = bucket.get('calls', 0) + 1
+            for field in ('input_tokens', 'output_tokens', 'cached_tokens', 'cost'):
+                bucket[field] = bucket.get(field, 0) + record[field]
+    summary['cost'] = round(summary['cost'], 8)
+    return summary
+
+
+def effective_model(model):
+    """The model to call: a budget fallback while one is active for this turn"""
+    overrides = _model_overrides.get()
+    return overrides.get(model, model) if overrides else model
+
+
+class UsageBudget:
+    def __init__(self, daily_tokens=None, daily_cost=None, downgrade_ratio=0.8, fallback_models=None):
+        """Per-user daily limits on model tokens and/or USD cost"""
+        self.daily_tokens = daily_tokens
+        self.daily_cost = daily_cost
+        self.downgrade_ratio = downgrade_ratio
+        self.fallback_models = fallback_models or {}
+
+    @classmethod
+    def from_env(cls):
+        tokens = os.getenv("USER_DAILY_TOKEN_BUDGET")
+        cost = os.getenv("USER_DAILY_COST_BUDGET")
+        return cls(
+            daily_tokens=int(tokens) if tokens else None,
+            daily_cost=float(cost) if cost else None,
+            downgrade_ratio=float(os.getenv("BUDGET_DOWNGRADE_RATIO", "0.8")),
+            fallback_models=parse_fallbacks(os.getenv("BUDGET_FALLBACK_MODELS", DEFAULT_FALLBACK_MODELS))
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.daily_tokens or self.daily_cost)
+
+    def status(self, spent):
+        """'ok', 'downgrade' or 'exhausted' for a user's usage today ({'tokens', 'cost'})"""
+        if not self.enabled or not spent:
+            return 'ok'
+        used = max(
+            spent['tokens'] / self.daily_tokens if self.daily_tokens else 0.0,
+            spent['cost'] / self.daily_cost if self.daily_cost else 0.0
+        )
+        if used >= 1.0:
+            return 'exhausted'
+        if used >= self.downgrade_ratio:
+            return 'downgrade'
+        return 'ok'
+
+    @contextmanager
+    def applied(self, status):
+        """Route model calls in this context to the fallback models unless status is 'ok'"""
+        if status == 'ok' or not self.fallback_models:
+            yield
+            return
+        token = _model_overrides.set(self.fallback_models)
+        try:
+            yield
+        finally:
+            _model_overrides.reset(token)
+
+
+# Process-wide budget policy
+usage_budget = UsageBudget.from_env()
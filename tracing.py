@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import uuid
+import logging
+import inspect
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+from metrics import metrics
+
+# Optional JSON-lines file that receives one record per finished turn trace
+TRACE_FILE = os.getenv("TRACE_FILE")
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+_trace_file_lock = threading.Lock()
+
+
+class Trace:
+    def __init__(self, name):
+        """Collect timed spans for one conversation turn"""
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self.usage = []
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, duration, error=None, **attrs):
+        span = {'name': name, 'start': round(start - self._start, 6), 'duration': round(duration, 6)}
+        if error:
+            span['error'] = error
+        if attrs:
+            span['attrs'] = attrs
+        with self._lock:
+            self.spans.append(span)
+
+    def add_usage(self, record):
+        """Attach a model call's token accounting record to the turn"""
+        with self._lock:
+            self.usage.append(record)
+
+    def stage_totals(self):
+        """Total seconds spent per span name"""
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                totals[span['name']] = round(totals.get(span['name'], 0.0) + span['duration'], 6)
+        return totals
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'trace_id': self.trace_id,
+                'name': self.name,
+                'started_at': self.started_at,
+                'duration': self.duration,
+                'spans': list(self.spans),
+                'usage': list(self.usage)
+            }
+
+
+def current_trace():
+    """Get the trace of the turn running in this context, if any"""
+    return _current_trace.get()
+
+
+def current_span():
+    """Name of the innermost span running in this context, if any"""
+    return _current_span.get()
+
+
+@contextmanager
+def start_trace(name="turn"):
+    """Start a turn trace, or join the one already active in this context"""
+    existing = _current_trace.get()
+    if existing is not None:
+        yield existing
+        return
+
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace.duration = round(time.perf_counter() - trace._start, 6)
+        metrics.observe("turn_seconds", trace.duration, trace=name)
+        if TRACE_FILE:
+            _write_trace(trace)
+
+
+def _write_trace(trace):
+    try:
+        line = json.dumps(trace.to_dict(), default=str)
+        with _trace_file_lock:
+            with open(TRACE_FILE, 'a', encoding='utf-8') as fh:
+                fh.write(line + "\n")
+    except Exception as e:
+        logging.error(f"Error writing trace file: {e}")
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time a stage, recording it on the current trace and in the stage latency histogram"""
+    start = time.perf_counter()
+    error = None
+    token = _current_span.set(name)
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        duration = time.perf_counter() - start
+        metrics.observe("stage_seconds", duration, stage=name)
+        if error:
+            metrics.inc("stage_errors_total", stage=name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(name, start, duration, error, **attrs)
+
+
+def traced(name):
+    """Decorator that wraps a function (or coroutine function) in a span"""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
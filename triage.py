@@ -0,0 +1,127 @@
+"""Deterministic fast-path triage that runs before any model call.
+
+A precompiled pattern spots crisis language so the user gets a safety
+response immediately instead of after an LLM round trip, and the soothing
+catalog's keyword index assigns the emotion category. When that category is
+unambiguous the model-based emotional analysis is skipped.
+"""
+import os
+import re
+from catalog import catalog_store
+from metrics import metrics
+
+# Crisis phrases are kept in code rather than the hot-reloaded catalog so a bad data file can never disable them
+# Violent-intent phrases are anchored so idioms like "hurt her feelings" do not replace the model's reply;
+# self-harm phrases err toward the safety response and only exclude idioms like "cutting myself off"
+CRISIS_PATTERN = re.compile(
+    r"\b("
+    r"(kill|killing) myself(?! (laughing|with laughter))"
+    r"|(cut|cutting|hurt|hurting|harm|harming) myself(?! (off|out|short|down|up|some slack|a break|loose|free))"
+    r"|(cut|cutting|slit|slitting) my (wrists?|arms?|thighs?|legs?)"
+    r"|(end|ending) (my (own )?life|it all)"
+    r"|(want|wanna|going|gonna|ready|need) (to )?end it\b(?! (with|between|off))"
+    r"|take my (own )?life|taking my (own )?life"
+    r"|suicid(e|al)|self[- ]?harm\w*"
+    r"|(want|wanna|going|plan|planning) to die(?! (of|from|laughing|for|on))|wish i (was|were) dead|better off dead"
+    r"|(don[’']?t|do not) (want to|wanna) (live|be alive|wake up|exist|be here anymore|be around anymore)(?! (in|at|with|near|here|there|like|on|by|early|so))"
+    r"|no reason to live|not worth living"
+    r"|(took|take|taking|thinking about|thought about|plan to|planning to|going to) (an )?overdos(e|ing)|overdosed"
+    r"|(?<!n't )(?<!not )(want|wanna|going|gonna|plan|planning|about|urge|urges) to (kill|hurt|stab|shoot|strangle) (someone|somebody|him|her|them|people|everyone|others)\b(?!'s)(?! (feelings|chances|reputation|career|pride|ego|business))"
+    r"|thoughts of (killing|hurting|harming) (myself|someone|somebody|people|others)"
+    r")\b",
+    re.IGNORECASE
+)
+
+# Reference phrasings for CRISIS_PATTERN, checked by tests/test_triage.py
+CRISIS_EXAMPLES = (
+    "I want to kill myself",
+    "I've been cutting myself again",
+    "sometimes I hurt myself when it gets bad",
+    "I keep thinking about harming myself",
+    "I have been self-harming",
+    "I am self harming again",
+    "I cut myself last night",
+    "I hurt myself on purpose",
+    "I might hurt myself",
+    "I want to end it all",
+    "I wanna end it",
+    "I'm thinking about ending my life",
+    "I feel suicidal",
+    "I want to die",
+    "I don't want to live anymore",
+    "I dont want to be here anymore",
+    "everyone would be better off dead without me, me included",
+    "I'm planning to take my own life",
+    "I took an overdose",
+    "I want to hurt someone",
+    "I'm going to kill him",
+    "I have thoughts of hurting people",
+)
+NOT_CRISIS_EXAMPLES = (
+    "I don't want to hurt her feelings",
+    "I keep cutting myself off from friends",
+    "I was killing myself laughing at that show",
+    "I'm going to die of embarrassment",
+    "I don't want to live in this city anymore",
+    "I cut myself some slack today",
+    "I'm worried I'll hurt his chances",
+    "My boss is going to kill me",
+    "I don't want to hurt them",
+    "I want to end it with my boyfriend but I'm scared",
+    "This week I want to end the habit of doom scrolling",
+)
+
+CRISIS_RESPONSE = os.getenv("CRISIS_RESPONSE") or (
+    "I'm really glad you told me, and I'm concerned about your safety. You don't have to go through this alone. "
+    "Please reach out right now to someone who can help: call or text 988 (Suicide & Crisis Lifeline, US), "
+    "contact your local emergency number, or find a helpline in your country at findahelpline.com. "
+    "If you're in immediate danger, please call emergency services. "
+    "I'm an AI assistant and not a replacement for professional help, but I'm here to keep talking with you. "
+    "Are you somewhere safe right now?"
+)
+
+# Keyword score at which the local category is trusted without a model analysis
+TRIAGE_MIN_SCORE = float(os.getenv("TRIAGE_MIN_SCORE", "2.0"))
+TRIAGE_SKIP_ANALYSIS = os.getenv("TRIAGE_SKIP_ANALYSIS", "true").lower() in ('1', 'true', 'yes')
+
+
+class TriageResult:
+    __slots__ = ('crisis', 'category', 'secondary', 'score', 'confident')
+
+    def __init__(self, crisis, category, secondary, score, confident):
+        """Outcome of local triage for one message"""
+        self.crisis = crisis
+        self.category = category
+        self.secondary = secondary
+        self.score = score
+        self.confident = confident
+
+    def emotional_context(self):
+        """Analysis text stored in place of the model's when triage is confident"""
+        if self.crisis:
+            return "Primary emotions: crisis\nUrgency level: high\nKey themes: crisis language detected by local triage"
+        emotions = self.category if not self.secondary else f"{self.category}, {self.secondary}"
+        return f"Primary emotions: {emotions}\nUrgency level: low\nKey themes: identified by local triage"
+
+
+def triage_message(text, min_score=None):
+    """Classify a message locally in microseconds: crisis detection plus emotion category"""
+    text = text or ""
+    if CRISIS_PATTERN.search(text):
+        metrics.inc("triage_total", outcome="crisis")
+        return TriageResult(True, 'crisis', None, 0.0, True)
+    catalog = catalog_store.current
+    category, secondary, score = catalog.classify(text)
+    confident = category != catalog.default_category and secondary is None and score >= (TRIAGE_MIN_SCORE if min_score is None else min_score)
+    metrics.inc("triage_total", outcome="confident" if confident else "deferred")
+    return TriageResult(False, category, secondary, score, confident)
+
+
+def emotion_label(result, analysis=None):
+    """Catalog category naming the message's emotion, from its triage or else the model's analysis; None if neither matches"""
+    catalog = catalog_store.current
+    if not result.crisis and result.category != catalog.default_category:
+        return result.category
+    category, _, _ = catalog.classify(analysis)
+    return category if category != catalog.default_category else None
+
@@ -0,0 +1,200 @@
+import os
+import time
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from tracing import start_trace, span
+from triage import TRIAGE_SKIP_ANALYSIS, emotion_label
+from audio_cache import audio_id, speech_key
+from metrics import metrics
+from token_usage import usage_budget, summarize
+
+# Leave emotional_context empty on uncertain turns and let backfill.py analyze them offline in batches
+DEFER_EMOTIONAL_ANALYSIS = os.getenv("DEFER_EMOTIONAL_ANALYSIS", "").lower() in ('1', 'true', 'yes')
+
+# Spoken replies render here while the supportive content is generated; separate from the prefetch queue
+_reply_audio_pool = ThreadPoolExecutor(int(os.getenv("REPLY_AUDIO_WORKERS", "4")), thread_name_prefix="reply-audio")
+
+
+class TurnPipeline:
+    def __init__(self, therapy_bot, audio_handler=None, image_handler=None, db_manager=None, memory=None, prefetcher=None):
+        """Run one conversation turn end to end, independent of the Streamlit UI"""
+        self.therapy_bot = therapy_bot
+        self.audio_handler = audio_handler
+        self.image_handler = image_handler
+        self.db_manager = db_manager
+        self.memory = memory
+        self.prefetcher = prefetcher
+
+    def process_turn(self, user_input, input_type, conversation_history, user_id=None, session_id=None, enable_audio_output=True, on_progress=None, budget=None):
+        """Generate the reply, audio and supportive content for a turn; returns (entry, warnings)
+
+        on_progress(stage, data), when given, is called as soon as the reply text and
+        then the supportive content are ready, for clients that stream the turn.
+        budget is the user's usage_budget status, looked up when not given.
+        """
+        with start_trace("turn") as trace:
+            budget = budget or self.budget_status(user_id)
+            with usage_budget.applied(budget):
+                return self._process_turn(trace, user_input, input_type, conversation_history, user_id, session_id, enable_audio_output, on_progress, budget)
+
+    def budget_status(self, user_id):
+        """'ok', 'downgrade' or 'exhausted' from the user's model usage so far today"""
+        if not usage_budget.enabled or not self.db_manager or not user_id:
+            return 'ok'
+        today = self.db_manager.get_token_usage(user_id, days=1)
+        status = usage_budget.status(today[0] if today else None)
+        metrics.inc("usage_budget_total", status=status)
+        return status
+
+    def _process_turn(self, trace, user_input, input_type, conversation_history, user_id, session_id, enable_audio_output, on_progress, budget):
+        warnings = []
+        prefetch = self.prefetcher if session_id else None
+        if prefetch:
+            # A new turn supersedes whatever the previous one still had queued
+            prefetch.cancel(session_id)
+
+        # Local triage: crisis detection and the emotion category, before any model call
+        triage = self.therapy_bot.triage(user_input)
+
+        # Recall relevant earlier turns beyond the recent history window
+        memories = None
+        if self.memory and session_id and not triage.crisis:
+            memories = self.memory.recall(session_id, user_input, conversation_history)
+
+        start_time = time.time()
+
+        # Get AI response
+        response = self.therapy_bot.get_response(user_input, conversation_history, memories=memories, triage=triage)
+
+        response_time = time.time() - start_time
+        if on_progress:
+            on_progress("reply", {'assistant': response, 'crisis': triage.crisis, 'response_time': response_time})
+
+        # Render the spoken reply alongside the supportive content; the copied context keeps its span on this trace
+        reply_audio = None
+        if enable_audio_output and self.audio_handler:
+            reply_audio = _reply_audio_pool.submit(contextvars.copy_context().run, self.audio_handler.text_to_speech, response)
+
+        # Analyze emotional context and generate supportive content
+        emotional_context = None
+        coping_strategies = None
+        soothing_content = None
+        motivational_quote = None
+        try:
+            if triage.crisis:
+                # Only the safety response; songs and jokes are not appropriate here
+                emotional_context = triage.emotional_context()
+            elif budget == 'exhausted':
+                # Over the daily budget: catalog content only, no optional model calls
+                emotional_context = triage.emotional_context() if triage.confident else None
+                with span("supportive_content"):
+                    soothing_content = self.therapy_bot.get_soothing_content(triage.category, triage.category, triage.secondary)
+                    motivational_quote = self.therapy_bot.get_motivational_quote(triage.category, triage.category)
+            elif (triage.confident and TRIAGE_SKIP_ANALYSIS) or DEFER_EMOTIONAL_ANALYSIS:
+                # The keyword category is unambiguous (or analysis is left to backfill.py), so the model call is skipped
+                emotional_context = triage.emotional_context() if triage.confident else None
+                # An uncertain triage category is only the catalog default, so the strategies come from the message itself
+                coping_strategies = self.therapy_bot.generate_coping_strategies(triage.category if triage.confident else user_input)
+                with span("supportive_content"):
+                    soothing_content = self.therapy_bot.get_soothing_content(triage.category, triage.category, triage.secondary)
+                    motivational_quote = self.therapy_bot.get_motivational_quote(triage.category, triage.category)
+            else:
+                emotional_context = self.therapy_bot.analyze_emotional_context(user_input)
+                if emotional_context:
+                    # Extract key emotional state for personalized content
+                    emotional_state = emotional_context.split('\n')[0] if emotional_context else user_input
+                    # Keyed by a catalog category where one matches, so concurrent turns about the same feeling share a request
+                    coping_strategies = self.therapy_bot.generate_coping_strategies(emotion_label(triage, emotional_context) or emotional_state)
+                    with span("supportive_content"):
+                        soothing_content = self.therapy_bot.get_soothing_content(emotional_state)
+                        motivational_quote = self.therapy_bot.get_motivational_quote(emotional_state)
+        except Exception as e:
+            logging.warning(f"Emotional analysis failed: {e}")
+
+        if on_progress:
+            on_progress("content", {
+                'emotional_context': emotional_context,
+                'coping_strategies': coping_strategies,
+                'soothing_content': soothing_content,
+                'motivational_quote': motivational_quote
+            })
+
+        # Speculatively render the song and remedy audio the user is likely to click next
+        if prefetch and soothing_content:
+            prefetch.prefetch_enrichment(session_id, soothing_content, emotional_context)
+
+        # Recorded as an audio response only when the audio was actually rendered
+        audio_data = None
+        has_audio_response = False
+        if reply_audio is not None:
+            try:
+                audio_data = reply_audio.result()
+                has_audio_response = audio_data is not None
+            except Exception as e:
+                warnings.append(f"Audio generation failed: {str(e)}")
+
+        # Stage breakdown up to this point is persisted with the conversation
+        stage_timings = trace.stage_totals()
+        token_usage = summarize(trace.usage)
+
+        # Save to database if available
+        conversation_id = None
+        if self.db_manager and user_id:
+            try:
+                conversation_record = self.db_manager.save_conversation(
+                    user_id=user_id,
+                    session_id=session_id,
+                    user_input=user_input,
+                    ai_response=response,
+                    input_type=input_type,
+                    has_audio_response=has_audio_response,
+                    emotional_context=emotional_context,
+                    response_time=response_time,
+                    stage_timings=stage_timings,
+                    token_usage=token_usage
+                )
+                conversation_id = conversation_record.id
+            except Exception as e:
+                logging.error(f"Failed to save conversation to database: {e}")
+                warnings.append("Conversation not saved to database")
+
+        # Index the turn for long-term recall in the background
+        if self.memory and session_id:
+            self.memory.remember_async(session_id, conversation_id, user_input, response)
+
+        conversation_entry = {
+            'id': str(conversation_id) if conversation_id else None,
+            'user': user_input,
+            'assistant': response,
+            'input_type': input_type,
+            'audio_data': audio_data,
+            # Lets any replica serve the spoken reply later from the stored text
+            'audio_id': audio_id(speech_key(response)) if has_audio_response else None,
+            'has_audio_response': has_audio_response,
+            'emotional_context': emotional_context,
+            'coping_strategies': coping_strategies,
+            'soothing_content': soothing_content,
+            'motivational_quote': motivational_quote,
+            'crisis': triage.crisis,
+            'response_time': response_time,
+            'stage_timings': stage_timings,
+            'token_usage': token_usage,
+            'budget': budget,
+            'created_at': time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        return conversation_entry, warnings
+
+    def transcribe_audio(self, audio_data):
+        """Convert a voice recording to text, or None if it could not be understood"""
+        return self.audio_handler.speech_to_text(audio_data)
+
+    def analyze_image(self, uploaded_images, image_context):
+        """Analyze one or more uploaded images in one request and build the combined turn input, or None on failure"""
+        if not isinstance(uploaded_images, (list, tuple)):
+            uploaded_images = [uploaded_images]
+        analysis = self.image_handler.analyze_images(uploaded_images, image_context)
+        image_analysis = analysis.to_text() if analysis else None
+        if not image_analysis:
+            return None
+        return f"[Image Context: {image_context}]\n[Image Analysis: {image_analysis}]"
@@ -0,0 +1,198 @@
+"""Voice activity detection and chunking for speech-to-text.
+
+A recording is decoded once, downmixed to mono 16-bit PCM at STT_SAMPLE_RATE
+and split into 30 ms frames. Frames are classified as speech by energy above
+an adaptive noise floor (or by WebRTC's VAD when `pip install webrtcvad` is
+available and VAD_BACKEND=webrtc). Speech frames are merged into segments
+across short pauses, leading and trailing silence is dropped, and long
+recordings are packed into chunks of at most STT_CHUNK_SECONDS that can be
+recognized in parallel. A clip with no speech yields no chunks, so it never
+reaches the recognition service.
+"""
+import io
+import os
+import wave
+import logging
+import numpy as np
+
+STT_SAMPLE_RATE = int(os.getenv("STT_SAMPLE_RATE", "16000"))
+STT_CHUNK_SECONDS = float(os.getenv("STT_CHUNK_SECONDS", "20"))
+VAD_BACKEND = os.getenv("VAD_BACKEND", "energy").lower()
+# Frames quieter than this are never speech, whatever the noise floor
+VAD_MIN_DBFS = float(os.getenv("VAD_MIN_DBFS", "-45"))
+# How far above the estimated noise floor a frame must be to count as speech
+VAD_MARGIN_DB = float(os.getenv("VAD_MARGIN_DB", "10"))
+# Frames louder than this are always speech, so a recording without pauses is not mistaken for noise
+VAD_MAX_THRESHOLD_DBFS = -30.0
+
+FRAME_MS = 30
+# Pauses shorter than this stay inside one segment
+MAX_PAUSE_MS = 400
+MIN_SPEECH_MS = 150
+# Context kept around each segment so word onsets and endings are not clipped
+PADDING_MS = 200
+# Silence placed between segments spliced into one chunk
+PAUSE_MS = 250
+
+
+class Clip:
+    __slots__ = ('samples', 'rate')
+
+    def __init__(self, samples, rate):
+        """Mono int16 PCM samples at rate Hz"""
+        self.samples = samples
+        self.rate = rate
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.rate if self.rate else 0.0
+
+    def pcm(self, start=0, end=None):
+        """Raw little-endian 16-bit PCM for samples[start:end]"""
+        return self.samples[start:end].astype('<i2').tobytes()
+
+
+def decode_wav(data, target_rate=STT_SAMPLE_RATE):
+    """Decode WAV bytes to a mono 16-bit Clip at target_rate, or None for other formats"""
+    try:
+        with wave.open(io.BytesIO(data), 'rb') as wav:
+            channels = wav.getnchannels()
+            width = wav.getsampwidth()
+            rate = wav.getframerate()
+            frames = wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    if width == 1:
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128.0) * 256.0
+    elif width == 2:
+        samples = np.frombuffer(frames, dtype='<i2').astype(np.float32)
+    elif width == 4:
+        samples = np.frombuffer(frames, dtype='<i4').astype(np.float32) / 65536.0
+    else:
+        return None
+    if channels > 1:
+        samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels).mean(axis=1)
+    if target_rate and rate != target_rate and len(samples):
+        samples = _resample(samples, rate, target_rate)
+        rate = target_rate
+    return Clip(np.clip(samples, -32768, 32767).astype(np.int16), rate)
+
+
+def _resample(samples, rate, target_rate):
+    if target_rate < rate:
+        # Box low-pass before decimating keeps most aliasing out of the speech band
+        width = int(round(rate / target_rate))
+        if width > 1:
+            samples = np.convolve(samples, np.ones(width) / width, mode='same')
+    count = int(len(samples) * target_rate / rate)
+    positions = np.arange(count) * (rate / target_rate)
+    return np.interp(positions, np.arange(len(samples)), samples)
+
+
+def frame_energies(clip, frame_ms=FRAME_MS):
+    """RMS level of each frame in dBFS"""
+    size = int(clip.rate * frame_ms / 1000)
+    count = len(clip.samples) // size
+    if count == 0:
+        return np.zeros(0)
+    frames = clip.samples[:count * size].astype(np.float32).reshape(count, size)
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    return 20 * np.log10(np.maximum(rms, 1.0) / 32768.0)
+
+
+def _energy_flags(clip, frame_ms):
+    levels = frame_energies(clip, frame_ms)
+    if not len(levels):
+        return levels.astype(bool)
+    # The quietest tenth of the recording approximates the room's noise floor
+    noise_floor = np.percentile(levels, 10)
+    return levels > max(VAD_MIN_DBFS, min(noise_floor + VAD_MARGIN_DB, VAD_MAX_THRESHOLD_DBFS))
+
+
+def _webrtc_flags(clip, frame_ms):
+    import webrtcvad
+    vad = webrtcvad.Vad(int(os.getenv("VAD_AGGRESSIVENESS", "2")))
+    size = int(clip.rate * frame_ms / 1000)
+    count = len(clip.samples) // size
+    return np.array([vad.is_speech(clip.pcm(i * size, (i + 1) * size), clip.rate) for i in range(count)], dtype=bool)
+
+
+def speech_flags(clip, frame_ms=FRAME_MS):
+    """Per-frame speech/non-speech decisions"""
+    if VAD_BACKEND == "webrtc" and clip.rate in (8000, 16000, 32000, 48000):
+        try:
+            return _webrtc_flags(clip, frame_ms)
+        except ImportError:
+            logging.warning("webrtcvad is not installed; using energy-based voice detection")
+    return _energy_flags(clip, frame_ms)
+
+
+def detect_speech(clip, frame_ms=FRAME_MS):
+    """Speech segments as [(start_sample, end_sample)], silence trimmed and short pauses bridged"""
+    flags = speech_flags(clip, frame_ms)
+    size = int(clip.rate * frame_ms / 1000)
+    max_pause = MAX_PAUSE_MS // frame_ms
+    min_speech = max(1, MIN_SPEECH_MS // frame_ms)
+    padding = int(clip.rate * PADDING_MS / 1000)
+
+    segments = []
+    start = None
+    last_voiced = None
+    for index, voiced in enumerate(flags):
+        if voiced:
+            if start is None:
+                start = index
+            last_voiced = index
+        elif start is not None and index - last_voiced > max_pause:
+            segments.append((start, last_voiced + 1))
+            start = None
+    if start is not None:
+        segments.append((start, last_voiced + 1))
+
+    padded = []
+    for first, last in segments:
+        if last - first < min_speech:
+            continue
+        begin = max(first * size - padding, 0)
+        end = min(last * size + padding, len(clip.samples))
+        if padded and begin <= padded[-1][1]:
+            padded[-1] = (padded[-1][0], end)
+        else:
+            padded.append((begin, end))
+    return padded
+
+
+def chunk_segments(segments, rate, max_seconds=STT_CHUNK_SECONDS):
+    """Group segments into chunks of at most max_seconds of speech, splitting only at pauses
+
+    A single segment longer than the limit is cut into limit-sized pieces.
+    """
+    limit = int(max_seconds * rate)
+    chunks = []
+    length = 0
+    for begin, end in segments:
+        pieces = []
+        while end - begin > limit:
+            pieces.append((begin, begin + limit))
+            begin += limit
+        pieces.append((begin, end))
+        for piece in pieces:
+            size = piece[1] - piece[0]
+            if chunks and length + size <= limit:
+                chunks[-1].append(piece)
+                length += size
+            else:
+                chunks.append([piece])
+                length = size
+    return chunks
+
+
+def chunk_pcm(clip, chunk):
+    """PCM for a chunk's segments, joined by a short pause instead of the original silence"""
+    gap = np.zeros(int(clip.rate * PAUSE_MS / 1000), dtype=np.int16)
+    parts = []
+    for index, (begin, end) in enumerate(chunk):
+        if index:
+            parts.append(gap)
+        parts.append(clip.samples[begin:end])
+    return Clip(np.concatenate(parts), clip.rate).pcm()